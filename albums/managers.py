@@ -0,0 +1,76 @@
+from django.db import connections, models, transaction
+from django.db.models import Q
+
+from vibly.ordering import StaleOrder, arrange, get_order_version
+
+UPDATE_BATCH_SIZE = 500
+
+
+class AlbumPositionManager(models.Manager):
+    """
+    Tracks of an album, numbered 1, 2, 3... by order.
+    """
+    def get_version(self, album):
+        return get_order_version(self.filter(album=album).order_by('order', 'id').only('song'))
+
+    def reorder(self, album, song_public_ids, version):
+        """
+        Numbers the tracks of the album in the order of song_public_ids (see vibly.ordering.arrange) at once.
+        Raises StaleOrder if they changed since version was read. Returns the new version.
+        """
+        with transaction.atomic():
+            tracks = list(self.filter(album=album).select_for_update(of=('self',)).select_related('song')
+                          .order_by('order', 'id').only('order', 'song__public_id'))
+
+            current = get_order_version(tracks)
+            if version != current:
+                raise StaleOrder(current)
+
+            tracks = arrange(tracks, song_public_ids)
+
+            moved = []
+            for order, track in enumerate(tracks, 1):
+                if track.order != order:
+                    track.order = order
+                    moved.append(track)
+
+            self.bulk_update(moved, ['order'], batch_size=UPDATE_BATCH_SIZE)
+
+        return get_order_version(tracks)
+
+    def remove(self, album, orders=(), start=None, end=None, songs=()):
+        """
+        Deletes the tracks at orders, from start to end (both included) and of songs at once, then numbers the
+        remaining ones 1, 2, 3... again in the same transaction. Returns the number of deleted tracks.
+        """
+        removed = Q(order__in=orders) | Q(song__public_id__in=songs)
+        if start is not None:
+            removed |= Q(order__range=(start, end))
+
+        with transaction.atomic(using=self.db):
+            count, _ = self.filter(album=album).filter(removed).delete()
+            if count:
+                self.renumber(album)
+
+        return count
+
+    def renumber(self, album):
+        """
+        Numbers the tracks of the album 1, 2, 3... by their current order with a single UPDATE, which only
+        writes the rows whose order changes.
+        """
+        connection = connections[self.db]
+        opts = self.model._meta
+        table = connection.ops.quote_name(opts.db_table)
+        pk = connection.ops.quote_name(opts.pk.column)
+        order = connection.ops.quote_name(opts.get_field('order').column)
+        album_id = connection.ops.quote_name(opts.get_field('album').column)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET {order} = numbered.position '
+                f'FROM (SELECT {pk}, ROW_NUMBER() OVER (ORDER BY {order}, {pk}) AS position '
+                f'FROM {table} WHERE {album_id} = %s) AS numbered '
+                f'WHERE {table}.{pk} = numbered.{pk} AND {table}.{order} <> numbered.position',
+                [album.pk],
+            )
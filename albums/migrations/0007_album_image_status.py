@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0006_alter_album_public_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='cover_job',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='cover_status',
+            field=models.CharField(choices=[('ready', 'Ready'), ('pending', 'Pending'), ('failed', 'Failed')], default='ready', editable=False, max_length=16),
+        ),
+    ]
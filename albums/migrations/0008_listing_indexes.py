@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-18 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0007_album_image_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='album',
+            index=models.Index(fields=['created_at', 'id'], name='albums_albu_created_1b0f95_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='album',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='albums_albu_author__601c03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='albumposition',
+            index=models.Index(fields=['album', 'order'], name='albums_albu_album_i_f59a22_idx'),
+        ),
+    ]
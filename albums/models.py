@@ -1,10 +1,14 @@
 import uuid
 
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 from django.db.models import F
 
 from songs.models import Song
+from vibly.img import ImageStatus, remove_image
+from .managers import AlbumPositionManager
 
 
 class Album(models.Model):
@@ -12,17 +16,30 @@ class Album(models.Model):
     title = models.CharField(max_length=255)
     author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     cover = models.ImageField(upload_to='albums/covers/', blank=True, default='defaults/albums/default.png')
+    cover_status = models.CharField(max_length=16, choices=ImageStatus.choices, default=ImageStatus.READY,
+                                    editable=False)
+    cover_job = models.UUIDField(blank=True, null=True, editable=False)
+    cover_staged = models.CharField(max_length=255, blank=True, editable=False)
     description = models.TextField(max_length=500, blank=True, null=True)
     public = models.BooleanField(default=False)
     created_at = models.DateField(auto_now_add=True, editable=False)
 
+    class Meta:
+        indexes = [
+            # listings, newest first
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['author', 'created_at', 'id']),
+        ]
+
     def __str__(self):
         return f'{self.title} - ({self.id})'
 
-    def delete(self, using=None, keep_parents=False):
-        if self.cover.name != self.cover.field.default:
-            self.cover.delete()
-        return super().delete(using, keep_parents)
+
+@receiver(post_delete, sender=Album)
+def release_album_cover(sender, instance, **kwargs):
+    # also runs for QuerySet.delete() and cascades, which skip Model.delete()
+    if instance.cover.name != instance.cover.field.default:
+        remove_image(instance.cover.name)
 
 
 class AlbumPosition(models.Model):
@@ -30,8 +47,13 @@ class AlbumPosition(models.Model):
     order = models.IntegerField(default=0)
     song = models.OneToOneField(Song, on_delete=models.CASCADE, related_name='album_position', editable=False)
 
+    objects = AlbumPositionManager()
+
     class Meta:
         ordering = ['order']
+        indexes = [
+            models.Index(fields=['album', 'order']),
+        ]
 
     def __str__(self):
         return f'{self.album.title} - {self.song.title} - {self.order}'
@@ -1,11 +1,17 @@
+from collections import Counter
+
+from django.db import transaction
 from rest_framework import serializers
 from django.db.models import F, Max
 
 from .models import Album, AlbumPosition
 from users.serializers import UserSerializer
-from songs.models import Song
-from songs.serializers import SongSerializer
-from vibly.img import reshape_and_return_url, delete_image
+from songs.serializers import SongPublicIdField, SongSerializer, load_songs
+from vibly.img import schedule_reshape, get_variant_urls
+from vibly.pagination import PaginatedRelationField
+
+# tracks per INSERT, SQLite limits the number of parameters of a statement
+BULK_CREATE_BATCH_SIZE = 250
 
 
 class AlbumPositionSerializer(serializers.ModelSerializer):
@@ -88,36 +94,42 @@ class AlbumPositionSerializer(serializers.ModelSerializer):
 
 
 class CreateAlbumPositionListSerializer(serializers.ListSerializer):
-    def is_valid(self, raise_exception=False):
-        errors = []
-        for data in self.initial_data:
-            serializer = self.child.__class__(data=data, context=self.context)
-            serializer.is_valid(raise_exception=False)
-            if serializer.errors:
-                errors.append(serializer.errors)
+    # Adds any number of tracks with a constant number of queries: the songs are read at once,
+    # the tracks are numbered after the last one and inserted together
 
-        if errors:
-            raise serializers.ValidationError(errors)
+    def to_internal_value(self, data):
+        self.songs = load_songs(data, 'song_pk', self.child.fields['song'])
+        try:
+            validated_data = super().to_internal_value(data)
+        finally:
+            del self.songs
 
-        return super().is_valid(raise_exception)
+        # a song belongs to one album, once
+        counts = Counter(item['song'] for item in validated_data)
+        duplicates = {song.title for song, count in counts.items() if count > 1}
+        if duplicates:
+            raise serializers.ValidationError(f'{", ".join(sorted(duplicates))} listed more than once')
 
-    def save(self, **kwargs):
-        result = []
-        for data in self.validated_data:
-            new_data = {'song_pk': data.get('song').public_id}
+        return validated_data
+
+    def create(self, validated_data):
+        album = self.context.get('album')
 
-            serializer = self.child.__class__(data=new_data, context=self.context)
-            serializer.is_valid(raise_exception=True)
-            serializer.save(**kwargs)
-            result.append(serializer.instance)
+        if album is None:
+            raise Exception('You must include album in context')
 
-        return result
+        with transaction.atomic():
+            max_order = album.album_positions.aggregate(Max('order'))['order__max'] or 0
+
+            return AlbumPosition.objects.bulk_create(
+                [AlbumPosition(album=album, song=item['song'], order=max_order + index)
+                 for index, item in enumerate(validated_data, 1)],
+                batch_size=BULK_CREATE_BATCH_SIZE
+            )
 
 
 class CreateAlbumPositionSerializer(AlbumPositionSerializer):
-    song_pk = serializers.SlugRelatedField(
-        queryset=Song.objects.all(), source='song', write_only=True, slug_field='public_id'
-    )
+    song_pk = SongPublicIdField(source='song', write_only=True)
 
     class Meta(AlbumPositionSerializer.Meta):
         list_serializer_class = CreateAlbumPositionListSerializer
@@ -126,31 +138,38 @@ class CreateAlbumPositionSerializer(AlbumPositionSerializer):
 
 class AlbumSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
-    album_positions = AlbumPositionSerializer(many=True, required=False)
+    # the first page, the following ones are listed by /album/<public_id>/order/
+    album_positions = PaginatedRelationField(AlbumPositionSerializer(),
+                                             lambda album: f'/album/{album.public_id}/order/')
+    cover_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Album
-        fields = ['title', 'author', 'description', 'cover', 'album_positions', 'created_at', 'public', 'public_id']
-        read_only_fields = ['author']
+        fields = ['title', 'author', 'description', 'cover', 'cover_variants', 'cover_status', 'album_positions',
+                  'created_at', 'public', 'public_id']
+        read_only_fields = ['author', 'cover_status']
 
     def save(self, **kwargs):
         self.validated_data['author'] = self.context.get('request').user
 
         cover = self.validated_data.pop('cover', None)
 
-        if cover:
-            if self.instance:
-                delete_image(self.instance.cover)
+        self.instance = self.instance or Album.objects.create(**self.validated_data)
 
-            self.validated_data['cover'] = reshape_and_return_url(cover,
-                                                                  cover.name,
-                                                                  self.Meta.model.cover.field.upload_to,
-                                                                  height=512,
-                                                                  width=512)
+        if cover:
+            schedule_reshape(self.instance, 'cover', cover, height=512, width=512)
 
-        self.instance = self.instance or Album.objects.create(**self.validated_data)
         return self.instance
 
+    def get_cover_variants(self, instance):
+        return get_variant_urls(instance.cover, self.context.get('request'))
+
+
+class AlbumListSerializer(AlbumSerializer):
+    # listings leave the tracks out, they would take a query per album
+    class Meta(AlbumSerializer.Meta):
+        fields = [field for field in AlbumSerializer.Meta.fields if field != 'album_positions']
+
 
 class CreateAlbumSerializer(AlbumSerializer):
     album_positions = CreateAlbumPositionSerializer(many=True, required=False)
@@ -160,12 +179,12 @@ class CreateAlbumSerializer(AlbumSerializer):
         super().save(**kwargs)
 
         self.context['album'] = self.instance
-        if album_positions is not None:
-            for album_position in album_positions:
-                album_position['song_pk'] = album_position.pop('song').public_id
-
-            serializer = CreateAlbumPositionSerializer(data=album_positions, context=self.context, many=True)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+        if album_positions:
+            # validated with the album already
+            self.fields['album_positions'].create(album_positions)
 
         return self.instance
+
+    def to_representation(self, instance):
+        # like retrieving it, with the first page of tracks
+        return AlbumSerializer(instance, context=self.context).data
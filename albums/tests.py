@@ -1,8 +1,12 @@
 import random
 
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from playlists.models import Playlist
 from songs.models import Song
 from .models import Album, AlbumPosition
 from songs.tests import SongCreate
@@ -40,6 +44,7 @@ class AlbumCreate:
         return AlbumPosition.objects.filter(album=album, order=response.data.get('order')).first()
 
 
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class AlbumTests(APITestCase):
     def setUp(self):
         user_dict = UserCreate.create_user_dict(self.client)
@@ -84,6 +89,26 @@ class AlbumTests(APITestCase):
         self.assertTrue(album.public)
         self.assertEqual(album.cover.url, f'/{response.data.get("cover").split("/", 3)[-1]}')
 
+    def test_copy_album_to_playlist(self):
+        album = self.create_album()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(3)]
+        for order, song in zip([2, 3, 1], songs):
+            AlbumPosition.objects.create(album=album, song=song, order=order)
+
+        other = UserCreate.create_user_dict(self.client)
+        response = self.client.post(f'/album/{album.public_id}/copy/',
+                                    HTTP_AUTHORIZATION=f'Bearer {other.get("token")}')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        playlist = Playlist.objects.get(public_id=response.data.get('public_id'))
+        self.assertEqual(playlist.author, other.get('user'))
+        self.assertEqual(playlist.title, album.title)
+        self.assertEqual([playlist_song.song for playlist_song in playlist.playlist_songs.all()],
+                         [songs[2], songs[0], songs[1]])
+
+        # the default album cover isn't a playlist cover
+        self.assertEqual(playlist.cover.name, playlist.cover.field.default)
+
     def test_create_album_position(self):
         songs = [self.create_song() for i in range(3)]
 
@@ -160,6 +185,29 @@ class AlbumTests(APITestCase):
         self.assertEqual(album.author, self.user)
         self.assertTrue(album.public)
 
+    def test_retrieve_album_queries(self):
+        album = self.create_album()
+
+        def add_songs(count):
+            for i in range(count):
+                song = SongCreate.create_song_row(self.user, title=f'Song number {i}')
+                AlbumPosition.objects.create(album=album, song=song, order=album.album_positions.count() + 1)
+
+        def retrieve():
+            response = self.client.get(f'/album/{album.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response
+
+        add_songs(1)
+        with CaptureQueriesContext(connection) as queries:
+            retrieve()
+
+        add_songs(20)
+        with self.assertNumQueries(len(queries)):
+            response = retrieve()
+
+        self.assertEqual(len(response.data['album_positions']['results']), 21)
+
     def test_delete_album(self):
         album = self.create_album()
 
@@ -172,6 +220,7 @@ class AlbumTests(APITestCase):
         self.assertEqual(AlbumPosition.objects.count(), 0)
 
 
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class AlbumPositionTest(APITestCase):
     def setUp(self):
         user_dict = UserCreate.create_user_dict(self.client)
@@ -319,6 +368,89 @@ class AlbumPositionTest(APITestCase):
             self.assertIsNotNone(album_position)
             self.assertEqual(album_position.order, preferred_order)
 
+    def test_create_album_positions_in_bulk(self):
+        album = self.create_album()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(33)]
+        url = f'/album/{album.public_id}/order/'
+
+        def add_songs(songs):
+            data = [{'song_pk': str(song.public_id)} for song in songs]
+            return self.client.post(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = add_songs(songs[:3])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with self.assertNumQueries(len(queries)):
+            response = add_songs(songs[3:])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([album_position['order'] for album_position in response.data], list(range(4, 34)))
+
+        album_positions = album.album_positions.all()
+        self.assertEqual([album_position.song for album_position in album_positions], songs)
+
+        # songs already in an album, other users' songs and songs listed twice are refused
+        other = UserCreate.create_user_dict(self.client).get('user')
+        other_song = SongCreate.create_song_row(other)
+        response = add_songs([songs[0], other_song])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data), 2)
+
+        song = SongCreate.create_song_row(self.user)
+        response = add_songs([song, song])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(album.album_positions.count(), len(songs))
+
+    def test_reorder_album_positions(self):
+        album = self.create_album()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(4)]
+        for order, song in enumerate(songs, 1):
+            AlbumPosition.objects.create(album=album, song=song, order=order)
+
+        url = f'/album/{album.public_id}/order/'
+        response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        version = response['ETag'].strip('"')
+
+        data = {'songs': [str(song.public_id) for song in reversed(songs)], 'version': version}
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        album_positions = album.album_positions.all()
+        self.assertEqual([album_position.song for album_position in album_positions], songs[::-1])
+        self.assertEqual([album_position.order for album_position in album_positions], [1, 2, 3, 4])
+
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+        other = UserCreate.create_user_dict(self.client)
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {other.get("token")}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_remove_album_positions(self):
+        album = self.create_album()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(6)]
+        for order, song in enumerate(songs, 1):
+            AlbumPosition.objects.create(album=album, song=song, order=order)
+
+        url = f'/album/{album.public_id}/order/'
+        response = self.client.delete(url, {'start': 2}, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        data = {'songs': [str(songs[0].public_id)], 'start': 3, 'end': 4, 'orders': [6]}
+        response = self.client.delete(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['removed'], 4)
+
+        # the remaining tracks are numbered again
+        album_positions = album.album_positions.all()
+        self.assertEqual([album_position.song for album_position in album_positions], [songs[1], songs[4]])
+        self.assertEqual([album_position.order for album_position in album_positions], [1, 2])
+
+        other = UserCreate.create_user_dict(self.client)
+        response = self.client.delete(url, {'orders': [1]}, HTTP_AUTHORIZATION=f'Bearer {other.get("token")}',
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_update_song_pk(self):
         album = self.create_album()
         album_position = self.create_album_position(album=album)
@@ -5,14 +5,22 @@ from django.shortcuts import get_object_or_404
 
 from .models import Album, AlbumPosition
 from .serializers import AlbumSerializer, \
+    AlbumListSerializer, \
     CreateAlbumSerializer, \
     AlbumPositionSerializer, \
     CreateAlbumPositionSerializer
+from playlists.models import Playlist
+from playlists.serializers import PlaylistSerializer
+from vibly.filters import VisibleListFilter
+from vibly.mixins import EagerLoadingMixin, eager_load
+from vibly.ordering import RemoveTracksSerializer, ReorderSerializer, StaleOrder
+from vibly.pagination import TrackPagination
 
 
-class AlbumsViewSet(viewsets.ModelViewSet):
+class AlbumsViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     lookup_field = 'public_id'
     queryset = Album.objects.all()
+    filter_backends = [VisibleListFilter]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -52,13 +60,27 @@ class AlbumsViewSet(viewsets.ModelViewSet):
         self.perform_destroy(album)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def copy(self, request, *args, **kwargs):
+        album = self.get_object()
+
+        if album.author != request.user and not album.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        # into a playlist, which only takes public songs
+        playlist = Playlist.objects.copy(album, request.user, album.album_positions.filter(song__public=True),
+                                         ('order', 'id'))
+        serializer = PlaylistSerializer(playlist, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateAlbumSerializer
+        if self.action == 'list':
+            return AlbumListSerializer
         return AlbumSerializer
 
     def get_permissions(self):
-        if self.action == 'create' or self.action == 'partial_update':
+        if self.action in ('create', 'partial_update', 'copy'):
             permission_classes = [IsAuthenticated]
         else:
             permission_classes = [AllowAny]
@@ -69,7 +91,55 @@ class AlbumPositionsViewSet(viewsets.ModelViewSet):
     multiple_lookup_fields = {'album': 'public_id', 'album_position': 'album_position_order'}
     album_queryset = Album.objects.all()
     album_position_queryset = AlbumPosition.objects.all()
-    permission_classes = [IsAuthenticated]
+    pagination_class = TrackPagination
+
+    def list(self, request, *args, **kwargs):
+        album = self.get_album()
+
+        if album.author != request.user and not album.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        page = self.paginate_queryset(eager_load(album.album_positions.all(), self.get_serializer()))
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+
+        # the version reorder expects, it reads every track so only the first page has it
+        if self.paginator.cursor_query_param not in request.query_params:
+            response['ETag'] = f'"{AlbumPosition.objects.get_version(album)}"'
+
+        return response
+
+    def reorder(self, request, *args, **kwargs):
+        album = self.get_album()
+
+        if album.author != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        version = serializer.validated_data.get('version') or request.headers.get('If-Match', '').strip('"')
+
+        try:
+            version = AlbumPosition.objects.reorder(album, serializer.validated_data['songs'], version)
+        except StaleOrder as e:
+            return Response({'detail': 'The tracks changed since they were read', 'version': e.version},
+                            status=status.HTTP_412_PRECONDITION_FAILED,
+                            headers={'ETag': f'"{e.version}"'})
+        except ValueError as e:
+            return Response({'songs': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'version': version}, headers={'ETag': f'"{version}"'})
+
+    def bulk_destroy(self, request, *args, **kwargs):
+        album = self.get_album()
+
+        if album.author != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        removed = AlbumPosition.objects.remove(album, **serializer.validated_data)
+        return Response({'removed': removed})
 
     def create(self, request, *args, **kwargs):
         album = self.get_album()
@@ -77,7 +147,10 @@ class AlbumPositionsViewSet(viewsets.ModelViewSet):
         if album.author != request.user:
             return Response(status=status.HTTP_403_FORBIDDEN)
 
-        serializer = self.get_serializer(data=request.data, context=self.get_serializer_context() | {'album': album})
+        # a list of tracks is added at once
+        serializer = self.get_serializer(data=request.data,
+                                         many=isinstance(request.data, list),
+                                         context=self.get_serializer_context() | {'album': album})
         serializer.is_valid(raise_exception=True)
         self.perform_create(serializer)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -110,8 +183,19 @@ class AlbumPositionsViewSet(viewsets.ModelViewSet):
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateAlbumPositionSerializer
+        if self.action == 'reorder':
+            return ReorderSerializer
+        if self.action == 'bulk_destroy':
+            return RemoveTracksSerializer
         return AlbumPositionSerializer
 
+    def get_permissions(self):
+        if self.action == 'list':
+            permission_classes = [AllowAny]
+        else:
+            permission_classes = [IsAuthenticated]
+        return [permission() for permission in permission_classes]
+
     def get_album(self):
         album_pk_url = self.multiple_lookup_fields.get('album')
         album_pk = self.kwargs.get(album_pk_url)
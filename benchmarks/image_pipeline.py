@@ -0,0 +1,99 @@
+"""
+Peak memory and time of vibly.img.reshape_and_return_url for large uploads.
+
+Every case runs in a fresh process, so ru_maxrss is the peak of that single image. The baseline case only imports
+Django and Pillow. Images are created in a separate process too, a forked child starts with its parent's pages.
+
+    python benchmarks/image_pipeline.py [--repeat 3]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CASES = {
+    'baseline': None,
+    'jpeg 24MP': ('photo.jpg', (6000, 4000)),
+    'jpeg 12MP rotated': ('rotated.jpg', (4000, 3000)),
+    'png 12MP': ('screenshot.png', (4000, 3000)),
+}
+
+
+def create_image(path, size):
+    from PIL import Image
+
+    # a gradient with noise compresses like a photo rather than a flat color
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 64)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+    exif = Image.Exif()
+    if 'rotated' in path:
+        # orientation 6: stored sideways, displayed rotated by 90 degrees
+        exif[0x0112] = 6
+
+    image.save(path, quality=90, exif=exif) if path.endswith('.jpg') else image.save(path)
+
+
+def run_case(directory, name):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'vibly.settings'
+
+    import vibly.settings
+    vibly.settings.MEDIA_ROOT = os.path.join(directory, 'media')
+
+    import django
+    django.setup()
+    from vibly.img import reshape_and_return_url
+
+    if CASES[name] is None:
+        return 0
+
+    filename = CASES[name][0]
+    start = time.perf_counter()
+    with open(os.path.join(directory, filename), 'rb') as file:
+        reshape_and_return_url(file, filename, 'covers/', width=512, height=512)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--create', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.create:
+        for case in CASES.values():
+            if case is not None:
+                create_image(os.path.join(args.directory, case[0]), case[1])
+        return
+
+    if args.case:
+        print(run_case(args.directory, args.case))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, __file__, '--create', '--directory', directory], check=True)
+
+        print(f'{"case":<20}{"peak rss (MB)":>15}{"time (s)":>10}')
+        for name in CASES:
+            peaks, times = [], []
+            for _ in range(args.repeat):
+                process = subprocess.Popen([sys.executable, __file__, '--case', name, '--directory', directory],
+                                           stdout=subprocess.PIPE)
+                output = process.stdout.read()
+                _, _, usage = os.wait4(process.pid, 0)
+
+                peaks.append(usage.ru_maxrss / 1024)
+                times.append(float(output))
+
+            print(f'{name:<20}{min(peaks):>15.1f}{min(times):>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
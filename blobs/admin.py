@@ -0,0 +1,6 @@
+from django.contrib import admin
+
+from .models import Blob, PendingDeletion
+
+admin.site.register(Blob)
+admin.site.register(PendingDeletion)
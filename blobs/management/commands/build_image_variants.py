@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from PIL import UnidentifiedImageError
+
+from albums.models import Album
+from playlists.models import Playlist
+from songs.models import Song
+from vibly.img import ImageTooLarge, get_variant_formats, get_variant_name, load_square, save_variants
+
+IMAGE_FIELDS = (
+    (Song, 'cover'),
+    (Album, 'cover'),
+    (Playlist, 'cover'),
+    (get_user_model(), 'pfp'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Builds the size and format variants of covers and profile pictures stored before they existed'
+
+    def handle(self, *args, **options):
+        built = 0
+        for model, field_name in IMAGE_FIELDS:
+            default = model._meta.get_field(field_name).default
+            names = model.objects.exclude(**{field_name: default}).exclude(**{field_name: ''}) \
+                .values_list(field_name, flat=True).distinct()
+
+            for name in names.iterator():
+                # images with every variant in place are skipped, so the command can simply be run again
+                missing = [image_format for image_format in get_variant_formats()
+                           for size in settings.IMAGE_VARIANT_SIZES
+                           if not default_storage.exists(get_variant_name(name, size, image_format))]
+                if not missing:
+                    continue
+
+                try:
+                    with default_storage.open(name, 'rb') as file:
+                        save_variants(load_square(file, max(settings.IMAGE_VARIANT_SIZES)), name)
+                except (FileNotFoundError, UnidentifiedImageError, ImageTooLarge) as e:
+                    self.stderr.write(f'{name}: {e}')
+                    continue
+
+                built += 1
+                self.stdout.write(f'\r{model._meta.verbose_name} {built}', ending='')
+
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f'Built variants of {built} images'))
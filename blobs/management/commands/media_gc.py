@@ -0,0 +1,321 @@
+import datetime
+import hashlib
+import heapq
+import json
+import os
+import posixpath
+import re
+import time
+from array import array
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from albums.models import Album
+from blobs.models import Blob
+from playlists.models import Playlist
+from songs.models import Song, SongRendition, UploadSession
+from songs.segments import SEGMENTS_DIRECTORY
+from vibly.img import VARIANT_EXTENSIONS, get_variant_name
+
+FILE_FIELDS = (
+    (Song, 'song_file'),
+    (Song, 'waveform'),
+    (Song, 'cover'),
+    (SongRendition, 'file'),
+    (Album, 'cover'),
+    (Playlist, 'cover'),
+    (get_user_model(), 'pfp'),
+    # uploads of image jobs that haven't ended, retry_image_jobs may run them again
+    (Song, 'cover_staged'),
+    (Album, 'cover_staged'),
+    (Playlist, 'cover_staged'),
+    (get_user_model(), 'pfp_staged'),
+)
+QUARANTINE_DIRECTORY = 'quarantine'
+# never swept: images shipped with the app and files already quarantined
+EXCLUDED_DIRECTORIES = ('defaults', QUARANTINE_DIRECTORY)
+CONTENT_ADDRESSED_STEM = re.compile(r'^[0-9a-f]{64}(?:_|$)')
+VARIANT_NAME = re.compile(rf'^(.+)_(\d+)\.(?:{"|".join(VARIANT_EXTENSIONS.values())})$')
+SEGMENT_NAME = re.compile(rf'^{SEGMENTS_DIRECTORY}/([^/]+)/')
+# prefixes per OR-ed query, SQLite limits the depth of expressions
+PREFIX_QUERY_SIZE = 100
+# entries of a local directory kept in memory at once while it's scanned in key order
+SCAN_CHUNK_SIZE = 10000
+
+
+def hash_name(name):
+    # 8 bytes per referenced name, a collision only keeps an orphan
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+
+def get_owner_prefix(name):
+    # Derived files live as long as the file they were made from: the image of a variant, the song file of
+    # a segment. Returns the prefix of the names that keep name alive, None if it's only kept by its own name.
+    match = SEGMENT_NAME.match(name)
+    if match:
+        return f'{Song.song_file.field.upload_to}{match.group(1)}.'
+
+    directory, basename = posixpath.split(name)
+    match = VARIANT_NAME.match(basename)
+    if match and int(match.group(2)) in settings.IMAGE_VARIANT_SIZES:
+        return posixpath.join(directory, f'{match.group(1)}.')
+
+    return None
+
+
+def is_after(key, position):
+    # a file after position, or a directory holding names after it. Directory keys end with /.
+    return position is None or key > position or (key.endswith('/') and position.startswith(key) and position != key)
+
+
+def scan_directory(path, directory, position):
+    # Yields (name, is_directory) of a local directory after position in key order. os.scandir streams entries
+    # unordered, every pass keeps the SCAN_CHUNK_SIZE smallest keys after the last one yielded, so memory stays
+    # bounded and entries up to position are read but never kept.
+    prefix = f'{directory}/' if directory else ''
+
+    while True:
+        try:
+            with os.scandir(path) as entries:
+                keys = heapq.nsmallest(SCAN_CHUNK_SIZE,
+                                       (key for key in (f'{prefix}{entry.name}{"/" if entry.is_dir() else ""}'
+                                                        for entry in entries)
+                                        if is_after(key, position)))
+        except FileNotFoundError:
+            return
+
+        for key in keys:
+            yield key[len(prefix):].rstrip('/'), key.endswith('/')
+
+        if len(keys) < SCAN_CHUNK_SIZE:
+            return
+        position = keys[-1]
+
+
+def get_sha256(name):
+    # content addressed files, their variants and segments are named after the SHA-256 of their content
+    prefix = get_owner_prefix(name) or name
+    stem = posixpath.basename(prefix).split('.')[0]
+    return stem[:64] if CONTENT_ADDRESSED_STEM.match(stem) else None
+
+
+class Command(BaseCommand):
+    help = 'Deletes stored media that no longer belongs to any song, album, playlist or user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files that would be deleted')
+        parser.add_argument('--quarantine', action='store_true',
+                            help=f'Move files to {QUARANTINE_DIRECTORY}/<run>/ instead of deleting them')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Hours since a file was written before it can be collected, '
+                                 'uploads in progress are stored before their rows are committed')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of files checked at once')
+        parser.add_argument('--rate', type=float, default=100, help='Files deleted per second at most, 0 for no limit')
+        parser.add_argument('--max-files', type=int, help='Stop after scanning this many files, '
+                                                          'the next run continues from the checkpoint')
+        parser.add_argument('--checkpoint', default=os.path.join(settings.BASE_DIR, '.media-gc'),
+                            help='File the position of an unfinished sweep is kept in')
+        parser.add_argument('--reset', action='store_true', help='Start over instead of continuing from the checkpoint')
+
+    def handle(self, *args, **options):
+        self.storage = default_storage
+        self.dry_run = options['dry_run']
+        self.quarantine = options['quarantine']
+        self.min_age = datetime.timedelta(hours=options['min_age'])
+        self.rate = options['rate']
+        self.checkpoint = options['checkpoint']
+        self.run = timezone.now().strftime('%Y%m%d%H%M%S')
+
+        position = None
+        if not options['reset'] and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint:
+                position = json.load(checkpoint)['position']
+            self.stdout.write(f'Continuing after {position}')
+
+        self.references = self.build_references()
+        self.stdout.write(f'{len(self.references)} referenced names')
+
+        self.started = time.monotonic()
+        self.scanned, self.removed = 0, 0
+        max_files = options['max_files']
+        finished = True
+
+        batch = []
+        for name in self.walk('', position):
+            batch.append(name)
+            self.scanned += 1
+
+            if len(batch) >= options['batch_size']:
+                self.collect(batch)
+                batch = []
+
+            if max_files and self.scanned >= max_files:
+                finished = False
+                break
+
+        if batch:
+            self.collect(batch)
+
+        if finished and not self.dry_run and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+        action = 'Would remove' if self.dry_run else 'Quarantined' if self.quarantine else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'Scanned {self.scanned} files. {action} {self.removed} files'
+                                             + ('' if finished else ', run again to continue')))
+
+    def build_references(self):
+        # Hashes of every name the database refers to, derived files included, as a sorted array
+        hashes = array('Q')
+
+        for model, field_name in FILE_FIELDS:
+            field = model._meta.get_field(field_name)
+            names = model.objects.exclude(**{field_name: ''}).order_by().values_list(field_name, flat=True).distinct()
+
+            for name in names.iterator():
+                hashes.append(hash_name(name))
+
+                if isinstance(field, models.ImageField) and name != field.default:
+                    for size in settings.IMAGE_VARIANT_SIZES:
+                        for image_format in VARIANT_EXTENSIONS:
+                            hashes.append(hash_name(get_variant_name(name, size, image_format)))
+
+                # a directory per song, its segments are written before the song is flagged as segmented
+                if field_name == 'song_file':
+                    stem = posixpath.splitext(posixpath.basename(name))[0]
+                    hashes.append(hash_name(f'{SEGMENTS_DIRECTORY}/{stem}/'))
+
+        # parts of resumable uploads in progress, when they're staged inside MEDIA_ROOT. Expired ones are orphans.
+        for public_id in UploadSession.objects.unexpired().values_list('public_id', flat=True).iterator():
+            path = os.path.relpath(UploadSession(public_id=public_id).staging_path, settings.MEDIA_ROOT)
+            if not path.startswith('..'):
+                hashes.append(hash_name(path.replace(os.sep, '/')))
+
+        return np.unique(np.frombuffer(hashes, np.uint64))
+
+    def is_referenced(self, names):
+        if not len(self.references):
+            return np.zeros(len(names), bool)
+
+        hashes = np.array([hash_name(name) for name in names], np.uint64)
+        index = np.minimum(np.searchsorted(self.references, hashes), len(self.references) - 1)
+        return self.references[index] == hashes
+
+    def walk(self, directory, position):
+        # Yields stored names in key order (a directory sorts as <name>/) after position, skipping referenced
+        # directories. Listings start at position, what comes before it isn't listed again.
+        for name, is_directory in self.list_entries(directory, position):
+            path = posixpath.join(directory, name)
+
+            if not is_directory:
+                yield path
+            elif path not in EXCLUDED_DIRECTORIES and not self.is_referenced([f'{path}/'])[0]:
+                yield from self.walk(path, position)
+
+    def list_entries(self, directory, position):
+        # object stores list after a key themselves (vibly.storage.S3Storage), local directories are scanned
+        iter_entries = getattr(self.storage, 'iter_entries', None)
+        if iter_entries is not None:
+            return iter_entries(directory, position)
+
+        try:
+            return scan_directory(self.storage.path(directory), directory, position)
+        except NotImplementedError:
+            directories, files = self.storage.listdir(directory)
+            prefix = f'{directory}/' if directory else ''
+            entries = sorted([(f'{name}/', True) for name in directories] + [(name, False) for name in files])
+            return [(name.rstrip('/'), is_directory) for name, is_directory in entries
+                    if is_after(prefix + name, position)]
+
+    def collect(self, batch):
+        candidates = [name for name, referenced in zip(batch, self.is_referenced(batch)) if not referenced]
+        candidates = [name for name in candidates if self.is_old(name)]
+
+        with transaction.atomic():
+            # uploads adding a reference to one of these blobs hold its row until they commit,
+            # so their references are visible below
+            list(Blob.objects.select_for_update()
+                 .filter(sha256__in={sha256 for sha256 in map(get_sha256, candidates) if sha256}))
+
+            live = self.find_live(candidates)
+            orphans = [name for name in candidates if name not in live]
+
+            # rows go first, a file left behind by a crash is found by the next run
+            if not self.dry_run:
+                Blob.objects.filter(name__in=orphans).delete()
+
+        for name in orphans:
+            self.remove(name)
+
+        if not self.dry_run:
+            self.prune({posixpath.dirname(name) for name in orphans})
+            self.save_checkpoint(batch[-1])
+
+    def is_old(self, name):
+        try:
+            return self.storage.get_modified_time(name) < timezone.now() - self.min_age
+        except FileNotFoundError:
+            return False
+
+    def find_live(self, names):
+        # The names referenced right now, the snapshot of the references is minutes old after a long scan
+        exact = [name for name in names if get_owner_prefix(name) is None]
+        prefixes = {get_owner_prefix(name) for name in names} - {None}
+        referenced, referenced_prefixes = set(), set()
+
+        for model, field_name in FILE_FIELDS:
+            referenced.update(model.objects.filter(**{f'{field_name}__in': exact})
+                              .values_list(field_name, flat=True))
+
+            pending = sorted(prefixes - referenced_prefixes)
+            for index in range(0, len(pending), PREFIX_QUERY_SIZE):
+                chunk = pending[index:index + PREFIX_QUERY_SIZE]
+                query = Q()
+                for prefix in chunk:
+                    query |= Q(**{f'{field_name}__startswith': prefix})
+
+                for value in model.objects.filter(query).values_list(field_name, flat=True):
+                    referenced_prefixes.update(prefix for prefix in chunk if value.startswith(prefix))
+
+        return {name for name in names
+                if name in referenced or get_owner_prefix(name) in referenced_prefixes}
+
+    def remove(self, name):
+        if self.dry_run:
+            self.stdout.write(name)
+        elif self.quarantine:
+            with self.storage.open(name, 'rb') as file:
+                self.storage.save(f'{QUARANTINE_DIRECTORY}/{self.run}/{name}', file)
+            self.storage.delete(name)
+        else:
+            self.storage.delete(name)
+
+        self.removed += 1
+
+        if self.rate and not self.dry_run:
+            delay = self.started + self.removed / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def prune(self, directories):
+        # local storages keep the directories of deleted files, object stores have none
+        for directory in sorted(directories, reverse=True):
+            if not directory:
+                continue
+            try:
+                os.rmdir(self.storage.path(directory))
+            except (NotImplementedError, OSError):
+                pass
+
+    def save_checkpoint(self, position):
+        # written aside and renamed, an interrupted run never leaves a partial checkpoint
+        temporary = f'{self.checkpoint}.tmp'
+        with open(temporary, 'w') as checkpoint:
+            json.dump({'position': position}, checkpoint)
+        os.replace(temporary, self.checkpoint)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from albums.models import Album
+from playlists.models import Playlist
+from songs.models import Song
+from vibly.img import retry_reshapes
+
+# (model, field, size the serializers reshape it to)
+IMAGE_FIELDS = (
+    (Song, 'cover', 512),
+    (Album, 'cover', 512),
+    (Playlist, 'cover', 512),
+    (get_user_model(), 'pfp', 512),
+)
+
+
+class Command(BaseCommand):
+    help = 'Processes covers and profile pictures again when their job was lost, pending for longer than ' \
+           'IMAGE_JOB_TIMEOUT. The ones whose upload is gone are marked failed.'
+
+    def handle(self, *args, **options):
+        retried = failed = 0
+        for model, field_name, size in IMAGE_FIELDS:
+            model_retried, model_failed = retry_reshapes(model, field_name, size, size, settings.IMAGE_JOB_TIMEOUT)
+            retried += model_retried
+            failed += model_failed
+
+        self.stdout.write(self.style.SUCCESS(f'Retried {retried} image jobs, {failed} failed'))
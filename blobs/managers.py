@@ -0,0 +1,141 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import F
+
+from vibly.tasks import submit_once
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(file):
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+class BlobManager(models.Manager):
+    """
+    Content addressed files. Every stored file is named after its SHA-256 and shared by all references to it.
+    """
+    def acquire(self, file, upload_to):
+        """
+        Stores the file unless identical content is already stored and adds a reference to it.
+        """
+        # the hashing upload handlers compute it while the upload streams in
+        sha256 = getattr(file, 'sha256', None) or hash_file(file)
+        extension = file.name.split('.')[-1].lower()
+
+        with transaction.atomic():
+            blob, created = self.get_or_create(sha256=sha256,
+                                               defaults={'name': f'{upload_to}{sha256}.{extension}',
+                                                         'size': file.size})
+            if created:
+                blob.name = default_storage.save(blob.name, file)
+                blob.save(update_fields=['name'])
+
+            self.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+
+        blob.refcount += 1
+        return blob
+
+    def retain(self, blob):
+        """
+        Adds a reference to a stored blob, for another row sharing its file.
+        """
+        self.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+        blob.refcount += 1
+        return blob
+
+    def release(self, blob):
+        """
+        Drops a reference and deletes the file with the last one, once the transaction commits.
+        Returns True if the file is deleted.
+        """
+        from .models import PendingDeletion
+
+        with transaction.atomic():
+            self.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+            deleted, _ = self.filter(pk=blob.pk, refcount__lte=0).delete()
+
+            if deleted:
+                PendingDeletion.objects.enqueue([blob.name])
+
+        return bool(deleted)
+
+
+def delete_stored(name):
+    if not name.endswith('/'):
+        default_storage.delete(name)
+        return
+
+    # object stores have no directories, listing is the only check that works everywhere
+    try:
+        names = default_storage.listdir(name)[1]
+    except FileNotFoundError:
+        return
+
+    for file_name in names:
+        default_storage.delete(f'{name}{file_name}')
+
+
+class PendingDeletionManager(models.Manager):
+    """
+    Stored files waiting to be deleted. Rows are written in the transaction that stops referencing the files,
+    so a rollback forgets them and a crash after the commit doesn't. A worker deletes the files after the commit.
+    """
+    def enqueue(self, names):
+        """
+        Deletes the files once the current transaction commits, names ending with / delete a whole directory.
+        """
+        names = [name for name in names if name]
+        if not names:
+            return
+
+        self.bulk_create([self.model(name=name) for name in names])
+        submit_once(self.drain)
+
+    def drain(self, batch_size=None):
+        """
+        Deletes queued files in batches until the queue is empty. Files that fail are retried by later drains,
+        up to MEDIA_DELETION_MAX_ATTEMPTS times.
+        """
+        from .models import Blob
+
+        batch_size = batch_size or settings.MEDIA_DELETION_BATCH_SIZE
+        failed = set()
+
+        while True:
+            with transaction.atomic():
+                # concurrent drains take different rows
+                pending = list(self.select_for_update(skip_locked=True).exclude(pk__in=failed).order_by('pk')
+                               [:batch_size])
+                if not pending:
+                    return
+
+                # a blob stored under a queued name again owns the file
+                taken = set(Blob.objects.filter(name__in=[deletion.name for deletion in pending])
+                            .values_list('name', flat=True))
+
+                done, retried = [], []
+                for deletion in pending:
+                    try:
+                        if deletion.name not in taken:
+                            delete_stored(deletion.name)
+                        done.append(deletion.pk)
+                    except OSError as e:
+                        logger.warning('Deleting %s failed: %s', deletion.name, e)
+                        failed.add(deletion.pk)
+                        if deletion.attempts + 1 >= settings.MEDIA_DELETION_MAX_ATTEMPTS:
+                            # media_gc collects the file once it's unreferenced for long enough
+                            done.append(deletion.pk)
+                        else:
+                            retried.append(deletion.pk)
+
+                self.filter(pk__in=done).delete()
+                self.filter(pk__in=retried).update(attempts=F('attempts') + 1)
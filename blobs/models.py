@@ -0,0 +1,28 @@
+from django.db import models
+
+from .managers import BlobManager, PendingDeletionManager
+
+
+class Blob(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return f'{self.name} ({self.refcount})'
+
+
+class PendingDeletion(models.Model):
+    # a name ending with / stands for every file in that directory
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    objects = PendingDeletionManager()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,188 @@
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+
+from vibly.img import share_image
+from vibly.ordering import StaleOrder, arrange, get_order_version
+from vibly.tasks import submit
+
+# ranks of tracks are spread this far apart, so a track fits between any two about 20 times before a rebalance
+RANK_GAP = 1 << 20
+# inserting into a narrower gap rebalances the playlist in the background
+RANK_MIN_GAP = 1 << 6
+UPDATE_BATCH_SIZE = 500
+
+
+class PlaylistSongQuerySet(models.QuerySet):
+    def before(self, playlist_song):
+        # the tracks of the queryset that come before playlist_song
+        return self.filter(Q(rank__lt=playlist_song.rank) | Q(rank=playlist_song.rank, pk__lt=playlist_song.pk))
+
+    def at(self, order):
+        """
+        Returns the track at the 1-based position order. Raises DoesNotExist if there is none.
+        """
+        try:
+            if order < 1:
+                raise IndexError(order)
+            playlist_song = self.order_by('rank', 'id')[order - 1]
+        except IndexError:
+            raise self.model.DoesNotExist(f'There is no track at {order}')
+
+        playlist_song.order = order
+        return playlist_song
+
+
+class PlaylistSongManager(models.Manager.from_queryset(PlaylistSongQuerySet)):
+    """
+    Tracks are kept in order by sparse ranks, adding or moving one only writes its own row and deleting one
+    writes none. The public order (1, 2, 3...) of a track is its position by rank.
+    """
+    def lock(self, playlist_id):
+        # Everything writing ranks of a playlist takes its row first, so a rank is never computed from ranks
+        # another transaction is rewriting
+        playlists = self.model.playlist.field.related_model.objects
+        list(playlists.select_for_update().filter(pk=playlist_id).values_list('pk'))
+
+    def get_rank(self, playlist, order=None, exclude=None):
+        """
+        Returns the rank that puts a track at the 1-based position order among the tracks of the playlist,
+        at the end if order is None or past it. exclude is the track being moved. Locks the playlist, the track
+        has to be saved in the same transaction.
+        """
+        self.lock(playlist.pk)
+        tracks = self.filter(playlist=playlist).exclude(pk=getattr(exclude, 'pk', None)).order_by('rank', 'id')
+        before, after = None, None
+
+        # the neighbours at order - 1 and order in one query
+        ranks = []
+        if order is not None:
+            order = max(order, 1)
+            ranks = list(tracks.values_list('rank', flat=True)[max(order - 2, 0):order])
+
+        if order == 1:
+            after = ranks[0] if ranks else None
+        elif ranks:
+            before, after = ranks[0], ranks[1] if len(ranks) > 1 else None
+        else:
+            before = tracks.reverse().values_list('rank', flat=True).first()
+
+        if before is None and after is None:
+            return 0
+        if after is None:
+            return before + RANK_GAP
+        if before is None:
+            return after - RANK_GAP
+
+        if after - before < 2:
+            # no room left between them, rare enough to rebalance right away
+            self.rebalance(playlist.pk)
+            return self.get_rank(playlist, order, exclude)
+
+        if after - before < RANK_MIN_GAP:
+            # once the track is saved with the rank returned below
+            transaction.on_commit(lambda: submit(self.rebalance, playlist.pk))
+
+        return (before + after) // 2
+
+    def rebalance(self, playlist_id):
+        """
+        Spreads the ranks of a playlist RANK_GAP apart again, keeping their order.
+        """
+        with transaction.atomic():
+            self.lock(playlist_id)
+            tracks = list(self.filter(playlist_id=playlist_id).order_by('rank', 'id').only('pk', 'rank'))
+
+            for index, track in enumerate(tracks):
+                track.rank = index * RANK_GAP
+
+            self.bulk_update(tracks, ['rank'], batch_size=UPDATE_BATCH_SIZE)
+
+    def get_version(self, playlist):
+        return get_order_version(self.filter(playlist=playlist).order_by('rank', 'id').only('song'))
+
+    def reorder(self, playlist, song_public_ids, version):
+        """
+        Puts the tracks of the playlist in the order of song_public_ids (see vibly.ordering.arrange) at once.
+        Raises StaleOrder if they changed since version was read. Returns the new version.
+        """
+        with transaction.atomic():
+            self.lock(playlist.pk)
+            tracks = list(self.filter(playlist=playlist).select_related('song')
+                          .order_by('rank', 'id').only('rank', 'song__public_id'))
+
+            current = get_order_version(tracks)
+            if version != current:
+                raise StaleOrder(current)
+
+            tracks = arrange(tracks, song_public_ids)
+
+            moved = []
+            for index, track in enumerate(tracks):
+                if track.rank != index * RANK_GAP:
+                    track.rank = index * RANK_GAP
+                    moved.append(track)
+
+            self.bulk_update(moved, ['rank'], batch_size=UPDATE_BATCH_SIZE)
+
+        return get_order_version(tracks)
+
+    def copy_tracks(self, playlist, tracks, ordering):
+        """
+        Appends the songs of tracks (a queryset of PlaylistSong or AlbumPosition), in ordering, to the empty
+        playlist with a single INSERT ... SELECT. The copies are ranked RANK_GAP apart.
+        """
+        positions = tracks.order_by().annotate(position=Window(RowNumber(), order_by=[F(field) for field in ordering]))
+        sql, params = positions.values('song_id', 'position').query.sql_with_params()
+
+        connection = connections[self.db]
+        opts = self.model._meta
+        columns = ', '.join(connection.ops.quote_name(opts.get_field(name).column)
+                            for name in ('playlist', 'song', 'rank'))
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {connection.ops.quote_name(opts.db_table)} ({columns}) '
+                f'SELECT %s, tracks.song_id, (tracks.position - 1) * %s FROM ({sql}) AS tracks',
+                [playlist.pk, RANK_GAP, *params],
+            )
+            return cursor.rowcount
+
+    def remove(self, playlist, orders=(), start=None, end=None, songs=()):
+        """
+        Deletes the tracks at the 1-based positions orders, from start to end (both included) and of songs in
+        a single DELETE. The tracks after them move up by rank, so none is written. Returns the number deleted.
+        """
+        tracks = self.filter(playlist=playlist).order_by('rank', 'id')
+        removed = Q(song__public_id__in=songs)
+
+        with transaction.atomic():
+            self.lock(playlist.pk)
+
+            if start is not None:
+                removed |= Q(pk__in=tracks.values('pk')[start - 1:end])
+
+            if orders:
+                orders = set(orders)
+                first = min(orders)
+                pks = tracks.values_list('pk', flat=True)[first - 1:max(orders)]
+                removed |= Q(pk__in=[pk for order, pk in enumerate(pks, first) if order in orders])
+
+            count, _ = tracks.filter(removed).delete()
+
+        return count
+
+
+class PlaylistManager(models.Manager):
+    def copy(self, source, author, tracks, ordering):
+        """
+        Creates a private playlist of author with the title, description and cover of source, a playlist or an
+        album, and the songs of tracks in ordering (see PlaylistSongManager.copy_tracks). The cover is shared
+        with source rather than processed again.
+        """
+        with transaction.atomic(using=self.db):
+            cover = source.cover.name if share_image(source.cover.name) else self.model.cover.field.default
+            playlist = self.create(title=source.title, author=author, description=source.description, cover=cover)
+            playlist.playlist_songs.model.objects.copy_tracks(playlist, tracks, ordering)
+
+        return playlist
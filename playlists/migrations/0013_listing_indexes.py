@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-18 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlists', '0012_playlist_image_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='playlist',
+            index=models.Index(fields=['created_at', 'id'], name='playlists_p_created_907342_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playlist',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='playlists_p_author__2a0b09_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playlistsong',
+            index=models.Index(fields=['playlist', 'order'], name='playlists_p_playlis_ebb84f_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.0.4 on 2026-10-18 03:10
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def copy_order(apps, schema_editor):
+    # orders were dense, spread them apart as PlaylistSongManager does
+    PlaylistSong = apps.get_model('playlists', 'PlaylistSong')
+    PlaylistSong.objects.update(rank=F('order') * (1 << 20))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('playlists', '0013_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playlistsong',
+            name='rank',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(copy_order, migrations.RunPython.noop),
+        migrations.AlterModelOptions(
+            name='playlistsong',
+            options={'ordering': ['rank', 'id']},
+        ),
+        migrations.RemoveIndex(
+            model_name='playlistsong',
+            name='playlists_p_playlis_ebb84f_idx',
+        ),
+        migrations.RemoveField(
+            model_name='playlistsong',
+            name='order',
+        ),
+        migrations.AddIndex(
+            model_name='playlistsong',
+            index=models.Index(fields=['playlist', 'rank'], name='playlists_p_playlis_1b5c0e_idx'),
+        ),
+    ]
@@ -1,10 +1,13 @@
 import uuid
 
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth import get_user_model
-from django.db.models import F
 
 from songs.models import Song
+from vibly.img import ImageStatus, remove_image
+from .managers import PlaylistManager, PlaylistSongManager
 
 
 class Playlist(models.Model):
@@ -12,34 +15,61 @@ class Playlist(models.Model):
     title = models.CharField(max_length=255)
     author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     cover = models.ImageField(upload_to='playlists/covers/', blank=True, default='defaults/playlists/default.png')
+    cover_status = models.CharField(max_length=16, choices=ImageStatus.choices, default=ImageStatus.READY,
+                                    editable=False)
+    cover_job = models.UUIDField(blank=True, null=True, editable=False)
+    cover_staged = models.CharField(max_length=255, blank=True, editable=False)
     description = models.TextField(max_length=500, blank=True, null=True)
     public = models.BooleanField(default=False)
     created_at = models.DateField(auto_now_add=True, editable=False)
 
+    objects = PlaylistManager()
+
+    class Meta:
+        indexes = [
+            # listings, newest first
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['author', 'created_at', 'id']),
+        ]
+
     def __str__(self):
         return f'{self.title} ({self.pk})'
 
-    def delete(self, using=None, keep_parents=False):
-        if self.cover.name != self.cover.field.default:
-            self.cover.delete()
-        return super().delete(using, keep_parents)
+
+@receiver(post_delete, sender=Playlist)
+def release_playlist_cover(sender, instance, **kwargs):
+    # also runs for QuerySet.delete() and cascades, which skip Model.delete()
+    if instance.cover.name != instance.cover.field.default:
+        remove_image(instance.cover.name)
 
 
 class PlaylistSong(models.Model):
     playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE, related_name='playlist_songs', editable=False)
     song = models.ForeignKey(Song, on_delete=models.CASCADE, editable=False)
-    order = models.IntegerField(default=0)
+    # sparse, only the order of ranks matters, see PlaylistSongManager
+    rank = models.BigIntegerField(default=0, editable=False)
+
+    objects = PlaylistSongManager()
+
+    # set by the queries that load tracks by position
+    _order = None
 
     class Meta:
-        ordering = ['order']
+        ordering = ['rank', 'id']
+        indexes = [
+            models.Index(fields=['playlist', 'rank']),
+        ]
 
     def __str__(self):
-        return f'{self.playlist.title} - {self.song.title} - {self.order}'
+        return f'{self.playlist.title} - {self.song.title} - {self.rank}'
 
-    def delete(self, *args, **kwargs):
-        if hasattr(self.playlist, 'playlist_songs'):
-            playlist_songs = self.playlist.playlist_songs.all()
-            playlist_songs_gte_order = playlist_songs.filter(order__gte=self.order)
-            playlist_songs_gte_order.update(order=F('order') - 1)
+    @property
+    def order(self):
+        # 1-based position in the playlist
+        if self._order is None:
+            self._order = PlaylistSong.objects.filter(playlist_id=self.playlist_id).before(self).count() + 1
+        return self._order
 
-        super().delete(*args, **kwargs)
+    @order.setter
+    def order(self, order):
+        self._order = order
@@ -0,0 +1,16 @@
+from vibly.pagination import TrackPagination
+
+
+class PlaylistTrackPagination(TrackPagination):
+    # Tracks are ordered by their sparse ranks, their order is counted: the tracks before the page plus the
+    # position on the page
+    ordering = ('rank', 'id')
+
+    def get_page(self, queryset, page_size=None, position=None):
+        page = super().get_page(queryset, page_size, position)
+
+        offset = queryset.before(page[0]).count() if page and position is not None else 0
+        for order, playlist_song in enumerate(page, offset + 1):
+            playlist_song.order = order
+
+        return page
@@ -1,11 +1,16 @@
+from django.db import transaction
 from rest_framework import serializers
-from django.db.models import F, Max
 
+from .managers import RANK_GAP
 from .models import Playlist, PlaylistSong
 from users.serializers import UserSerializer
-from songs.models import Song
-from songs.serializers import SongSerializer
-from vibly.img import reshape_and_return_url, delete_image
+from songs.serializers import SongPublicIdField, SongSerializer, load_songs
+from vibly.img import schedule_reshape, get_variant_urls
+from vibly.pagination import PaginatedRelationField
+from .pagination import PlaylistTrackPagination
+
+# tracks per INSERT, SQLite limits the number of parameters of a statement
+BULK_CREATE_BATCH_SIZE = 250
 
 
 class PlaylistSongSerializer(serializers.ModelSerializer):
@@ -26,88 +31,64 @@ class PlaylistSongSerializer(serializers.ModelSerializer):
         return song_pk
 
     def save(self, **kwargs):
-        order = self.validated_data.get('order')
-
         playlist = self.context.get('playlist')
-        self.validated_data['playlist'] = playlist
 
         if playlist is None:
             raise Exception('You must include playlist in context')
 
-        playlist_songs = playlist.playlist_songs.all()
-        max_order = (playlist_songs.aggregate(Max('order'))['order__max'] or 0) + 1
-
-        if order is None:
-            order = self.instance.order if self.instance is not None else max_order
-        else:
-            # clamp between 1 and max_order
-            order = max(min(order, max_order), 1)
-
-        self.validated_data['order'] = order
         self.validated_data['playlist'] = playlist
 
-        return super().save(**kwargs)
-
-    def create(self, validated_data):
-        order = validated_data.get('order')
-        playlist = validated_data.get('playlist')
-
-        playlist_songs = playlist.playlist_songs.all()
-
-        if PlaylistSong.objects.filter(playlist=playlist, order=order).exists():
-            songs_gte_order = playlist_songs.filter(order__gte=order)
-            songs_gte_order.update(order=F('order') + 1)
+        # only this row is written, the other tracks keep their ranks. The rank is read and saved under the
+        # playlist's lock, a rebalance or reorder committing in between would put the track elsewhere
+        order = self.validated_data.pop('order', None)
+        with transaction.atomic():
+            if self.instance is None or order is not None:
+                self.validated_data['rank'] = PlaylistSong.objects.get_rank(playlist, order, exclude=self.instance)
 
-        return super().create(validated_data)
+            return super().save(**kwargs)
 
     def update(self, instance, validated_data):
-        order = validated_data.get('order')
-        playlist = validated_data.get('playlist')
+        instance = super().update(instance, validated_data)
+        # moved, its position is counted again
+        instance.order = None
+        return instance
 
-        playlist_songs = playlist.playlist_songs.all()
 
-        if PlaylistSong.objects.filter(playlist=playlist, order=order).exists():
-            if instance.order < order:
-                songs_query = playlist_songs.filter(order__lte=order, order__gt=instance.order)
-                songs_query.update(order=F('order') - 1)
-            elif instance.order > order:
-                songs_query = playlist_songs.filter(order__gte=order, order__lt=instance.order)
-                songs_query.update(order=F('order') + 1)
-
-        return super().update(instance, validated_data)
+class CreatePlaylistSongListSerializer(serializers.ListSerializer):
+    # Adds any number of tracks with a constant number of queries: the songs are read at once,
+    # the tracks are appended after the last one and inserted together
 
+    def to_internal_value(self, data):
+        self.songs = load_songs(data, 'song_pk', self.child.fields['song'])
+        try:
+            return super().to_internal_value(data)
+        finally:
+            del self.songs
 
-class CreatePlaylistSongListSerializer(serializers.ListSerializer):
-    def is_valid(self, raise_exception=False):
-        errors = []
-        for data in self.initial_data:
-            serializer = self.child.__class__(data=data, context=self.context)
-            serializer.is_valid(raise_exception=False)
-            if serializer.errors:
-                errors.append(serializer.errors)
+    def create(self, validated_data):
+        playlist = self.context.get('playlist')
 
-        if errors:
-            raise serializers.ValidationError(errors)
+        if playlist is None:
+            raise Exception('You must include playlist in context')
 
-        return super().is_valid(raise_exception)
+        with transaction.atomic():
+            rank = PlaylistSong.objects.get_rank(playlist)
+            count = playlist.playlist_songs.count()
 
-    def save(self, **kwargs):
-        result = []
-        for data in self.validated_data:
-            new_data = {'song_pk': data.get('song').public_id}
+            playlist_songs = PlaylistSong.objects.bulk_create(
+                [PlaylistSong(playlist=playlist, song=item['song'], rank=rank + index * RANK_GAP)
+                 for index, item in enumerate(validated_data)],
+                batch_size=BULK_CREATE_BATCH_SIZE
+            )
 
-            serializer = self.child.__class__(data=new_data, context=self.context)
-            serializer.is_valid(raise_exception=True)
-            serializer.save(**kwargs)
-            result.append(serializer.instance)
+        for order, playlist_song in enumerate(playlist_songs, count + 1):
+            playlist_song.order = order
 
-        return result
+        return playlist_songs
 
 
 class CreatePlaylistSongSerializer(PlaylistSongSerializer):
-    song_pk = serializers.SlugRelatedField(
-        queryset=Song.objects.all(), source='song', write_only=True, slug_field='public_id'
-    )
+    song_pk = SongPublicIdField(source='song', write_only=True)
 
     class Meta(PlaylistSongSerializer.Meta):
         list_serializer_class = CreatePlaylistSongListSerializer
@@ -115,31 +96,39 @@ class CreatePlaylistSongSerializer(PlaylistSongSerializer):
 
 
 class PlaylistSerializer(serializers.ModelSerializer):
-    playlist_songs = PlaylistSongSerializer(many=True, required=False, read_only=True)
+    # the first page, the following ones are listed by /playlist/<public_id>/order/
+    playlist_songs = PaginatedRelationField(PlaylistSongSerializer(),
+                                            lambda playlist: f'/playlist/{playlist.public_id}/order/',
+                                            pagination_class=PlaylistTrackPagination)
     author = UserSerializer(read_only=True)
+    cover_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Playlist
-        fields = ['public_id', 'title', 'author', 'playlist_songs', 'cover', 'description', 'public', 'created_at']
+        fields = ['public_id', 'title', 'author', 'playlist_songs', 'cover', 'cover_variants', 'cover_status',
+                  'description', 'public', 'created_at']
 
     def save(self, **kwargs):
         self.validated_data['author'] = self.context.get('request').user
 
         cover = self.validated_data.pop('cover', None)
 
-        if cover:
-            if self.instance:
-                delete_image(self.instance.cover)
+        self.instance = self.instance or Playlist.objects.create(**self.validated_data)
 
-            self.validated_data['cover'] = reshape_and_return_url(cover,
-                                                                  cover.name,
-                                                                  self.Meta.model.cover.field.upload_to,
-                                                                  height=512,
-                                                                  width=512)
+        if cover:
+            schedule_reshape(self.instance, 'cover', cover, height=512, width=512)
 
-        self.instance = self.instance or Playlist.objects.create(**self.validated_data)
         return self.instance
 
+    def get_cover_variants(self, instance):
+        return get_variant_urls(instance.cover, self.context.get('request'))
+
+
+class PlaylistListSerializer(PlaylistSerializer):
+    # listings leave the tracks out, they would take a query per playlist
+    class Meta(PlaylistSerializer.Meta):
+        fields = [field for field in PlaylistSerializer.Meta.fields if field != 'playlist_songs']
+
 
 class CreatePlaylistSerializer(PlaylistSerializer):
     playlist_songs = CreatePlaylistSongSerializer(many=True, required=False)
@@ -149,12 +138,12 @@ class CreatePlaylistSerializer(PlaylistSerializer):
         super().save(**kwargs)
 
         self.context['playlist'] = self.instance
-        if playlist_songs is not None:
-            for playlist_song in playlist_songs:
-                playlist_song['song_pk'] = playlist_song.pop('song').public_id
-
-            serializer = CreatePlaylistSongSerializer(data=playlist_songs, context=self.context, many=True)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
+        if playlist_songs:
+            # validated with the playlist already
+            self.fields['playlist_songs'].create(playlist_songs)
 
         return self.instance
+
+    def to_representation(self, instance):
+        # like retrieving it, with the first page of tracks
+        return PlaylistSerializer(instance, context=self.context).data
@@ -1,12 +1,21 @@
 import json
+import os
 import random
 from pprint import pprint
+from unittest import mock
 
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from albums.models import Album, AlbumPosition
+from blobs.models import Blob
 from songs.models import Song
 from users.tests import UserCreate
+from vibly.pagination import TrackPagination
+from .managers import PlaylistSongManager
 from .models import Playlist, PlaylistSong
 
 from songs.tests import SongCreate
@@ -40,9 +49,10 @@ class PlaylistCreate:
 
         response = client.post(f'/playlist/{playlist.public_id}/order/', data, HTTP_AUTHORIZATION='Bearer ' + token)
 
-        return PlaylistSong.objects.filter(playlist=playlist, order=response.data.get('order')).first()
+        return PlaylistSong.objects.filter(playlist=playlist).at(response.data.get('order'))
 
 
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class PlaylistTests(APITestCase):
     def setUp(self):
         user_dict = UserCreate.create_user_dict(self.client)
@@ -87,6 +97,47 @@ class PlaylistTests(APITestCase):
         self.assertTrue(playlist.public)
         self.assertEqual(playlist.cover.url, f'/{response.data.get("cover").split("/", 3)[-1]}')
 
+    def test_copy_playlist(self):
+        with open('testfiles/armstrong.jpg', 'rb') as cover:
+            response = self.client.post('/playlist/', {'title': 'test playlist', 'public': True, 'cover': cover},
+                                        HTTP_AUTHORIZATION='Bearer ' + self.token)
+        playlist = Playlist.objects.get(public_id=response.data.get('public_id'))
+
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(3)]
+        songs.insert(1, SongCreate.create_song_row(self.user, public=False))
+        songs.append(songs[0])
+        for song in songs:
+            rank = PlaylistSong.objects.get_rank(playlist)
+            PlaylistSong.objects.create(playlist=playlist, song=song, rank=rank)
+
+        other = UserCreate.create_user_dict(self.client)
+        response = self.client.post(f'/playlist/{playlist.public_id}/copy/',
+                                    HTTP_AUTHORIZATION=f'Bearer {other.get("token")}')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        copy = Playlist.objects.get(public_id=response.data.get('public_id'))
+        self.assertEqual(copy.author, other.get('user'))
+        self.assertEqual(copy.title, playlist.title)
+        self.assertFalse(copy.public)
+
+        # private songs are left out
+        self.assertEqual([playlist_song.song for playlist_song in copy.playlist_songs.all()],
+                         [songs[0], songs[2], songs[3], songs[0]])
+        self.assertEqual([item['order'] for item in response.data['playlist_songs']['results']], [1, 2, 3, 4])
+
+        # the cover is shared and stays until both playlists are deleted
+        self.assertEqual(copy.cover.name, playlist.cover.name)
+        self.assertEqual(Blob.objects.get(name=playlist.cover.name).refcount, 2)
+        playlist.delete()
+        self.assertTrue(os.path.isfile(copy.cover.path))
+        copy.delete()
+        self.assertFalse(Blob.objects.exists())
+
+        playlist = self.create_playlist(public=False)
+        response = self.client.post(f'/playlist/{playlist.public_id}/copy/',
+                                    HTTP_AUTHORIZATION=f'Bearer {other.get("token")}')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_create_playlist_song(self):
         songs = [self.create_song() for i in range(3)]
 
@@ -162,6 +213,64 @@ class PlaylistTests(APITestCase):
         self.assertEqual(playlist.author, self.user)
         self.assertTrue(playlist.public)
 
+    def test_retrieve_playlist_queries(self):
+        playlist = self.create_playlist()
+        album = Album.objects.create(title='test album', author=self.user, public=True)
+
+        def add_songs(count):
+            for i in range(count):
+                song = SongCreate.create_song_row(self.user, title=f'Song number {i}')
+                # songs of an album show its cover
+                if i % 2:
+                    AlbumPosition.objects.create(album=album, song=song, order=song.pk)
+                rank = PlaylistSong.objects.get_rank(playlist)
+                PlaylistSong.objects.create(playlist=playlist, song=song, rank=rank)
+
+        def retrieve():
+            response = self.client.get(f'/playlist/{playlist.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response
+
+        add_songs(2)
+        with CaptureQueriesContext(connection) as queries:
+            retrieve()
+
+        add_songs(20)
+        with self.assertNumQueries(len(queries)):
+            response = retrieve()
+
+        playlist_songs = response.data['playlist_songs']['results']
+        self.assertEqual(len(playlist_songs), 22)
+        self.assertEqual(len(playlist_songs[-1]['song']['renditions']), 1)
+        self.assertTrue(playlist_songs[-1]['song']['cover'].endswith(album.cover.url))
+
+    def test_list_playlist_songs(self):
+        playlist = self.create_playlist(public=False)
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(5)]
+        for order, song in enumerate(reversed(songs), 1):
+            PlaylistSong.objects.create(playlist=playlist, song=song, rank=order)
+
+        # the playlist shows the first page, the tracks list continues after it
+        with mock.patch.object(TrackPagination, 'page_size', 2):
+            response = self.client.get(f'/playlist/{playlist.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        orders = [playlist_song['order'] for playlist_song in response.data['playlist_songs']['results']]
+        self.assertEqual(orders, [1, 2])
+
+        url = response.data['playlist_songs']['next']
+        self.assertTrue(url.startswith(f'http://testserver/playlist/{playlist.public_id}/order/?cursor='))
+        while url:
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            orders += [playlist_song['order'] for playlist_song in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(orders, [1, 2, 3, 4, 5])
+
+        response = self.client.get(f'/playlist/{playlist.public_id}/order/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_delete_playlist(self):
         playlist = self.create_playlist()
 
@@ -174,6 +283,7 @@ class PlaylistTests(APITestCase):
         self.assertEqual(PlaylistSong.objects.count(), 0)
 
 
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class PlaylistSongTest(APITestCase):
     def setUp(self):
         user_dict = UserCreate.create_user_dict(self.client)
@@ -220,13 +330,60 @@ class PlaylistSongTest(APITestCase):
 
             self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
-        playlist_songs = PlaylistSong.objects.filter(playlist=playlist).order_by('order')
+        playlist_songs = PlaylistSong.objects.filter(playlist=playlist)
         self.assertEqual(playlist_songs.count(), len(songs))
 
         sorted_songs = [song for order, song in sorted(zip(sorted_order, songs))]
         for playlist_song, song in zip(playlist_songs, sorted_songs):
             self.assertEqual(playlist_song.song, song)
 
+    def test_insert_playlist_song_writes_one_row(self):
+        playlist = self.create_playlist()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(30)]
+
+        for song in songs[:5]:
+            PlaylistSong.objects.create(playlist=playlist, song=song, rank=PlaylistSong.objects.get_rank(playlist))
+
+        # the gap at the second position is halved by every insert, until the playlist is rebalanced
+        for song in songs[5:]:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(f'/playlist/{playlist.public_id}/order/',
+                                            {'song_pk': song.public_id, 'order': 2},
+                                            HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(response.data['order'], 2)
+
+            writes = [query['sql'] for query in queries.captured_queries
+                      if query['sql'].startswith(('INSERT', 'UPDATE'))]
+            if len(writes) > 1:
+                self.assertEqual(len(writes), 2, writes)
+                self.assertTrue(writes[0].startswith('UPDATE'), writes)
+            self.assertTrue(writes[-1].startswith('INSERT'), writes)
+
+        expected = [songs[0]] + songs[:4:-1] + songs[1:5]
+        self.assertEqual([playlist_song.song for playlist_song in playlist.playlist_songs.all()], expected)
+        self.assertEqual([playlist_song.order for playlist_song in playlist.playlist_songs.all()],
+                         list(range(1, len(songs) + 1)))
+
+    def test_rank_writes_lock_playlist(self):
+        playlist = self.create_playlist()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(2)]
+        url = f'/playlist/{playlist.public_id}/order/'
+
+        with mock.patch.object(PlaylistSongManager, 'lock', autospec=True) as lock:
+            self.client.post(url, {'song_pk': songs[0].public_id}, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.client.post(url, [{'song_pk': songs[1].public_id}], HTTP_AUTHORIZATION=f'Bearer {self.token}',
+                             format='json')
+            PlaylistSong.objects.rebalance(playlist.pk)
+            self.client.put(url, {'songs': [str(song.public_id) for song in songs],
+                                  'version': PlaylistSong.objects.get_version(playlist)},
+                            HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+            self.client.delete(url, {'orders': [1]}, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+
+        self.assertEqual([call.args[1] for call in lock.call_args_list], [playlist.pk] * 5)
+        self.assertEqual(playlist.playlist_songs.count(), 1)
+
     def test_update_playlist_song_to_left(self):
         playlist = self.create_playlist()
 
@@ -245,7 +402,7 @@ class PlaylistSongTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        playlist_songs = playlist.playlist_songs.all().order_by('order')
+        playlist_songs = playlist.playlist_songs.all()
 
         for preferred_order, playlist_song in enumerate(playlist_songs, start=1):
             playlist_song = playlist_songs.filter(song=playlist_song.song).first()
@@ -271,7 +428,7 @@ class PlaylistSongTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        playlist_songs = playlist.playlist_songs.all().order_by('order')
+        playlist_songs = playlist.playlist_songs.all()
 
         for preferred_order, playlist_song in enumerate(playlist_songs, start=1):
             playlist_song = playlist_songs.filter(song=playlist_song.song).first()
@@ -279,6 +436,106 @@ class PlaylistSongTest(APITestCase):
             self.assertIsNotNone(playlist_song)
             self.assertEqual(playlist_song.order, preferred_order)
 
+    def test_create_playlist_songs_in_bulk(self):
+        playlist = self.create_playlist()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(33)]
+        url = f'/playlist/{playlist.public_id}/order/'
+
+        def add_songs(songs):
+            data = [{'song_pk': str(song.public_id)} for song in songs]
+            response = self.client.post(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return response
+
+        with CaptureQueriesContext(connection) as queries:
+            response = add_songs(songs[:3])
+        self.assertEqual([playlist_song['order'] for playlist_song in response.data], [1, 2, 3])
+
+        with self.assertNumQueries(len(queries)):
+            response = add_songs(songs[3:])
+        self.assertEqual([playlist_song['order'] for playlist_song in response.data], list(range(4, 34)))
+        self.assertEqual([playlist_song['song']['public_id'] for playlist_song in response.data],
+                         [str(song.public_id) for song in songs[3:]])
+
+        self.assertEqual([playlist_song.song for playlist_song in playlist.playlist_songs.all()], songs)
+
+        # nothing is added unless every item is valid
+        private = SongCreate.create_song_row(self.user, public=False)
+        data = [{'song_pk': str(songs[0].public_id)}, {'song_pk': str(private.public_id)}, {'song_pk': 'bogus'}]
+        response = self.client.post(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('song_pk', response.data[1])
+        self.assertIn('song_pk', response.data[2])
+        self.assertEqual(playlist.playlist_songs.count(), len(songs))
+
+    def test_reorder_playlist_songs(self):
+        playlist = self.create_playlist()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(3)]
+        # a song can be in a playlist more than once
+        songs.append(songs[0])
+        tracks = []
+        for song in songs:
+            rank = PlaylistSong.objects.get_rank(playlist)
+            tracks.append(PlaylistSong.objects.create(playlist=playlist, song=song, rank=rank))
+
+        url = f'/playlist/{playlist.public_id}/order/'
+        response = self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        version = response['ETag'].strip('"')
+
+        data = {'songs': [str(song.public_id) for song in [songs[2], songs[0], songs[1], songs[0]]], 'version': version}
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['version'], version)
+
+        # tracks of the same song keep their order
+        self.assertEqual(list(playlist.playlist_songs.all()), [tracks[2], tracks[0], tracks[1], tracks[3]])
+
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        version = response.data['version']
+
+        # the version can be sent as If-Match as well
+        data = {'songs': [str(song.public_id) for song in songs[:3]]}
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', HTTP_IF_MATCH=f'"{version}"',
+                                   format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        data['songs'].append(str(songs[0].public_id))
+        response = self.client.put(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', HTTP_IF_MATCH=f'"{version}"',
+                                   format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], f'"{response.data["version"]}"')
+        self.assertEqual(list(playlist.playlist_songs.all()), tracks)
+
+    def test_remove_playlist_songs(self):
+        playlist = self.create_playlist()
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(6)]
+        songs.append(songs[0])
+        tracks = []
+        for song in songs:
+            rank = PlaylistSong.objects.get_rank(playlist)
+            tracks.append(PlaylistSong.objects.create(playlist=playlist, song=song, rank=rank))
+
+        url = f'/playlist/{playlist.public_id}/order/'
+        response = self.client.delete(url, {'start': 3, 'end': 2}, HTTP_AUTHORIZATION=f'Bearer {self.token}',
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # every track of a song, a range and single positions at once
+        data = {'songs': [str(songs[0].public_id)], 'start': 3, 'end': 4, 'orders': [6]}
+        response = self.client.delete(url, data, HTTP_AUTHORIZATION=f'Bearer {self.token}', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['removed'], 5)
+
+        self.assertEqual(list(playlist.playlist_songs.all()), [tracks[1], tracks[4]])
+        self.assertEqual(PlaylistSong.objects.filter(playlist=playlist).at(2), tracks[4])
+
+        other = UserCreate.create_user_dict(self.client)
+        response = self.client.delete(url, {'orders': [1]}, HTTP_AUTHORIZATION=f'Bearer {other.get("token")}',
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_update_song_pk(self):
         playlist = self.create_playlist()
         playlist_song = self.create_playlist_song(playlist=playlist)
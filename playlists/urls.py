@@ -3,10 +3,14 @@ from django.urls import path
 from .views import PlaylistsViewSet, PlaylistSongsViewSet
 
 urlpatterns = [
-    path('', PlaylistsViewSet.as_view({'post': 'create'})),
+    path('', PlaylistsViewSet.as_view({'get': 'list', 'post': 'create'})),
     path('<uuid:public_id>/',
          PlaylistsViewSet.as_view({'get': 'retrieve', 'patch': 'partial_update', 'delete': 'destroy'})),
-    path('<uuid:public_id>/order/', PlaylistSongsViewSet.as_view({'post': 'create'})),
+    path('<uuid:public_id>/copy/', PlaylistsViewSet.as_view({'post': 'copy'})),
+    path('<uuid:public_id>/order/', PlaylistSongsViewSet.as_view({'get': 'list',
+                                                                  'post': 'create',
+                                                                  'put': 'reorder',
+                                                                  'delete': 'bulk_destroy'})),
     path('<uuid:public_id>/order/<int:playlist_song_order>/', PlaylistSongsViewSet.as_view({'patch': 'partial_update',
                                                                                             'delete': 'destroy'}))
 ]
@@ -1,18 +1,25 @@
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 
 from .models import Playlist, PlaylistSong
+from .pagination import PlaylistTrackPagination
 from .serializers import PlaylistSerializer, \
+    PlaylistListSerializer, \
     CreatePlaylistSerializer, \
     PlaylistSongSerializer, \
     CreatePlaylistSongSerializer
+from vibly.filters import VisibleListFilter
+from vibly.mixins import EagerLoadingMixin, eager_load
+from vibly.ordering import RemoveTracksSerializer, ReorderSerializer, StaleOrder
 
 
-class PlaylistsViewSet(viewsets.ModelViewSet):
+class PlaylistsViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     lookup_field = 'public_id'
     queryset = Playlist.objects.all()
+    filter_backends = [VisibleListFilter]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -49,13 +56,27 @@ class PlaylistsViewSet(viewsets.ModelViewSet):
         self.perform_destroy(playlist)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def copy(self, request, *args, **kwargs):
+        playlist = self.get_object()
+
+        if playlist.author != request.user and not playlist.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        # only public songs can be added to a playlist
+        copy = Playlist.objects.copy(playlist, request.user, playlist.playlist_songs.filter(song__public=True),
+                                     ('rank', 'id'))
+        serializer = self.get_serializer(copy)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     def get_serializer_class(self):
         if self.action == 'create':
             return CreatePlaylistSerializer
+        if self.action == 'list':
+            return PlaylistListSerializer
         return PlaylistSerializer
 
     def get_permissions(self):
-        if self.action == 'create' or self.action == 'partial_update':
+        if self.action in ('create', 'partial_update', 'copy'):
             permission_classes = [IsAuthenticated]
         else:
             permission_classes = [AllowAny]
@@ -66,7 +87,55 @@ class PlaylistSongsViewSet(viewsets.ModelViewSet):
     multiple_lookup_fields = {'playlist': 'public_id', 'playlist_song': 'playlist_song_order'}
     playlist_queryset = Playlist.objects.all()
     playlist_song_queryset = PlaylistSong.objects.all()
-    permission_classes = [IsAuthenticated]
+    pagination_class = PlaylistTrackPagination
+
+    def list(self, request, *args, **kwargs):
+        playlist = self.get_playlist()
+
+        if playlist.author != request.user and not playlist.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        page = self.paginate_queryset(eager_load(playlist.playlist_songs.all(), self.get_serializer()))
+        serializer = self.get_serializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+
+        # the version reorder expects, it reads every track so only the first page has it
+        if self.paginator.cursor_query_param not in request.query_params:
+            response['ETag'] = f'"{PlaylistSong.objects.get_version(playlist)}"'
+
+        return response
+
+    def reorder(self, request, *args, **kwargs):
+        playlist = self.get_playlist()
+
+        if playlist.author != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        version = serializer.validated_data.get('version') or request.headers.get('If-Match', '').strip('"')
+
+        try:
+            version = PlaylistSong.objects.reorder(playlist, serializer.validated_data['songs'], version)
+        except StaleOrder as e:
+            return Response({'detail': 'The tracks changed since they were read', 'version': e.version},
+                            status=status.HTTP_412_PRECONDITION_FAILED,
+                            headers={'ETag': f'"{e.version}"'})
+        except ValueError as e:
+            return Response({'songs': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'version': version}, headers={'ETag': f'"{version}"'})
+
+    def bulk_destroy(self, request, *args, **kwargs):
+        playlist = self.get_playlist()
+
+        if playlist.author != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        removed = PlaylistSong.objects.remove(playlist, **serializer.validated_data)
+        return Response({'removed': removed})
 
     def create(self, request, *args, **kwargs):
         playlist = self.get_playlist()
@@ -74,7 +143,9 @@ class PlaylistSongsViewSet(viewsets.ModelViewSet):
         if playlist.author != request.user:
             return Response(status=status.HTTP_403_FORBIDDEN)
 
+        # a list of tracks is added at once
         serializer = self.get_serializer(data=request.data,
+                                         many=isinstance(request.data, list),
                                          context=self.get_serializer_context() | {'playlist': playlist})
         serializer.is_valid(raise_exception=True)
         self.perform_create(serializer)
@@ -109,8 +180,19 @@ class PlaylistSongsViewSet(viewsets.ModelViewSet):
     def get_serializer_class(self):
         if self.action == 'create':
             return CreatePlaylistSongSerializer
+        if self.action == 'reorder':
+            return ReorderSerializer
+        if self.action == 'bulk_destroy':
+            return RemoveTracksSerializer
         return PlaylistSongSerializer
 
+    def get_permissions(self):
+        if self.action == 'list':
+            permission_classes = [AllowAny]
+        else:
+            permission_classes = [IsAuthenticated]
+        return [permission() for permission in permission_classes]
+
     def get_playlist(self):
         playlist_pk_url = self.multiple_lookup_fields.get('playlist')
         playlist_pk = self.kwargs.get(playlist_pk_url)
@@ -121,8 +203,9 @@ class PlaylistSongsViewSet(viewsets.ModelViewSet):
     def get_playlist_song(self):
         playlist_song_pk_url = self.multiple_lookup_fields.get('playlist_song')
         playlist_song_pk = self.kwargs.get(playlist_song_pk_url)
-        playlist_song = get_object_or_404(self.playlist_song_queryset,
-                                          order=playlist_song_pk,
-                                          playlist=self.get_playlist())
+        try:
+            playlist_song = self.playlist_song_queryset.filter(playlist=self.get_playlist()).at(playlist_song_pk)
+        except PlaylistSong.DoesNotExist:
+            raise Http404
         self.check_object_permissions(self.request, playlist_song)
         return playlist_song
@@ -0,0 +1,52 @@
+import io
+import logging
+
+from PIL import Image, UnidentifiedImageError
+
+from vibly.img import ImageTooLarge, reshape_and_return_url, remove_image
+from .models import Song
+from .probe import ProbeError, get_picture, probe_audio
+
+logger = logging.getLogger(__name__)
+
+COVER_SIZE = 512
+
+
+def read_picture(song):
+    with song.song_file.open('rb') as file:
+        return get_picture(probe_audio(file).audio)
+
+
+def attach_embedded_cover(song_id, picture=None):
+    # Turns the embedded picture into the cover of a song that has none. picture is read while the upload
+    # is probed, None reads it from the stored file (content that was already stored isn't parsed on upload)
+    song = Song.objects.filter(pk=song_id).first()
+    if song is None or song.cover.name != song.cover.field.default:
+        return
+
+    if picture is None:
+        try:
+            picture = read_picture(song)
+        except ProbeError as e:
+            logger.info('Skipping embedded cover of song %s: %s', song_id, e)
+            return
+
+    if not picture:
+        return
+
+    try:
+        with Image.open(io.BytesIO(picture)) as pil_img:
+            extension = pil_img.format.lower()
+
+        cover = reshape_and_return_url(io.BytesIO(picture),
+                                       f'{song.file_stem}.{extension}',
+                                       Song.cover.field.upload_to,
+                                       height=COVER_SIZE,
+                                       width=COVER_SIZE)
+    except (UnidentifiedImageError, Image.DecompressionBombError, ImageTooLarge, OSError) as e:
+        logger.info('Skipping embedded cover of song %s: %s', song_id, e)
+        return
+
+    # a cover uploaded in the meantime wins
+    if not Song.objects.filter(pk=song_id, cover=song.cover.field.default).update(cover=cover):
+        remove_image(cover)
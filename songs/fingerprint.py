@@ -0,0 +1,114 @@
+import logging
+
+import numpy as np
+from django.conf import settings
+
+from .models import FingerprintHash, Song
+from .pcm import decode, DecodeError
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = 1024
+HOP_SIZE = 512
+# frequency bin edges, the strongest bin of every band is a candidate peak
+BANDS = (8, 16, 32, 64, 128, 256, 512)
+# a candidate has to be this many times louder than the frame's median bin
+PEAK_THRESHOLD = 10
+FAN_OUT = 5
+MAX_DELTA = 63
+# multiplier of the hashes limit_hashes keeps, odd so it mixes every bit
+MIX = np.uint64(0x9E3779B1)
+
+
+def spectrogram(samples):
+    if len(samples) < FRAME_SIZE:
+        return np.zeros((0, FRAME_SIZE // 2 + 1), np.float32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples.astype(np.float32), FRAME_SIZE)[::HOP_SIZE]
+    return np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE).astype(np.float32), axis=1))
+
+
+def find_peaks(spectrum):
+    # Returns (frame, bin) pairs sorted by frame
+    floor = np.median(spectrum, axis=1) * PEAK_THRESHOLD
+    peaks = []
+
+    for low, high in zip(BANDS, BANDS[1:]):
+        band = spectrum[:, low:high]
+        bins = band.argmax(axis=1)
+        values = band[np.arange(len(band)), bins]
+
+        frames = np.nonzero(values > floor)[0]
+        peaks.append(np.stack((frames, bins[frames] + low), axis=1))
+
+    peaks = np.concatenate(peaks)
+    return peaks[np.lexsort((peaks[:, 1], peaks[:, 0]))]
+
+
+def hash_peaks(peaks):
+    # Pairs every peak with the next FAN_OUT peaks of its target zone, the frames 1 to MAX_DELTA after its own.
+    # Returns unique (hash, anchor frame) pairs, the hash packs both frequencies (9 bits each) and their distance
+    # in frames (6 bits).
+    frames = peaks[:, 0]
+    # the first peak of a later frame, peaks of the anchor's own frame would all have a distance of 0
+    starts = np.searchsorted(frames, frames + 1)
+    hashes = []
+
+    for index in range(FAN_OUT):
+        targets = starts + index
+        anchors = np.nonzero(targets < len(peaks))[0]
+        targets = targets[anchors]
+
+        delta = frames[targets] - frames[anchors]
+        valid = delta <= MAX_DELTA
+        anchors, targets, delta = anchors[valid], targets[valid], delta[valid]
+
+        values = peaks[anchors, 1] << 15 | peaks[targets, 1] << 6 | delta
+        hashes.append(np.stack((values, frames[anchors]), axis=1))
+
+    if not hashes:
+        return np.zeros((0, 2), np.int64)
+
+    return np.unique(np.concatenate(hashes), axis=0)
+
+
+def limit_hashes(hashes, max_hashes):
+    # Keeps at most max_hashes, those whose values mix to the smallest numbers. Which values these are doesn't
+    # depend on the song, so two encodings of it keep mostly the same hashes and still match.
+    if len(hashes) <= max_hashes:
+        return hashes
+
+    mixed = (hashes[:, 0].astype(np.uint64) * MIX) & np.uint64(0xFFFFFFFF)
+    threshold = np.partition(mixed, max_hashes)[max_hashes]
+    return hashes[mixed < threshold]
+
+
+def fingerprint(samples):
+    return limit_hashes(hash_peaks(find_peaks(spectrogram(samples))), settings.SONG_FINGERPRINT_MAX_HASHES)
+
+
+def build_fingerprint(song):
+    if song.fingerprinted:
+        return
+
+    # the same content was fingerprinted for another song, copy its hashes
+    sibling = None
+    if song.blob_id is not None:
+        sibling = Song.objects.filter(blob=song.blob, fingerprinted=True).exclude(pk=song.pk).first()
+
+    if sibling is not None:
+        hashes = sibling.fingerprint_hashes.values_list('hash', 'offset')
+    else:
+        try:
+            hashes = fingerprint(decode(song, settings.SONG_FINGERPRINT_SAMPLE_RATE)).tolist()
+        except DecodeError as e:
+            logger.info('Skipping fingerprint of song %s: %s', song.pk, e)
+            return
+
+    FingerprintHash.objects.filter(song=song).delete()
+    FingerprintHash.objects.bulk_create([FingerprintHash(song=song, hash=value, offset=offset)
+                                         for value, offset in hashes],
+                                        batch_size=1000)
+
+    song.fingerprinted = True
+    song.save(update_fields=['fingerprinted'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from songs.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Deletes resumable upload sessions older than SONG_UPLOAD_SESSION_MAX_AGE and their staged files'
+
+    def handle(self, *args, **options):
+        deleted, _ = UploadSession.objects.expired().delete()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired upload sessions'))
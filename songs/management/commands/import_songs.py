@@ -0,0 +1,251 @@
+import datetime
+import hashlib
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from PIL import Image, UnidentifiedImageError
+
+from albums.models import Album, AlbumPosition
+from blobs.models import Blob
+from songs.models import Song
+from songs.pipeline import schedule_song_processing
+from songs.probe import ProbeError, get_picture, get_tags, probe_audio
+from vibly.img import ImageTooLarge, has_variants, load_square, save_variants
+
+EXTENSIONS = ('mp3', 'ogg', 'wav')
+COVER_SIZE = 512
+# imported files, one path (relative to the imported directory) per line
+STATE_NAME = '.vibly-import'
+
+
+def resize_cover(data):
+    try:
+        pil_img = load_square(io.BytesIO(data), COVER_SIZE).convert('RGB')
+    except (UnidentifiedImageError, Image.DecompressionBombError, ImageTooLarge, OSError):
+        return None
+
+    buffer = io.BytesIO()
+    pil_img.save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def read_file(path):
+    # Runs in a worker process: hashes and probes one file, reads its tags and resizes the embedded cover
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(File.DEFAULT_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+        try:
+            info = probe_audio(file)
+        except ProbeError as e:
+            return {'path': path, 'error': str(e)}
+
+    tags = get_tags(info.audio)
+    picture = get_picture(info.audio)
+
+    return {
+        'path': path,
+        'sha256': sha256.hexdigest(),
+        'codec': info.codec,
+        'duration': info.duration,
+        'bitrate': info.bitrate,
+        'sample_rate': info.sample_rate,
+        'channels': info.channels,
+        'title': tags.title,
+        'album': tags.album,
+        'track': tags.track,
+        'cover': resize_cover(picture) if picture else None,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Imports a directory of songs, albums are created from the album tags'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--author', required=True, help='Email of the user the songs are imported for')
+        parser.add_argument('--private', action='store_true', help='Import songs and albums as not public')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of probing processes')
+        parser.add_argument('--batch-size', type=int, default=200, help='Number of songs inserted at once')
+        parser.add_argument('--process', action='store_true',
+                            help='Schedule renditions, segments, waveforms... of imported songs, '
+                                 'otherwise run process_songs afterwards')
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['directory'])
+        if not os.path.isdir(directory):
+            raise CommandError(f'{directory} is not a directory')
+
+        self.author = get_user_model().objects.filter(email=options['author']).first()
+        if self.author is None:
+            raise CommandError(f'User {options["author"]} does not exist')
+
+        self.public = not options['private']
+        self.process = options['process']
+        self.albums = {}
+
+        # an interrupted import continues with the files that weren't imported yet
+        state_path = os.path.join(directory, STATE_NAME)
+        done = set()
+        if os.path.exists(state_path):
+            with open(state_path) as state:
+                done = set(state.read().splitlines())
+
+        paths = [path for path in self.find_files(directory) if os.path.relpath(path, directory) not in done]
+        if done:
+            self.stdout.write(f'Skipping {len(done)} already imported files')
+
+        batch_size = options['batch_size']
+        batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+        imported, failed = 0, 0
+
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool, open(state_path, 'a') as state:
+            results = pool.map(read_file, batches[0]) if batches else None
+
+            for index, batch in enumerate(batches):
+                batch_results = list(results)
+                # workers probe the next batch while this one is inserted
+                if index + 1 < len(batches):
+                    results = pool.map(read_file, batches[index + 1])
+
+                songs, errors = self.import_batch(batch_results)
+                imported += len(songs)
+                failed += len(errors)
+
+                for path, error in errors:
+                    self.stderr.write(f'\n{os.path.relpath(path, directory)}: {error}')
+
+                # unsupported files are recorded as well, they would fail again
+                state.write(''.join(f'{os.path.relpath(path, directory)}\n' for path in batch))
+                state.flush()
+                os.fsync(state.fileno())
+
+                self.stdout.write(f'\r{imported + failed}/{len(paths)}', ending='')
+
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f'Imported {imported} songs, {failed} files failed'))
+
+    @staticmethod
+    def find_files(directory):
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if name.split('.')[-1].lower() in EXTENSIONS:
+                    paths.append(os.path.join(root, name))
+        return sorted(paths)
+
+    def import_batch(self, results):
+        errors = [(result['path'], result['error']) for result in results if 'error' in result]
+        results = [result for result in results if 'error' not in result]
+
+        # a failed batch leaves stored files without rows, the blobs are only referenced once it commits
+        with transaction.atomic():
+            self.create_albums(results)
+
+            songs = []
+            for result in results:
+                with open(result['path'], 'rb') as file:
+                    file = File(file, name=os.path.basename(result['path']))
+                    file.sha256 = result['sha256']
+                    blob = Blob.objects.acquire(file, Song.song_file.field.upload_to)
+
+                song = Song(title=result['title'] or os.path.splitext(os.path.basename(result['path']))[0],
+                            author=self.author,
+                            song_file=blob.name,
+                            blob=blob,
+                            duration=datetime.timedelta(seconds=result['duration']),
+                            codec=result['codec'],
+                            bitrate=result['bitrate'],
+                            sample_rate=result['sample_rate'],
+                            channels=result['channels'],
+                            public=self.public)
+
+                # songs of an album show the album cover
+                if not result['album'] and result['cover']:
+                    song.cover = self.save_cover(result, Song.cover.field.upload_to)
+
+                songs.append(song)
+
+            Song.objects.bulk_create(songs)
+
+            # not every database returns primary keys from bulk inserts
+            pks = dict(Song.objects.filter(public_id__in=[song.public_id for song in songs])
+                       .values_list('public_id', 'pk'))
+            for song in songs:
+                song.pk = pks[song.public_id]
+
+            self.create_album_positions(songs, results)
+
+        if self.process:
+            for song in songs:
+                schedule_song_processing(song)
+
+        return songs, errors
+
+    def create_albums(self, results):
+        # the album cover is taken from the first track that has one
+        tracks = {}
+        for result in results:
+            title = result['album']
+            if title and (title not in tracks or result['cover'] and not tracks[title]['cover']):
+                tracks[title] = result
+
+        titles = [title for title in tracks if title not in self.albums]
+        if not titles:
+            return
+
+        for album in Album.objects.filter(author=self.author, title__in=titles):
+            self.albums.setdefault(album.title, album)
+
+        albums = []
+        for title in titles:
+            if title in self.albums:
+                continue
+
+            album = Album(title=title, author=self.author, public=self.public)
+            if tracks[title]['cover']:
+                album.cover = self.save_cover(tracks[title], Album.cover.field.upload_to)
+
+            albums.append(album)
+
+        Album.objects.bulk_create(albums)
+        for album in Album.objects.filter(public_id__in=[album.public_id for album in albums]):
+            self.albums[album.title] = album
+
+    def create_album_positions(self, songs, results):
+        tracks = {}
+        for song, result in zip(songs, results):
+            if result['album']:
+                tracks.setdefault(self.albums[result['album']], []).append((result['track'], result['path'], song))
+
+        max_orders = dict(AlbumPosition.objects.filter(album__in=tracks.keys())
+                          .values('album').annotate(max_order=Max('order')).values_list('album', 'max_order'))
+
+        positions = []
+        for album, album_tracks in tracks.items():
+            # untagged tracks go after the numbered ones, in file name order
+            album_tracks.sort(key=lambda track: (track[0] is None, track[0] or 0, track[1]))
+            order = max_orders.get(album.pk) or 0
+
+            for track, path, song in album_tracks:
+                order += 1
+                positions.append(AlbumPosition(album=album, song=song, order=order))
+
+        AlbumPosition.objects.bulk_create(positions)
+
+    @staticmethod
+    def save_cover(result, upload_to):
+        # every album or song holds its own reference, tracks embedding the same picture share the file
+        name = Blob.objects.acquire(ContentFile(result['cover'], name='cover.jpg'), upload_to).name
+        if not has_variants(name):
+            save_variants(Image.open(io.BytesIO(result['cover'])), name)
+        return name
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from songs.models import Song
+from songs.pipeline import STAGES, process_song
+
+
+class Command(BaseCommand):
+    help = 'Runs song processing stages (renditions, segments, waveforms...) over existing songs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stage', action='append', dest='stages',
+                            help=f'Stage to run, can be repeated. Default: all of {", ".join(STAGES)}')
+        parser.add_argument('--song', action='append', dest='songs', help='public_id of a song, can be repeated')
+
+    def handle(self, *args, **options):
+        stages = options['stages']
+        for stage in stages or []:
+            if stage not in STAGES:
+                raise CommandError(f'Unknown stage {stage}. Available: {", ".join(STAGES)}')
+
+        songs = Song.objects.order_by('pk')
+        if options['songs']:
+            songs = songs.filter(public_id__in=options['songs'])
+
+        # stages skip work that is already done, so an interrupted backfill can simply be run again
+        song_ids = list(songs.values_list('pk', flat=True))
+        for done, song_id in enumerate(song_ids, start=1):
+            process_song(song_id, stages)
+            self.stdout.write(f'\r{done}/{len(song_ids)}', ending='')
+
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(song_ids)} songs'))
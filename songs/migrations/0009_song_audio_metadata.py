@@ -0,0 +1,33 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0008_alter_song_public_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='bitrate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='channels',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='codec',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='sample_rate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
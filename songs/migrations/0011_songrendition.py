@@ -0,0 +1,31 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0010_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongRendition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bitrate', models.PositiveIntegerField()),
+                ('codec', models.CharField(max_length=16)),
+                ('file', models.FileField(upload_to='songs/renditions/')),
+                ('song', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='songs.song')),
+            ],
+            options={
+                'ordering': ['bitrate'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='songrendition',
+            constraint=models.UniqueConstraint(fields=('song', 'codec', 'bitrate'), name='unique_song_rendition'),
+        ),
+    ]
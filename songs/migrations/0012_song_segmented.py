@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0011_songrendition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='segmented',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0012_song_segmented'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='waveform',
+            field=models.FileField(blank=True, editable=False, upload_to='songs/files/'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blobs', '0001_initial'),
+        ('songs', '0013_song_waveform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='songs', to='blobs.blob'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0014_song_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='fingerprinted',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.CreateModel(
+            name='FingerprintHash',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.IntegerField(db_index=True)),
+                ('offset', models.IntegerField()),
+                ('song', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='fingerprint_hashes', to='songs.song')),
+            ],
+        ),
+    ]
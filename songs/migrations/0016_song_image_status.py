@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0015_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='cover_job',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='cover_status',
+            field=models.CharField(choices=[('ready', 'Ready'), ('pending', 'Pending'), ('failed', 'Failed')], default='ready', editable=False, max_length=16),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.4 on 2026-10-18 03:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0016_song_image_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['created_at', 'id'], name='songs_song_created_18744d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='songs_song_author__b79bb3_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 12:00
+
+from django.db import migrations
+
+
+def reset_fingerprints(apps, schema_editor):
+    # hashes now pair peaks across frames and don't match the old ones, process_songs --stage fingerprint
+    # builds them again
+    FingerprintHash = apps.get_model('songs', 'FingerprintHash')
+    Song = apps.get_model('songs', 'Song')
+    FingerprintHash.objects.all().delete()
+    Song.objects.filter(fingerprinted=True).update(fingerprinted=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0017_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 03:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('songs', '0018_rebuild_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='song',
+            name='cover_staged',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
@@ -1,8 +1,17 @@
 import os
 import uuid
+from collections import Counter, defaultdict
 
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from blobs.models import Blob, PendingDeletion
+from vibly.img import ImageStatus, remove_image
+from .segments import get_directory
 
 
 class Song(models.Model):
@@ -10,22 +19,148 @@ class Song(models.Model):
     title = models.CharField(max_length=255)
     author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     song_file = models.FileField(upload_to='songs/files/')
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='songs', blank=True, null=True,
+                             editable=False)
     duration = models.DurationField(blank=True, null=True)
+    codec = models.CharField(max_length=16, blank=True, null=True)
+    bitrate = models.PositiveIntegerField(blank=True, null=True)
+    sample_rate = models.PositiveIntegerField(blank=True, null=True)
+    channels = models.PositiveSmallIntegerField(blank=True, null=True)
     cover = models.ImageField(upload_to='songs/covers/', default='defaults/songs/default.png')
+    cover_status = models.CharField(max_length=16, choices=ImageStatus.choices, default=ImageStatus.READY,
+                                    editable=False)
+    cover_job = models.UUIDField(blank=True, null=True, editable=False)
+    cover_staged = models.CharField(max_length=255, blank=True, editable=False)
     public = models.BooleanField(default=True)
+    segmented = models.BooleanField(default=False, editable=False)
+    waveform = models.FileField(upload_to='songs/files/', blank=True, editable=False)
+    fingerprinted = models.BooleanField(default=False, editable=False)
     created_at = models.DateField(auto_now_add=True, editable=False)
 
+    class Meta:
+        indexes = [
+            # listings, newest first
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['author', 'created_at', 'id']),
+        ]
+
     @property
     def album(self):
         if hasattr(self, 'album_position'):
             return self.album_position.album
         return None
 
-    def delete(self, *args, **kwargs):
-        if os.path.isfile(self.song_file.path):
-            os.remove(self.song_file.path)
+    @property
+    def file_stem(self):
+        # derived media (renditions, segments, waveform) is named after the song file,
+        # so songs sharing a blob share it as well
+        return os.path.splitext(os.path.basename(self.song_file.name))[0]
+
+    def find_duplicates(self, min_matches=None):
+        """
+        Returns [(song, score)] of songs that sound like this one, best match first. The score is the number of
+        fingerprint hashes matching at one time offset, so re-encodes score high and shared samples don't.
+        """
+        min_matches = min_matches or settings.SONG_FINGERPRINT_MIN_MATCHES
+
+        offsets = defaultdict(list)
+        for value, offset in self.fingerprint_hashes.values_list('hash', 'offset'):
+            offsets[value].append(offset)
+
+        if not offsets:
+            return []
+
+        # the hash index only touches rows sharing a hash with this song, not the whole catalogue
+        matches = FingerprintHash.objects.filter(hash__in=self.fingerprint_hashes.values('hash')) \
+            .exclude(song=self) \
+            .values_list('song_id', 'hash', 'offset')
+
+        alignments = Counter()
+        for song_id, value, offset in matches.iterator():
+            for own_offset in offsets[value]:
+                alignments[(song_id, offset - own_offset)] += 1
+
+        scores = {}
+        for (song_id, delta), count in alignments.items():
+            scores[song_id] = max(scores.get(song_id, 0), count)
+
+        scores = {song_id: score for song_id, score in scores.items() if score >= min_matches}
+        songs = Song.objects.in_bulk(scores.keys())
+        return sorted(((songs[song_id], score) for song_id, score in scores.items()), key=lambda match: -match[1])
+
+
+class SongRendition(models.Model):
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name='renditions', editable=False)
+    bitrate = models.PositiveIntegerField()
+    codec = models.CharField(max_length=16)
+    file = models.FileField(upload_to='songs/renditions/')
+
+    class Meta:
+        ordering = ['bitrate']
+        constraints = [
+            models.UniqueConstraint(fields=['song', 'codec', 'bitrate'], name='unique_song_rendition'),
+        ]
+
+    def __str__(self):
+        return f'{self.song.title} - {self.codec} {self.bitrate}k'
+
+
+class FingerprintHash(models.Model):
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name='fingerprint_hashes', editable=False)
+    hash = models.IntegerField(db_index=True)
+    offset = models.IntegerField()
+
+
+# Files are released by post_delete receivers, QuerySet.delete() and cascades skip Model.delete().
+# They're deleted once the transaction commits.
+@receiver(post_delete, sender=Song)
+def release_song_files(sender, instance, **kwargs):
+    if instance.cover.name != instance.cover.field.default:
+        remove_image(instance.cover.name)
+
+    if instance.blob_id is not None:
+        # the file and derived media stay until the last song referencing the blob is gone
+        if not Blob.objects.release(instance.blob):
+            return
+    else:
+        PendingDeletion.objects.enqueue([instance.song_file.name])
+
+    PendingDeletion.objects.enqueue([instance.waveform.name,
+                                     f'{get_directory(instance)}/' if instance.segmented else None])
+
+
+@receiver(post_delete, sender=SongRendition)
+def release_rendition_file(sender, instance, **kwargs):
+    # songs sharing a blob share their renditions
+    if not SongRendition.objects.filter(file=instance.file.name).exists():
+        PendingDeletion.objects.enqueue([instance.file.name])
+
+
+class UploadSessionQuerySet(models.QuerySet):
+    def expired(self):
+        return self.filter(created_at__lt=timezone.now() - settings.SONG_UPLOAD_SESSION_MAX_AGE)
+
+    def unexpired(self):
+        return self.filter(created_at__gte=timezone.now() - settings.SONG_UPLOAD_SESSION_MAX_AGE)
+
+
+class UploadSession(models.Model):
+    public_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True, editable=False)
+
+    objects = UploadSessionQuerySet.as_manager()
+
+    @property
+    def staging_path(self):
+        return os.path.join(settings.SONG_UPLOAD_STAGING_ROOT, f'{self.public_id}.part')
 
-        if self.cover.name != self.cover.field.default:
-            self.cover.delete()
 
-        super().delete(*args, **kwargs)
+@receiver(post_delete, sender=UploadSession)
+def remove_staging_file(sender, instance, **kwargs):
+    # staged parts are local files, outside the storage API
+    if os.path.isfile(instance.staging_path):
+        os.remove(instance.staging_path)
@@ -0,0 +1,113 @@
+import wave
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from vibly.storage import local_path
+from .renditions import get_encoder
+
+# output samples resampled at a time
+RESAMPLE_BLOCK = 8192
+# the anti-aliasing filter's width, in zero crossings of its sinc on each side, and its cutoff relative to the
+# target's Nyquist frequency
+LOWPASS_ZERO_CROSSINGS = 16
+LOWPASS_ROLLOFF = 0.9
+
+
+class DecodeError(Exception):
+    pass
+
+
+def read_wav(file):
+    # Returns (mono int16 samples, sample rate) for plain PCM wave files
+    try:
+        with wave.open(file) as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            sample_rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise DecodeError(str(e))
+
+    if width == 1:
+        samples = (np.frombuffer(frames, np.uint8).astype(np.int16) - 128) << 8
+    elif width == 2:
+        samples = np.frombuffer(frames, '<i2')
+    elif width == 3:
+        data = np.frombuffer(frames, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((data[:, 0] << 8 | data[:, 1] << 16 | data[:, 2] << 24) >> 16).astype(np.int16)
+    elif width == 4:
+        samples = (np.frombuffer(frames, '<i4') >> 16).astype(np.int16)
+    else:
+        raise DecodeError(f'Unsupported sample width: {width}')
+
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels]
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32).astype(np.int16)
+
+    return samples, sample_rate
+
+
+def lowpass_kernel(cutoff):
+    # windowed sinc passing frequencies below cutoff, in cycles per sample
+    half = int(np.ceil(LOWPASS_ZERO_CROSSINGS / (2 * cutoff)))
+    n = np.arange(-half, half + 1)
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(len(n))
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def resample(samples, sample_rate, target_rate):
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+
+    length = int(len(samples) * target_rate / sample_rate)
+    step = (len(samples) - 1) / (length - 1) if length > 1 else 0
+
+    # Downsampling filters out what's above the target's Nyquist frequency first, it would alias. Only the samples
+    # interpolated between are filtered, a block at a time, so there's no float copy of the whole song.
+    if target_rate < sample_rate:
+        kernel = lowpass_kernel(LOWPASS_ROLLOFF * target_rate / sample_rate / 2)
+    else:
+        kernel = np.ones(1, np.float32)
+    half = len(kernel) // 2
+
+    resampled = np.empty(length, np.int16)
+    for start in range(0, length, RESAMPLE_BLOCK):
+        positions = np.arange(start, min(start + RESAMPLE_BLOCK, length)) * step
+        left = np.minimum(positions.astype(np.int64), len(samples) - 1)
+        fraction = (positions - left).astype(np.float32)
+
+        # the samples the block reads, silence past the ends of the song
+        first, last = left[0] - half, left[-1] + half + 2
+        available = slice(max(first, 0), min(last, len(samples)))
+        block = np.zeros(last - first, np.float32)
+        block[available.start - first:available.stop - first] = samples[available]
+
+        windows = sliding_window_view(block, len(kernel))
+        current = windows[left - left[0]] @ kernel
+        following = windows[left - left[0] + 1] @ kernel
+
+        values = current + (following - current) * fraction
+        resampled[start:start + len(values)] = np.clip(np.round(values), -32768, 32767)
+
+    return resampled
+
+
+def decode(song, sample_rate):
+    # Returns the song as mono int16 samples at sample_rate. WAV is read in process, other codecs go through
+    # the rendition encoder's decoder.
+    if song.codec == 'pcm':
+        try:
+            with song.song_file.open('rb') as file:
+                samples, rate = read_wav(file)
+            return resample(samples, rate, sample_rate)
+        except DecodeError:
+            # WAVE_FORMAT_EXTENSIBLE and float wave files aren't handled by the wave module
+            pass
+
+    encoder = get_encoder()
+    if not hasattr(encoder, 'decode') or not encoder.available():
+        raise DecodeError(f'No decoder available for {song.codec}')
+
+    with local_path(song.song_file.storage, song.song_file.name) as path:
+        return np.frombuffer(encoder.decode(path, sample_rate), '<i2')
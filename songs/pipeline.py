@@ -0,0 +1,35 @@
+import logging
+
+from vibly.tasks import submit
+from .models import Song
+from .renditions import build_renditions
+from .segments import build_segments
+from .waveform import build_waveform
+from .fingerprint import build_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Stages run in this order after a song is created, each one must be safe to run again
+STAGES = {
+    'renditions': build_renditions,
+    'segments': build_segments,
+    'waveform': build_waveform,
+    'fingerprint': build_fingerprint,
+}
+
+
+def process_song(song_id, stages=None):
+    song = Song.objects.filter(pk=song_id).first()
+    if song is None:
+        # deleted before the task ran
+        return
+
+    for name in stages or STAGES:
+        try:
+            STAGES[name](song)
+        except Exception:
+            logger.exception('Stage %s failed for song %s', name, song_id)
+
+
+def schedule_song_processing(song, stages=None):
+    submit(process_song, song.pk, stages)
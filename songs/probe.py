@@ -0,0 +1,149 @@
+import base64
+import binascii
+from collections import namedtuple
+
+from mutagen import MutagenError
+from mutagen.flac import Picture
+from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+from mutagen.wave import WAVE
+
+from .models import Song
+
+HEADER_SIZE = 64
+
+# audio is the parsed mutagen file, so tags and pictures can be read without parsing the upload again
+AudioInfo = namedtuple('AudioInfo', ['codec', 'duration', 'bitrate', 'sample_rate', 'channels', 'audio'])
+Tags = namedtuple('Tags', ['title', 'album', 'track'])
+
+# ID3 frame and vorbis comment of every tag
+TAG_KEYS = {
+    'title': ('TIT2', 'title'),
+    'album': ('TALB', 'album'),
+    'track': ('TRCK', 'tracknumber'),
+}
+# APIC picture type of the front cover
+FRONT_COVER = 3
+
+
+class ProbeError(Exception):
+    pass
+
+
+def sniff(header):
+    # Returns (codec, mutagen class) based on the magic bytes, or None if the format isn't supported
+    if header.startswith(b'ID3') or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return 'mp3', MP3
+
+    if header.startswith(b'OggS'):
+        if b'OpusHead' in header:
+            return 'opus', OggOpus
+        if b'\x01vorbis' in header:
+            return 'vorbis', OggVorbis
+
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'pcm', WAVE
+
+    return None
+
+
+def probe_audio(file):
+    file.seek(0)
+    header = file.read(HEADER_SIZE)
+    file.seek(0)
+
+    sniffed = sniff(header)
+    if sniffed is None:
+        raise ProbeError('Unsupported audio format')
+
+    codec, audio_class = sniffed
+
+    try:
+        audio = audio_class(file)
+    except MutagenError as e:
+        raise ProbeError(str(e))
+    finally:
+        file.seek(0)
+
+    info = audio.info
+    return AudioInfo(codec=codec,
+                     duration=float(info.length),
+                     bitrate=getattr(info, 'bitrate', None) or None,
+                     # opus always decodes at 48 kHz
+                     sample_rate=getattr(info, 'sample_rate', None) or (48000 if codec == 'opus' else None),
+                     channels=getattr(info, 'channels', None),
+                     audio=audio)
+
+
+def probe_upload(file):
+    # Content that is already stored was probed when it was first uploaded, that result is reused
+    sha256 = getattr(file, 'sha256', None)
+    if sha256:
+        song = Song.objects.filter(blob__sha256=sha256, codec__isnull=False).first()
+        if song is not None:
+            return AudioInfo(codec=song.codec,
+                             duration=song.duration.total_seconds(),
+                             bitrate=song.bitrate,
+                             sample_rate=song.sample_rate,
+                             channels=song.channels,
+                             audio=None)
+
+    return probe_audio(file)
+
+
+def get_audio_info(file):
+    # IsAudio attaches the probe result to the upload, so it's only parsed once per request
+    audio_info = getattr(file, 'audio_info', None)
+    if audio_info is None:
+        audio_info = probe_audio(file)
+        file.audio_info = audio_info
+    return audio_info
+
+
+def get_tags(audio):
+    tags = audio.tags
+    values = {}
+
+    for name, (frame, comment) in TAG_KEYS.items():
+        value = None
+        if isinstance(tags, ID3):
+            if frame in tags and tags[frame].text:
+                value = str(tags[frame].text[0])
+        elif tags is not None:
+            value = (tags.get(comment) or [None])[0]
+
+        values[name] = (value.strip() or None) if value else None
+
+    # "3/12" is the third of twelve tracks
+    track = values['track']
+    try:
+        values['track'] = int(track.split('/')[0]) if track else None
+    except ValueError:
+        values['track'] = None
+
+    return Tags(**values)
+
+
+def get_picture(audio):
+    # Returns the bytes of the embedded cover art (front cover if there are several) or None
+    tags = audio.tags
+    pictures = []
+
+    if isinstance(tags, ID3):
+        pictures = [(frame.type, frame.data) for frame in tags.getall('APIC')]
+    elif tags is not None:
+        # vorbis comments carry base64 encoded FLAC picture blocks
+        for value in tags.get('metadata_block_picture', []):
+            try:
+                picture = Picture(base64.b64decode(value))
+            except (binascii.Error, MutagenError):
+                continue
+            pictures.append((picture.type, picture.data))
+
+    if not pictures:
+        return None
+
+    pictures.sort(key=lambda picture: picture[0] != FRONT_COVER)
+    return pictures[0][1]
@@ -0,0 +1,81 @@
+import contextlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.utils.module_loading import import_string
+
+from vibly.storage import local_path
+from .models import SongRendition
+
+logger = logging.getLogger(__name__)
+
+
+class FFmpegEncoder:
+    codec = 'mp3'
+    extension = 'mp3'
+    binary = 'ffmpeg'
+
+    def available(self):
+        return shutil.which(self.binary) is not None
+
+    def encode(self, source, target, bitrate):
+        subprocess.run([self.binary, '-nostdin', '-v', 'error', '-y',
+                        '-i', source,
+                        '-map', '0:a:0', '-map_metadata', '-1',
+                        '-c:a', 'libmp3lame', '-b:a', f'{bitrate}k',
+                        target],
+                       check=True, capture_output=True)
+
+    def decode(self, source, sample_rate):
+        # mono signed 16-bit little endian PCM
+        return subprocess.run([self.binary, '-nostdin', '-v', 'error',
+                               '-i', source,
+                               '-map', '0:a:0', '-ac', '1', '-ar', str(sample_rate),
+                               '-f', 's16le', '-'],
+                              check=True, capture_output=True).stdout
+
+
+def get_encoder():
+    return import_string(settings.SONG_RENDITION_ENCODER)()
+
+
+def build_renditions(song):
+    encoder = get_encoder()
+    if not encoder.available():
+        logger.info('Encoder %s is not available, skipping renditions', settings.SONG_RENDITION_ENCODER)
+        return
+
+    existing = set(song.renditions.filter(codec=encoder.codec).values_list('bitrate', flat=True))
+
+    with contextlib.ExitStack() as stack:
+        source = None
+
+        for bitrate in settings.SONG_RENDITION_BITRATES:
+            # never upscale, the original already serves its own bitrate
+            if bitrate in existing or (song.bitrate and bitrate * 1000 >= song.bitrate):
+                continue
+
+            filename = f'{song.file_stem}_{bitrate}k.{encoder.extension}'
+
+            name = f'{SongRendition.file.field.upload_to}{filename}'
+            if SongRendition.file.field.storage.exists(name):
+                # already rendered for another song with the same content
+                SongRendition.objects.create(song=song, bitrate=bitrate, codec=encoder.codec, file=name)
+                continue
+
+            # the encoder reads a local file, object stores are downloaded once and only if something is encoded
+            if source is None:
+                source = stack.enter_context(local_path(song.song_file.storage, song.song_file.name))
+
+            with tempfile.TemporaryDirectory() as directory:
+                target = os.path.join(directory, filename)
+                encoder.encode(source, target, bitrate)
+
+                with open(target, 'rb') as f:
+                    rendition = SongRendition(song=song, bitrate=bitrate, codec=encoder.codec)
+                    rendition.file.save(filename, File(f), save=True)
@@ -0,0 +1,166 @@
+import math
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from mutagen.mp3 import MP3
+
+from blobs.managers import delete_stored
+
+MANIFEST_NAME = 'index.m3u8'
+# one directory per song file: <SEGMENTS_DIRECTORY>/<song file stem>/
+SEGMENTS_DIRECTORY = 'songs/segments'
+
+# kbps by bitrate index, for (MPEG version 1, layer) and (MPEG version 2/2.5, layer)
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+VERSIONS = {0b00: 2.5, 0b10: 2, 0b11: 1}
+LAYERS = {0b01: 3, 0b10: 2, 0b11: 1}
+
+
+def parse_frame_header(header):
+    # Returns (frame length in bytes, frame duration in seconds) or None if header isn't a valid MPEG audio frame
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+
+    version = VERSIONS.get((header[1] >> 3) & 0b11)
+    layer = LAYERS.get((header[1] >> 1) & 0b11)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0b11
+    padding = (header[2] >> 1) & 0b1
+
+    # free format (index 0) can't be split without decoding
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 576 if layer == 3 and version != 1 else 1152
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return length, samples / sample_rate
+
+
+def is_info_frame(frame):
+    # Xing/Info/VBRI frames carry no audio, only the seek table of the whole file
+    return b'Xing' in frame[:40] or b'Info' in frame[:40] or b'VBRI' in frame[:40]
+
+
+def iter_frames(file, offset):
+    # Yields (offset, length, duration) for every frame from offset up to the first invalid header (ID3v1, APE...)
+    file.seek(offset)
+    while True:
+        header = file.read(4)
+        frame = parse_frame_header(header)
+        if frame is None:
+            return
+
+        length, duration = frame
+        yield offset, length, duration
+
+        offset += length
+        file.seek(offset)
+
+
+def split_frames(file, offset, target_duration):
+    # Groups whole frames into (start, end, duration) segments of about target_duration seconds
+    segments = []
+    start, end, duration = None, None, 0
+
+    for frame_offset, length, frame_duration in iter_frames(file, offset):
+        if start is None:
+            file.seek(frame_offset)
+            if is_info_frame(file.read(min(length, 64))):
+                continue
+            start = frame_offset
+
+        end = frame_offset + length
+        duration += frame_duration
+
+        if duration >= target_duration:
+            segments.append((start, end, duration))
+            start, duration = None, 0
+
+    if start is not None:
+        segments.append((start, end, duration))
+
+    return segments
+
+
+def get_directory(song):
+    return f'{SEGMENTS_DIRECTORY}/{song.file_stem}'
+
+
+def get_manifest_name(song):
+    return f'{get_directory(song)}/{MANIFEST_NAME}'
+
+
+def get_segment_name(song, index):
+    return f'{get_directory(song)}/{index}.mp3'
+
+
+def build_manifest(durations):
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{math.ceil(max(durations, default=0))}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+
+    for index, duration in enumerate(durations):
+        lines.append(f'#EXTINF:{duration:.3f},')
+        lines.append(f'{index}.mp3')
+
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def build_segments(song):
+    # Cuts MP3 songs into frame aligned segments without re-encoding, other codecs would need a transcode
+    if song.codec != 'mp3' or song.segmented:
+        return
+
+    # already segmented for another song with the same content
+    if default_storage.exists(get_manifest_name(song)):
+        song.segmented = True
+        song.save(update_fields=['segmented'])
+        return
+
+    with song.song_file.open('rb') as file:
+        offset = MP3(file).info.frame_offset
+        segments = split_frames(file, offset, settings.SONG_SEGMENT_DURATION)
+
+        delete_segments(song)
+        for index, (start, end, duration) in enumerate(segments):
+            file.seek(start)
+            default_storage.save(get_segment_name(song, index), ContentFile(file.read(end - start)))
+
+    manifest = build_manifest([duration for start, end, duration in segments])
+    default_storage.save(get_manifest_name(song), ContentFile(manifest.encode()))
+
+    # only flagged once every file is in place
+    song.segmented = True
+    song.save(update_fields=['segmented'])
+
+
+def delete_segments(song):
+    delete_stored(f'{get_directory(song)}/')
@@ -1,11 +1,20 @@
 from rest_framework import serializers
-from mutagen.mp3 import MP3
+from django.conf import settings
+from django.db import transaction
+from django.utils.encoding import smart_str
 import datetime
+import uuid
 
+from blobs.models import Blob
 from users.serializers import UserSerializer
-from .models import Song
+from .models import Song, SongRendition, UploadSession
 from .validators import HasExtension, IsAudio
-from vibly.img import reshape_and_return_url, get_renamed_filename, delete_image
+from .probe import get_audio_info, get_picture
+from .pipeline import schedule_song_processing
+from .covers import attach_embedded_cover
+from vibly.img import schedule_reshape, get_variant_urls
+from vibly.mixins import eager_load
+from vibly.tasks import submit
 
 
 class CreateSongSerializer(serializers.ModelSerializer):
@@ -14,41 +23,77 @@ class CreateSongSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Song
-        fields = ['public_id', 'title', 'author', 'song_file', 'duration', 'cover', 'public', 'created_at']
-        read_only_fields = ('id', 'public_id', 'created_at', 'updated_at', 'author', 'duration')
+        fields = ['public_id', 'title', 'author', 'song_file', 'duration', 'codec', 'bitrate', 'sample_rate',
+                  'channels', 'cover', 'cover_status', 'public', 'created_at']
+        read_only_fields = ('id', 'public_id', 'created_at', 'updated_at', 'author', 'duration', 'codec', 'bitrate',
+                            'sample_rate', 'channels', 'cover_status')
 
     def save(self, **kwargs):
-        self.validated_data['song_file'].name = get_renamed_filename(self.validated_data['song_file'].name)
-        self.validated_data['duration'] = \
-            datetime.timedelta(seconds=float(MP3(self.validated_data['song_file']).info.length))
+        song_file = self.validated_data['song_file']
+        audio_info = get_audio_info(song_file)
+
+        self.validated_data['duration'] = datetime.timedelta(seconds=audio_info.duration)
+        self.validated_data['codec'] = audio_info.codec
+        self.validated_data['bitrate'] = audio_info.bitrate
+        self.validated_data['sample_rate'] = audio_info.sample_rate
+        self.validated_data['channels'] = audio_info.channels
 
         self.validated_data['author'] = self.context['request'].user
 
         cover = self.validated_data.get('cover')
         self.validated_data.pop('cover', None)
 
+        # Identical uploads share one stored file. The reference is only added if the song is saved with it, a
+        # failed save leaves at most a stored file without rows for media_gc.
+        with transaction.atomic():
+            blob = Blob.objects.acquire(song_file, self.Meta.model.song_file.field.upload_to)
+            self.validated_data['song_file'] = blob.name
+            self.validated_data['blob'] = blob
+            song = super().save(**kwargs)
+
         if cover:
-            if self.instance:
-                delete_image(self.instance.cover)
+            schedule_reshape(song, 'cover', cover, height=512, width=512)
+        else:
+            # the picture comes from the parse that probed the upload, stored content is read again by the task
+            picture = get_picture(audio_info.audio) if audio_info.audio is not None else None
+            if picture or audio_info.audio is None:
+                submit(attach_embedded_cover, song.pk, picture)
+
+        schedule_song_processing(song)
+        return song
 
-            self.validated_data['cover'] = reshape_and_return_url(cover,
-                                                                  cover.name,
-                                                                  self.Meta.model.cover.field.upload_to,
-                                                                  height=512,
-                                                                  width=512)
 
-        return super().save(**kwargs)
+class SongRenditionSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = SongRendition
+        fields = ['bitrate', 'codec', 'url']
+
+    def get_url(self, instance):
+        return self.context['request'].build_absolute_uri(f'/song/{instance.song.public_id}/stream/'
+                                                          f'?bitrate={instance.bitrate}')
 
 
 class SongSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     song_file = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
+    hls = serializers.SerializerMethodField()
+    waveform = serializers.SerializerMethodField()
     cover = serializers.SerializerMethodField()
+    cover_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Song
-        fields = ['public_id', 'title', 'author', 'song_file', 'duration', 'cover', 'public', 'created_at']
-        read_only_fields = ('created_at', 'updated_at', 'author', 'duration', 'song_file', 'public_id')
+        fields = ['public_id', 'title', 'author', 'song_file', 'renditions', 'hls', 'waveform', 'duration', 'codec',
+                  'bitrate', 'sample_rate', 'channels', 'cover', 'cover_variants', 'cover_status', 'public',
+                  'created_at']
+        read_only_fields = ('created_at', 'updated_at', 'author', 'duration', 'codec', 'bitrate', 'sample_rate',
+                            'channels', 'song_file', 'public_id', 'cover_status')
+        # read by get_cover, get_cover_variants and get_renditions
+        select_related = ['album_position__album']
+        prefetch_related = ['renditions']
 
     def save(self, **kwargs):
         self.validated_data['author'] = self.context['request'].user
@@ -59,23 +104,91 @@ class SongSerializer(serializers.ModelSerializer):
         song = super().save(**kwargs)
 
         if cover:
-            if self.instance:
-                delete_image(self.instance.pfp)
-
-            self.validated_data['cover'] = reshape_and_return_url(cover,
-                                                                  cover.name,
-                                                                  self.Meta.model.cover.field.upload_to,
-                                                                  height=512,
-                                                                  width=512)
+            schedule_reshape(song, 'cover', cover, height=512, width=512)
 
         return song
 
     def get_song_file(self, instance):
         if instance.public or instance.author == self.context['request'].user:
-            return self.context['request'].build_absolute_uri(instance.song_file.url)
+            return self.context['request'].build_absolute_uri(f'/song/{instance.public_id}/stream/')
+        return None
+
+    def get_renditions(self, instance):
+        if instance.public or instance.author == self.context['request'].user:
+            return SongRenditionSerializer(instance.renditions.all(), many=True, context=self.context).data
+        return []
+
+    def get_hls(self, instance):
+        if instance.segmented and (instance.public or instance.author == self.context['request'].user):
+            return self.context['request'].build_absolute_uri(f'/song/{instance.public_id}/hls/index.m3u8')
+        return None
+
+    def get_waveform(self, instance):
+        if instance.waveform and (instance.public or instance.author == self.context['request'].user):
+            return self.context['request'].build_absolute_uri(f'/song/{instance.public_id}/waveform/')
         return None
 
     def get_cover(self, instance):
         if not instance.album:
             return self.context['request'].build_absolute_uri(instance.cover.url)
         return self.context['request'].build_absolute_uri(instance.album.cover.url)
+
+    def get_cover_variants(self, instance):
+        cover = instance.album.cover if instance.album else instance.cover
+        return get_variant_urls(cover, self.context['request'])
+
+
+class SongPublicIdField(serializers.SlugRelatedField):
+    # A song written by its public_id. Lists of tracks read the songs of all their items in one query and keep
+    # them in their songs attribute (see load_songs), single tracks read their own.
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queryset', Song.objects.all())
+        kwargs.setdefault('slug_field', 'public_id')
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        songs = getattr(self.parent.parent, 'songs', None)
+        if songs is None:
+            return super().to_internal_value(data)
+
+        try:
+            return songs[uuid.UUID(smart_str(data))]
+        except (KeyError, ValueError):
+            self.fail('does_not_exist', slug_name=self.slug_field, value=smart_str(data))
+
+
+def load_songs(items, field_name, serializer):
+    # {public_id: song} of the songs items refer to by field_name, loaded with what serializer renders
+    public_ids = set()
+    for item in items if isinstance(items, list) else []:
+        try:
+            public_ids.add(uuid.UUID(smart_str(item.get(field_name))))
+        except (AttributeError, ValueError):
+            pass
+
+    return {song.public_id: song for song in eager_load(Song.objects.filter(public_id__in=public_ids), serializer)}
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    filename = serializers.CharField(max_length=255, validators=[HasExtension('mp3', 'ogg', 'wav')])
+
+    class Meta:
+        model = UploadSession
+        fields = ['public_id', 'filename', 'size', 'offset', 'created_at']
+        read_only_fields = ('public_id', 'offset', 'created_at')
+
+    def validate_size(self, size):
+        if size <= 0 or size > settings.SONG_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f'Size must be between 1 and {settings.SONG_UPLOAD_MAX_SIZE} bytes')
+        return size
+
+    def validate(self, attrs):
+        sessions = UploadSession.objects.unexpired().filter(author=self.context['request'].user)
+        if sessions.count() >= settings.SONG_UPLOAD_MAX_OPEN_SESSIONS:
+            raise serializers.ValidationError(f'You can\'t have more than {settings.SONG_UPLOAD_MAX_OPEN_SESSIONS} '
+                                              f'uploads in progress')
+        return attrs
+
+    def save(self, **kwargs):
+        self.validated_data['author'] = self.context['request'].user
+        return super().save(**kwargs)
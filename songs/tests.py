@@ -1,15 +1,58 @@
+import base64
 import datetime
+import hashlib
+import io
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from unittest import mock
 
+from django.contrib.auth import get_user_model
 from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, IntegrityError, transaction
 from rest_framework import status
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APITestCase
+from mutagen.id3 import APIC, TALB, TIT2, TRCK
 from mutagen.mp3 import MP3
+from mutagen.oggvorbis import OggVorbis
+from mutagen.wave import WAVE
 from PIL import Image
+import numpy as np
 
-from .models import Song
+from albums.models import Album
+from blobs.models import Blob, PendingDeletion
+from vibly import imagecache
+from vibly import settings as vibly_settings
+from . import fingerprint, pcm
+from .models import Song, SongRendition, UploadSession
+from .segments import get_directory
 from users.tests import UserCreate
 
 
+class CopyEncoder:
+    # Stands in for ffmpeg, which isn't available everywhere the tests run
+    codec = 'mp3'
+    extension = 'mp3'
+
+    def available(self):
+        return True
+
+    def encode(self, source, target, bitrate):
+        shutil.copyfile(source, target)
+
+
 class SongCreate:
     @staticmethod
     def create_song(client, token, **kwargs):
@@ -28,7 +71,55 @@ class SongCreate:
         song = client.post('/song/', data, HTTP_AUTHORIZATION=f'Bearer {token}')
         return Song.objects.filter(public_id=song.data.get('public_id')).first()
 
+    @staticmethod
+    def create_song_row(author, **kwargs):
+        # a song and its rendition without stored files, for tests that only render songs
+        data = {
+            'title': 'test song',
+            'author': author,
+            'song_file': f'songs/files/{uuid.uuid4().hex}.mp3',
+            'public': True
+        }
+
+        data.update(kwargs)
+
+        song = Song.objects.create(**data)
+        SongRendition.objects.create(song=song, bitrate=128, codec='mp3',
+                                     file=f'songs/renditions/{song.file_stem}_128.mp3')
+        return song
+
+    @staticmethod
+    def create_wav(seconds=2, frequency=440, amplitude=0.5, sample_rate=8000, samples=None):
+        buffer = io.BytesIO()
+        if samples is None:
+            samples = [int(amplitude * 32767 * math.sin(2 * math.pi * frequency * i / sample_rate))
+                       for i in range(int(seconds * sample_rate))]
+
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(struct.pack(f'<{len(samples)}h', *samples))
+
+        return SimpleUploadedFile('tone.wav', buffer.getvalue(), content_type='audio/wav')
+
+    @classmethod
+    def create_melody_wav(cls, seed, amplitude=0.5, noise=0.0, seconds=8, sample_rate=8000):
+        # a random sequence of quarter second notes, each a chord of three tones
+        rng = np.random.default_rng(seed)
+        note_length = sample_rate // 4
+        time = np.arange(note_length) / sample_rate
 
+        notes = [sum(np.sin(2 * np.pi * frequency * time) for frequency in rng.uniform(100, 3500, 3)) / 3
+                 for _ in range(seconds * 4)]
+        signal = amplitude * np.concatenate(notes) + noise * np.random.default_rng(seed + 1).standard_normal(
+            seconds * 4 * note_length)
+
+        samples = (np.clip(signal, -1, 1) * 32767).astype(int).tolist()
+        return cls.create_wav(samples=samples, sample_rate=sample_rate)
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class SongTests(APITestCase):
     def setUp(self):
         user_dict = UserCreate.create_user_dict(self.client)
@@ -69,9 +160,225 @@ class SongTests(APITestCase):
         song_file_duration = MP3(song_file).info.length
         self.assertEqual(song.duration, datetime.timedelta(seconds=song_file_duration))
 
+        self.assertEqual(song.codec, 'mp3')
+        self.assertEqual(song.bitrate, 128000)
+        self.assertEqual(song.sample_rate, 44100)
+        self.assertEqual(song.channels, 2)
+
         cover_image = Image.open(song.cover)
         self.assertEqual(cover_image.size, (512, 512))
 
+    def test_create_ogg_song(self):
+        song_file = open('testfiles/Yung Nugget - Simp Detector.ogg', 'rb')
+
+        data = {
+            'title': 'test song',
+            'song_file': song_file,
+        }
+
+        response = self.client.post('/song/', data, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        song = Song.objects.filter(public_id=response.data.get('public_id')).first()
+        info = OggVorbis('testfiles/Yung Nugget - Simp Detector.ogg').info
+        self.assertEqual(song.codec, 'vorbis')
+        self.assertEqual(song.duration, datetime.timedelta(seconds=info.length))
+        self.assertEqual(song.sample_rate, info.sample_rate)
+        self.assertEqual(song.channels, info.channels)
+
+    def test_cover_variants(self):
+        song = self.create_song()
+
+        response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        variants = response.data.get('cover_variants')
+        self.assertEqual(list(variants), [64, 128, 256, 512])
+
+        paths = []
+        for size, urls in variants.items():
+            self.assertIn('jpeg', urls)
+            for image_format, url in urls.items():
+                path = os.path.join(settings.MEDIA_ROOT, url.split('/media/', 1)[-1])
+                with Image.open(path) as variant:
+                    self.assertEqual((variant.size, variant.format.lower()), ((size, size), image_format))
+                paths.append(path)
+
+        song.delete()
+        for path in paths:
+            self.assertFalse(os.path.isfile(path))
+
+        # default covers have no variants
+        song = self.create_song(cover='')
+        response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.data.get('cover_variants')[64], {'png': response.data.get('cover')})
+
+        # without a format Pillow supports, covers are stored without variants and stand in for them
+        with mock.patch('vibly.img.features.check', return_value=False):
+            song = self.create_song()
+            response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.data.get('cover_variants')[64], {'jpg': response.data.get('cover')})
+
+    def test_media_cache_control(self):
+        song = self.create_song()
+        other = self.create_song()
+
+        # the processed cover is named after its content and shared
+        self.assertEqual(song.cover.name, other.cover.name)
+
+        response = self.client.get(song.cover.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(b''.join(response.streaming_content), song.cover.read())
+        song.cover.close()
+
+        # audio is only served by the song endpoints, which check who may listen
+        self.assertEqual(self.client.get(song.song_file.url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/songs/covers/../files/').status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get(f'/media/{song.cover.field.default}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/songs/').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_resize_image(self):
+        song = self.create_song()
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+
+        with mock.patch.object(vibly_settings, 'IMAGE_CACHE_ROOT', cache_root), \
+                mock.patch('vibly.imagecache.scale_to_width', wraps=imagecache.scale_to_width) as scale:
+            for _ in range(2):
+                response = self.client.get(f'/image/{song.cover.name}', {'width': 96, 'format': 'png'})
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+                with Image.open(io.BytesIO(b''.join(response.streaming_content))) as resized:
+                    self.assertEqual((resized.size, resized.format), ((96, 96), 'PNG'))
+
+            # the second request is served from the cache
+            self.assertEqual(scale.call_count, 1)
+
+            response = self.client.get(f'/image/{song.cover.name}', {'width': 100})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.get(f'/image/{song.cover.name}', {'width': 96, 'format': 'bmp'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            response = self.client.get(f'/image/{song.song_file.name}', {'width': 96})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+            response = self.client.get('/image/songs/covers/../../../manage.py', {'width': 96})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_resize_image_evicted_before_open(self):
+        song = self.create_song()
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+
+        # another process evicts the entry between the lookup and the response opening it
+        def get_resized_and_evict(*args):
+            name = imagecache.get_resized(*args)
+            if get_resized.call_count == 1:
+                os.remove(os.path.join(cache_root, name))
+            return name
+
+        with mock.patch.object(vibly_settings, 'IMAGE_CACHE_ROOT', cache_root), \
+                mock.patch('vibly.views.get_resized', side_effect=get_resized_and_evict) as get_resized:
+            response = self.client.get(f'/image/{song.cover.name}', {'width': 96, 'format': 'png'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_resized.call_count, 2)
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as resized:
+            self.assertEqual(resized.size, (96, 96))
+
+    def test_resize_image_single_flight(self):
+        song = self.create_song()
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+
+        scale_to_width = imagecache.scale_to_width
+
+        def slow_scale(*args):
+            time.sleep(0.2)
+            return scale_to_width(*args)
+
+        with mock.patch.object(vibly_settings, 'IMAGE_CACHE_ROOT', cache_root), \
+                mock.patch('vibly.imagecache.scale_to_width', side_effect=slow_scale) as scale:
+            names = []
+
+            def resize():
+                names.append(imagecache.get_resized(song.cover.name, 64, 'jpeg'))
+
+            threads = [threading.Thread(target=resize) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(scale.call_count, 1)
+            self.assertEqual(len(set(names)), 1)
+
+    def test_resize_image_eviction(self):
+        song = self.create_song()
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+
+        with mock.patch.object(vibly_settings, 'IMAGE_CACHE_ROOT', cache_root):
+            first = imagecache.get_resized(song.cover.name, 256, 'png')
+            size = os.path.getsize(os.path.join(cache_root, first))
+
+            # the first entry is used again, so the second one is the least recently used
+            second = imagecache.get_resized(song.cover.name, 192, 'png')
+            past = time.time() - 3600
+            os.utime(os.path.join(cache_root, first), (past, past))
+            os.utime(os.path.join(cache_root, second), (past, past))
+            imagecache.get_resized(song.cover.name, 256, 'png')
+
+            # misses under the limit only add to the running total
+            with mock.patch('vibly.imagecache.scan', wraps=imagecache.scan) as scan:
+                imagecache.get_resized(song.cover.name, 256, 'jpeg')
+            scan.assert_not_called()
+            os.remove(os.path.join(cache_root, imagecache.get_cache_name(song.cover.name, 256, 'jpeg')))
+
+            with mock.patch.object(vibly_settings, 'IMAGE_CACHE_MAX_SIZE', size * 3 // 2):
+                third = imagecache.get_resized(song.cover.name, 128, 'png')
+
+            self.assertTrue(os.path.isfile(os.path.join(cache_root, first)))
+            self.assertFalse(os.path.isfile(os.path.join(cache_root, second)))
+            self.assertTrue(os.path.isfile(os.path.join(cache_root, third)))
+
+    def test_embedded_cover(self):
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as song_file:
+            with open('testfiles/Among Us Drip Theme Song Original.mp3', 'rb') as f:
+                shutil.copyfileobj(f, song_file)
+            song_file.flush()
+
+            tags = MP3(song_file.name)
+            with open('testfiles/armstrong.jpg', 'rb') as f:
+                tags.tags.add(APIC(mime='image/jpeg', type=3, data=f.read()))
+            tags.save()
+
+            first = self.create_song(song_file=File(open(song_file.name, 'rb')), cover='')
+            # already stored content isn't parsed again, the picture is read from the stored file
+            second = self.create_song(song_file=File(open(song_file.name, 'rb')), cover='')
+
+        self.assertEqual(first.blob, second.blob)
+        for song in (first, second):
+            song.refresh_from_db()
+            self.assertNotEqual(song.cover.name, song.cover.field.default)
+            with Image.open(song.cover.path) as cover:
+                self.assertEqual(cover.size, (512, 512))
+
+        # identical pictures are stored once
+        self.assertEqual(first.cover.name, second.cover.name)
+        self.assertEqual(Blob.objects.get(name=first.cover.name).refcount, 2)
+
+        first.delete()
+        self.assertTrue(os.path.isfile(second.cover.path))
+
+        # songs without a picture keep the default cover
+        song = self.create_song(song_file=SongCreate.create_wav(), cover='')
+        song.refresh_from_db()
+        self.assertEqual(song.cover.name, song.cover.field.default)
+
     def test_create_bad_song(self):
         song_file = File(open('testfiles/definitelynotmp3.mp3', 'rb'))
 
@@ -84,6 +391,40 @@ class SongTests(APITestCase):
         response = self.client.post('/song/', data, HTTP_AUTHORIZATION=f'Bearer {self.token}')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_create_duplicate_song(self):
+        first = self.create_song()
+        second = self.create_song()
+
+        # identical uploads share one stored file
+        self.assertEqual(first.song_file.name, second.song_file.name)
+        self.assertEqual(first.blob, second.blob)
+        self.assertEqual(Blob.objects.get(pk=first.blob.pk).refcount, 2)
+
+        with open('testfiles/Among Us Drip Theme Song Original.mp3', 'rb') as f:
+            self.assertEqual(first.blob.sha256, hashlib.sha256(f.read()).hexdigest())
+
+        self.assertEqual((second.codec, second.duration), (first.codec, first.duration))
+
+        path = first.song_file.path
+        first.delete()
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual(Blob.objects.get(pk=second.blob.pk).refcount, 1)
+
+        second.delete()
+        self.assertFalse(os.path.isfile(path))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_failed_song_save_releases_blob(self):
+        song = self.create_song()
+
+        # the reference added for the upload goes away with the song that failed to save
+        with mock.patch.object(Song, 'save', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.create_song()
+
+        self.assertEqual(Song.objects.count(), 1)
+        self.assertEqual(Blob.objects.get(pk=song.blob.pk).refcount, 1)
+
     def test_retrieve_song(self):
         song = self.create_song()
 
@@ -96,12 +437,69 @@ class SongTests(APITestCase):
         self.assertEqual(response.data.get('duration')[1:], str(song.duration))
         self.assertEqual(response.data.get('created_at'), song.created_at.isoformat())
 
+    def test_retrieve_song_queries(self):
+        album = Album.objects.create(title='test album', author=self.user, public=True)
+        song = SongCreate.create_song_row(self.user)
+        album.album_positions.create(song=song, order=1)
+
+        def retrieve():
+            response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response
+
+        with CaptureQueriesContext(connection) as queries:
+            retrieve()
+
+        for bitrate in (64, 192, 320):
+            SongRendition.objects.create(song=song, bitrate=bitrate, codec='mp3',
+                                         file=f'songs/renditions/{song.file_stem}_{bitrate}.mp3')
+        with self.assertNumQueries(len(queries)):
+            response = retrieve()
+
+        self.assertEqual(len(response.data['renditions']), 4)
+
     def test_retrieve_unpublished_song(self):
         song = self.create_song(public=False)
 
         response = self.client.get(f'/song/{song.public_id}/')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_list_songs(self):
+        other = UserCreate.create_user_dict(self.client).get('user')
+
+        songs = [SongCreate.create_song_row(self.user, title=f'Song number {i}') for i in range(5)]
+        private = SongCreate.create_song_row(self.user, public=False)
+        others = [SongCreate.create_song_row(other), SongCreate.create_song_row(other, public=False)]
+
+        # older songs come last, whatever their id
+        Song.objects.filter(pk__in=[songs[1].pk, songs[3].pk]).update(created_at=datetime.date(2020, 1, 1))
+
+        def list_songs(url, **kwargs):
+            public_ids = []
+            while url:
+                response = self.client.get(url, **kwargs)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertLessEqual(len(response.data['results']), 2)
+                public_ids += [song['public_id'] for song in response.data['results']]
+                url = response.data['next']
+            return public_ids
+
+        expected = [others[0], songs[4], songs[2], songs[0], songs[3], songs[1]]
+        self.assertEqual(list_songs('/song/?page_size=2'), [str(song.public_id) for song in expected])
+
+        expected = [others[0], private, songs[4], songs[2], songs[0], songs[3], songs[1]]
+        self.assertEqual(list_songs('/song/?page_size=2', HTTP_AUTHORIZATION=f'Bearer {self.token}'),
+                         [str(song.public_id) for song in expected])
+
+        self.assertEqual(list_songs(f'/song/?author={other.public_id}', HTTP_AUTHORIZATION=f'Bearer {self.token}'),
+                         [str(others[0].public_id)])
+
+        response = self.client.get('/song/?cursor=bogus')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.get('/song/?author=bogus')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_song(self):
         song = self.create_song()
 
@@ -123,3 +521,519 @@ class SongTests(APITestCase):
         response = self.client.delete(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(Song.objects.count(), 0)
+
+    def test_files_deleted_after_commit(self):
+        song = self.create_song()
+        paths = [song.song_file.path, song.cover.path,
+                 os.path.join(settings.MEDIA_ROOT, get_directory(song), 'index.m3u8')]
+
+        submitted = []
+        with override_settings(TASKS_ALWAYS_EAGER=False), mock.patch('vibly.tasks.get_executor') as get_executor:
+            get_executor.return_value.submit.side_effect = lambda fn, *args: submitted.append((fn, args))
+
+            # a rolled back delete keeps the files
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Song.objects.get(pk=song.pk).delete()
+                raise RuntimeError
+            self.assertTrue(Song.objects.filter(pk=song.pk).exists())
+            self.assertFalse(PendingDeletion.objects.exists())
+
+            # cascades and QuerySet.delete() release files as well, a single drain deletes them after the commit
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                get_user_model().objects.filter(pk=self.user.pk).delete()
+                self.assertTrue(all(os.path.isfile(path) for path in paths))
+                self.assertTrue(PendingDeletion.objects.exists())
+
+            self.assertGreater(len(callbacks), 1)
+            self.assertEqual(len(submitted), 1)
+            for fn, args in submitted:
+                fn(*args)
+
+        self.assertFalse(PendingDeletion.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(any(os.path.isfile(path) for path in paths))
+
+    @override_settings(SONG_RENDITION_ENCODER='songs.tests.CopyEncoder', SONG_RENDITION_BITRATES=(64, 128, 256))
+    def test_song_renditions(self):
+        song = self.create_song()
+
+        # the test file is 128 kbps, higher renditions would only waste space
+        renditions = SongRendition.objects.filter(song=song)
+        self.assertEqual(list(renditions.values_list('bitrate', flat=True)), [64])
+
+        rendition = renditions.first()
+        self.assertTrue(os.path.isfile(rendition.file.path))
+
+        response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.data.get('renditions'), [{
+            'bitrate': 64,
+            'codec': 'mp3',
+            'url': f'http://testserver/song/{song.public_id}/stream/?bitrate=64'
+        }])
+
+        response = self.client.get(response.data['renditions'][0]['url'])
+        self.assertEqual(b''.join(response.streaming_content), rendition.file.read())
+        rendition.file.close()
+        self.assertEqual(self.client.get(f'/song/{song.public_id}/stream/?bitrate=256').status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+        path = rendition.file.path
+        song.delete()
+        self.assertFalse(os.path.isfile(path))
+
+    def test_song_segments(self):
+        song = self.create_song()
+        song.refresh_from_db()
+        self.assertTrue(song.segmented)
+
+        response = self.client.get(f'/song/{song.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.data.get('hls'), f'http://testserver/song/{song.public_id}/hls/index.m3u8')
+
+        response = self.client.get(f'/song/{song.public_id}/hls/index.m3u8')
+        manifest = b''.join(response.streaming_content).decode()
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
+        self.assertTrue(manifest.startswith('#EXTM3U'))
+        self.assertTrue(manifest.rstrip().endswith('#EXT-X-ENDLIST'))
+
+        durations = [float(line[len('#EXTINF:'):-1]) for line in manifest.splitlines() if line.startswith('#EXTINF:')]
+        self.assertAlmostEqual(sum(durations), song.duration.total_seconds(), delta=0.1)
+        self.assertTrue(all(duration <= 10.1 for duration in durations))
+
+        for index in range(len(durations)):
+            response = self.client.get(f'/song/{song.public_id}/hls/{index}.mp3')
+            segment = b''.join(response.streaming_content)
+            response.close()
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIn('immutable', response['Cache-Control'])
+            # every segment starts on a frame header
+            self.assertEqual(segment[0], 0xFF)
+            self.assertEqual(segment[1] & 0xE0, 0xE0)
+
+        response = self.client.get(f'/song/{song.public_id}/hls/{len(durations)}.mp3')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(SONG_WAVEFORM_SAMPLE_RATE=8000, SONG_WAVEFORM_SAMPLES_PER_PEAK=64, SONG_WAVEFORM_LEVELS=4)
+    def test_song_waveform(self):
+        song = self.create_song(song_file=SongCreate.create_wav(seconds=2, amplitude=0.5))
+        self.assertEqual(song.codec, 'pcm')
+        self.assertTrue(song.waveform)
+
+        response = self.client.get(f'/song/{song.public_id}/waveform/', {'level': 0})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Waveform-Levels'], '4')
+        self.assertEqual(response['X-Waveform-Samples-Per-Peak'], '64')
+
+        peaks = response.content
+        self.assertEqual(len(peaks), math.ceil(2 * 8000 / 64) * 2)
+        minimums = [struct.unpack('b', peaks[i:i + 1])[0] for i in range(0, len(peaks), 2)]
+        maximums = [struct.unpack('b', peaks[i:i + 1])[0] for i in range(1, len(peaks), 2)]
+        self.assertAlmostEqual(max(maximums), 63, delta=2)
+        self.assertAlmostEqual(min(minimums), -64, delta=2)
+
+        # without a level the coarsest one is returned
+        response = self.client.get(f'/song/{song.public_id}/waveform/')
+        self.assertEqual(response['X-Waveform-Samples-Per-Peak'], str(64 << 3))
+        self.assertEqual(len(response.content), math.ceil(2 * 8000 / (64 << 3)) * 2)
+
+        response = self.client.get(f'/song/{song.public_id}/waveform/', {'level': 4})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_resample(self):
+        def tone(frequency, sample_rate=8000):
+            time = np.arange(sample_rate) / sample_rate
+            return (10000 * np.sin(2 * np.pi * frequency * time)).astype(np.int16)
+
+        # a tone above the target's Nyquist frequency is filtered out, not folded back below it
+        with mock.patch.object(pcm, 'RESAMPLE_BLOCK', 1000):
+            kept = pcm.resample(tone(500), 8000, 4000)
+            aliased = pcm.resample(tone(3000), 8000, 4000)
+
+        self.assertEqual((len(kept), len(aliased)), (4000, 4000))
+        self.assertGreater(np.abs(kept[100:-100]).max(), 9000)
+        self.assertLess(np.abs(aliased[100:-100]).max(), 100)
+
+        upsampled = pcm.resample(tone(500), 8000, 16000)
+        self.assertEqual(len(upsampled), 16000)
+        self.assertGreater(np.abs(upsampled).max(), 9000)
+
+    def test_fingerprint_hashes(self):
+        # peaks of a frame pair with the peaks of the following frames, not with each other
+        peaks = np.array([[0, 10], [0, 20], [0, 30], [1, 40], [3, 50]])
+        hashes = fingerprint.hash_peaks(peaks)
+        self.assertEqual(len(hashes), 7)
+        self.assertTrue(all(value & 63 > 0 for value, offset in hashes))
+
+        # the same values are kept whatever their offsets, so limited fingerprints still line up
+        shifted = hashes + [0, 100]
+        self.assertEqual(fingerprint.limit_hashes(hashes, 4)[:, 0].tolist(),
+                         fingerprint.limit_hashes(shifted, 4)[:, 0].tolist())
+        self.assertLessEqual(len(fingerprint.limit_hashes(hashes, 4)), 4)
+
+    def test_find_duplicates(self):
+        original = self.create_song(song_file=SongCreate.create_melody_wav(seed=1))
+        # same melody, quieter and with noise, as a re-encode would differ
+        copy = self.create_song(song_file=SongCreate.create_melody_wav(seed=1, amplitude=0.3, noise=0.01))
+        other = self.create_song(song_file=SongCreate.create_melody_wav(seed=2))
+
+        self.assertNotEqual(original.blob, copy.blob)
+        for song in (original, copy, other):
+            song.refresh_from_db()
+            self.assertTrue(song.fingerprinted)
+
+        duplicates = [song for song, score in original.find_duplicates()]
+        self.assertEqual(duplicates, [copy])
+
+        response = self.client.get(f'/song/{copy.public_id}/duplicates/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([match['song']['public_id'] for match in response.data], [str(original.public_id)])
+
+        response = self.client.get(f'/song/{copy.public_id}/duplicates/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_duplicates_queries(self):
+        song = SongCreate.create_song_row(self.user)
+        album = Album.objects.create(title='test album', author=self.user, public=True)
+
+        def add_matches(count):
+            for i in range(count):
+                match = SongCreate.create_song_row(self.user, title=f'Song number {i}')
+                album.album_positions.create(song=match, order=match.pk)
+                matches.append((match, 100 - len(matches)))
+
+        def duplicates():
+            with mock.patch.object(Song, 'find_duplicates', return_value=list(matches)):
+                response = self.client.get(f'/song/{song.public_id}/duplicates/',
+                                           HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response
+
+        matches = []
+        add_matches(1)
+        with CaptureQueriesContext(connection) as queries:
+            duplicates()
+
+        add_matches(20)
+        with self.assertNumQueries(len(queries)):
+            response = duplicates()
+
+        self.assertEqual([match['song']['public_id'] for match in response.data],
+                         [str(match.public_id) for match, score in matches])
+
+    def test_stream_song(self):
+        song = self.create_song()
+
+        response = self.client.get(f'/song/{song.public_id}/stream/')
+        content = b''.join(response.streaming_content)
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+        self.assertEqual(content, song.song_file.read())
+        song.song_file.close()
+
+    def test_stream_song_range(self):
+        song = self.create_song()
+        data = song.song_file.read()
+        song.song_file.close()
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE='bytes=100-1099')
+        content = b''.join(response.streaming_content)
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 100-1099/{len(data)}')
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(content, data[100:1100])
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE='bytes=-500')
+        content = b''.join(response.streaming_content)
+        response.close()
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(content, data[-500:])
+
+    def test_stream_song_multiple_ranges(self):
+        song = self.create_song()
+        data = song.song_file.read()
+        song.song_file.close()
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE='bytes=0-9, 200-209')
+        content = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertIn(f'Content-Range: bytes 0-9/{len(data)}\r\n\r\n'.encode() + data[0:10], content)
+        self.assertIn(f'Content-Range: bytes 200-209/{len(data)}\r\n\r\n'.encode() + data[200:210], content)
+
+    def test_stream_song_unsatisfiable_range(self):
+        song = self.create_song()
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE=f'bytes={song.song_file.size}-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{song.song_file.size}')
+
+    def test_stream_song_conditional(self):
+        song = self.create_song()
+
+        response = self.client.get(f'/song/{song.public_id}/stream/')
+        response.close()
+        etag = response['ETag']
+        # shared caches revalidate, the song may be made private
+        self.assertEqual(response['Cache-Control'], 'public, no-cache')
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # stale If-Range falls back to the full file
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        response.close()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        response.close()
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+    def test_stream_unpublished_song(self):
+        song = self.create_song(public=False)
+
+        response = self.client.get(f'/song/{song.public_id}/stream/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.client.get(f'/song/{song.public_id}/stream/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        response.close()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True)
+class UploadSessionTests(APITestCase):
+    song_path = 'testfiles/Among Us Drip Theme Song Original.mp3'
+
+    def setUp(self):
+        user_dict = UserCreate.create_user_dict(self.client)
+        self.user = user_dict.get('user')
+        self.token = user_dict.get('token')
+
+        with open(self.song_path, 'rb') as f:
+            self.data = f.read()
+
+        def end():
+            for session in UploadSession.objects.all():
+                session.delete()
+
+            for song in Song.objects.all():
+                song.delete()
+
+        self.addCleanup(end)
+
+    def create_session(self, **kwargs):
+        data = {
+            'filename': 'song.mp3',
+            'size': len(self.data)
+        }
+
+        data.update(kwargs)
+
+        response = self.client.post('/song/uploads/', data, HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        return UploadSession.objects.filter(public_id=response.data.get('public_id')).first()
+
+    def upload_chunk(self, session, offset, chunk, **headers):
+        return self.client.patch(f'/song/uploads/{session.public_id}/',
+                                 chunk,
+                                 content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(offset),
+                                 HTTP_AUTHORIZATION=f'Bearer {self.token}',
+                                 **headers)
+
+    @staticmethod
+    def checksum(chunk):
+        return 'sha256 ' + base64.b64encode(hashlib.sha256(chunk).digest()).decode()
+
+    def test_create_session(self):
+        response = self.client.post('/song/uploads/',
+                                    {'filename': 'song.mp3', 'size': len(self.data)},
+                                    HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response['Upload-Offset'], '0')
+
+        session = UploadSession.objects.get(public_id=response.data.get('public_id'))
+        self.assertEqual(session.author, self.user)
+        self.assertTrue(os.path.isfile(session.staging_path))
+
+    def test_create_session_bad_extension(self):
+        response = self.client.post('/song/uploads/',
+                                    {'filename': 'song.exe', 'size': 10},
+                                    HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_resume_and_finalize(self):
+        session = self.create_session()
+        middle = len(self.data) // 2
+
+        response = self.upload_chunk(session, 0, self.data[:middle],
+                                     HTTP_UPLOAD_CHECKSUM=self.checksum(self.data[:middle]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response['Upload-Offset'], str(middle))
+
+        # the client asks where to resume after losing the connection
+        response = self.client.get(f'/song/uploads/{session.public_id}/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response['Upload-Offset'], str(middle))
+
+        response = self.upload_chunk(session, middle, self.data[middle:])
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.post(f'/song/uploads/{session.public_id}/finalize/',
+                                    {'title': 'uploaded song', 'public': True},
+                                    HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        song = Song.objects.get(public_id=response.data.get('public_id'))
+        self.assertEqual(song.title, 'uploaded song')
+        self.assertEqual(song.author, self.user)
+        self.assertEqual(song.duration, datetime.timedelta(seconds=MP3(self.song_path).info.length))
+        self.assertEqual(song.song_file.read(), self.data)
+        song.song_file.close()
+
+        self.assertFalse(UploadSession.objects.filter(pk=session.pk).exists())
+        self.assertFalse(os.path.isfile(session.staging_path))
+
+    def test_wrong_offset(self):
+        session = self.create_session()
+
+        response = self.upload_chunk(session, 10, self.data[10:20])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '0')
+
+    def test_checksum_mismatch(self):
+        session = self.create_session()
+
+        response = self.upload_chunk(session, 0, self.data[:100], HTTP_UPLOAD_CHECKSUM=self.checksum(b'other'))
+        self.assertEqual(response.status_code, 460)
+
+        session.refresh_from_db()
+        self.assertEqual(session.offset, 0)
+        self.assertEqual(os.path.getsize(session.staging_path), 0)
+
+    def test_finalize_incomplete(self):
+        session = self.create_session()
+        self.upload_chunk(session, 0, self.data[:100])
+
+        response = self.client.post(f'/song/uploads/{session.public_id}/finalize/',
+                                    {'title': 'uploaded song'},
+                                    HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Song.objects.count(), 0)
+
+    def test_expired_session(self):
+        session = self.create_session()
+        UploadSession.objects.filter(pk=session.pk).update(created_at=timezone.now() - datetime.timedelta(days=2))
+
+        response = self.upload_chunk(session, 0, self.data[:100])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        call_command('clear_upload_sessions', stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.filter(pk=session.pk).exists())
+        self.assertFalse(os.path.isfile(session.staging_path))
+
+    @override_settings(SONG_UPLOAD_MAX_OPEN_SESSIONS=2)
+    def test_open_sessions_limit(self):
+        sessions = [self.create_session() for _ in range(2)]
+
+        response = self.client.post('/song/uploads/',
+                                    {'filename': 'song.mp3', 'size': len(self.data)},
+                                    HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # abandoned sessions make room
+        UploadSession.objects.filter(pk=sessions[0].pk).update(created_at=timezone.now() - datetime.timedelta(days=2))
+        self.assertIsNotNone(self.create_session())
+        self.assertFalse(os.path.isfile(sessions[0].staging_path))
+
+    def test_other_user_session(self):
+        session = self.create_session()
+        token = UserCreate.create_user_dict(self.client).get('token')
+
+        response = self.client.get(f'/song/uploads/{session.public_id}/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True)
+class ImportSongsTests(APITestCase):
+    def setUp(self):
+        self.user = UserCreate.create_user_dict(self.client).get('user')
+        self.directory = tempfile.mkdtemp()
+
+        def end():
+            for album in Album.objects.all():
+                album.delete()
+
+            for song in Song.objects.all():
+                song.delete()
+
+            shutil.rmtree(self.directory)
+
+        self.addCleanup(end)
+
+    def import_songs(self):
+        call_command('import_songs', self.directory, author=self.user.email, workers=2, batch_size=2,
+                     stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_import_songs(self):
+        os.makedirs(os.path.join(self.directory, 'album'))
+
+        mp3_path = os.path.join(self.directory, 'album', 'b.mp3')
+        shutil.copyfile('testfiles/Among Us Drip Theme Song Original.mp3', mp3_path)
+        tags = MP3(mp3_path)
+        tags.tags.add(TIT2(text=['Drip']))
+        tags.tags.add(TALB(text=['Imported album']))
+        tags.tags.add(TRCK(text=['2/2']))
+        with open('testfiles/armstrong.jpg', 'rb') as f:
+            tags.tags.add(APIC(mime='image/jpeg', type=3, data=f.read()))
+        tags.save()
+
+        ogg_path = os.path.join(self.directory, 'album', 'a.ogg')
+        shutil.copyfile('testfiles/Yung Nugget - Simp Detector.ogg', ogg_path)
+        tags = OggVorbis(ogg_path)
+        tags['album'] = 'Imported album'
+        tags['tracknumber'] = '1'
+        tags.save()
+
+        shutil.copyfile('testfiles/definitelynotmp3.mp3', os.path.join(self.directory, 'bad.mp3'))
+
+        self.import_songs()
+
+        self.assertEqual(Song.objects.count(), 2)
+        album = Album.objects.get(author=self.user)
+        self.assertEqual(album.title, 'Imported album')
+        self.assertNotEqual(album.cover.name, album.cover.field.default)
+        with Image.open(album.cover.path) as cover:
+            self.assertEqual(cover.size, (512, 512))
+
+        positions = album.album_positions.all()
+        self.assertEqual([(position.order, position.song.title) for position in positions], [(1, 'a'), (2, 'Drip')])
+        self.assertEqual(positions[0].song.codec, 'vorbis')
+        self.assertEqual(positions[1].song.codec, 'mp3')
+        self.assertIsNotNone(positions[1].song.blob)
+
+        # files that were already imported are skipped, new files go after the album's last track
+        wav_path = os.path.join(self.directory, 'album', 'c.wav')
+        with open(wav_path, 'wb') as f:
+            f.write(SongCreate.create_wav().read())
+        tags = WAVE(wav_path)
+        tags.add_tags()
+        tags.tags.add(TALB(text=['Imported album']))
+        tags.save()
+
+        self.import_songs()
+
+        self.assertEqual(Song.objects.count(), 3)
+        self.assertEqual(Album.objects.count(), 1)
+        position = album.album_positions.get(order=3)
+        self.assertEqual(position.song.title, 'c')
+        self.assertEqual(position.song.codec, 'pcm')
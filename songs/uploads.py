@@ -0,0 +1,91 @@
+import base64
+import binascii
+import fcntl
+import hashlib
+import os
+
+from django.core.files import File
+
+from .models import UploadSession
+
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256')
+BLOCK_SIZE = 64 * 1024
+
+
+class ChunkError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class StagedUpload(File):
+    # FileSystemStorage moves files exposing temporary_file_path() instead of copying them
+    def __init__(self, session):
+        super().__init__(open(session.staging_path, 'rb'), name=session.filename)
+        self.staging_path = session.staging_path
+
+    def temporary_file_path(self):
+        return self.staging_path
+
+
+def create_staging_file(session):
+    os.makedirs(os.path.dirname(session.staging_path), exist_ok=True)
+    open(session.staging_path, 'wb').close()
+
+
+def parse_checksum(header):
+    # Upload-Checksum: <algorithm> <base64 digest>, as in the tus checksum extension
+    if not header:
+        return None
+
+    try:
+        algorithm, digest = header.split(' ', 1)
+        digest = base64.b64decode(digest, validate=True)
+    except (ValueError, binascii.Error):
+        raise ChunkError(400, 'Malformed Upload-Checksum header')
+
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ChunkError(400, f'Unsupported checksum algorithm. Supported: {", ".join(CHECKSUM_ALGORITHMS)}')
+
+    return algorithm, digest
+
+
+def write_chunk(session, stream, length, offset, checksum=None):
+    if offset + length > session.size:
+        raise ChunkError(413, 'Chunk exceeds the declared upload size')
+
+    hasher = hashlib.new(checksum[0]) if checksum else None
+
+    with open(session.staging_path, 'r+b') as staging:
+        # the lock serializes requests writing to the same session, it's released when the file is closed
+        fcntl.flock(staging, fcntl.LOCK_EX)
+
+        session.refresh_from_db(fields=['offset'])
+        if offset != session.offset:
+            raise ChunkError(409, f'Upload-Offset must be {session.offset}')
+
+        staging.seek(offset)
+        remaining = length
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+
+            staging.write(block)
+            if hasher is not None:
+                hasher.update(block)
+            remaining -= len(block)
+
+        written = length - remaining
+
+        # a checksummed chunk is all or nothing, otherwise keep whatever arrived before the connection dropped
+        if hasher is not None and (remaining or hasher.digest() != checksum[1]):
+            staging.truncate(offset)
+            raise ChunkError(460, 'Checksum mismatch')
+
+        staging.truncate(offset + written)
+        UploadSession.objects.filter(pk=session.pk).update(offset=offset + written)
+        session.offset = offset + written
+
+    return session.offset
@@ -1,8 +1,19 @@
 from django.urls import path
 
-from .views import SongViewSet
+from .views import SongViewSet, UploadSessionViewSet
 
 urlpatterns = [
     path('<uuid:public_id>/', SongViewSet.as_view({'get': 'retrieve', 'patch': 'partial_update', 'delete': 'destroy'})),
-    path('', SongViewSet.as_view({'post': 'create'})),
+    path('<uuid:public_id>/stream/', SongViewSet.as_view({'get': 'stream'})),
+    path('<uuid:public_id>/duplicates/', SongViewSet.as_view({'get': 'duplicates'})),
+    path('<uuid:public_id>/waveform/', SongViewSet.as_view({'get': 'waveform'})),
+    path('<uuid:public_id>/hls/index.m3u8', SongViewSet.as_view({'get': 'hls_manifest'})),
+    path('<uuid:public_id>/hls/<int:segment>.mp3', SongViewSet.as_view({'get': 'hls_segment'})),
+    path('', SongViewSet.as_view({'get': 'list', 'post': 'create'})),
+    path('uploads/', UploadSessionViewSet.as_view({'post': 'create'})),
+    path('uploads/<uuid:public_id>/', UploadSessionViewSet.as_view({'get': 'retrieve',
+                                                                     'patch': 'upload_chunk',
+                                                                     'put': 'upload_chunk',
+                                                                     'delete': 'destroy'})),
+    path('uploads/<uuid:public_id>/finalize/', UploadSessionViewSet.as_view({'post': 'finalize'})),
 ]
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from mutagen.mp3 import MP3, HeaderNotFoundError
+
+from .probe import probe_upload, ProbeError
 
 
 class HasExtension:
@@ -7,8 +8,10 @@ class HasExtension:
         self.extensions = args
 
     def __call__(self, file):
+        # accepts an uploaded file or a bare filename
+        name = getattr(file, 'name', file)
         for ext in self.extensions:
-            if ext == file.name.split('.')[-1]:
+            if ext == name.split('.')[-1]:
                 return True
 
         raise serializers.ValidationError(
@@ -19,7 +22,7 @@ class HasExtension:
 class IsAudio:
     def __call__(self, file):
         try:
-            MP3(file)
-        except HeaderNotFoundError:
+            # keep the result on the upload, the serializer reuses it instead of parsing the file again
+            file.audio_info = probe_upload(file)
+        except ProbeError:
             raise serializers.ValidationError('File is not an audio file')
-
@@ -1,15 +1,26 @@
 from rest_framework import viewsets, status
+from django.http import HttpResponse
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 
-from .serializers import SongSerializer, CreateSongSerializer
-from .models import Song
+from django.conf import settings
 
+from .serializers import SongSerializer, CreateSongSerializer, UploadSessionSerializer
+from .models import Song, UploadSession
+from .segments import get_manifest_name, get_segment_name
+from .waveform import read_level, WaveformError
+from .uploads import ChunkError, StagedUpload, create_staging_file, parse_checksum, write_chunk
+from vibly.filters import VisibleListFilter
+from vibly.mixins import EagerLoadingMixin
+from vibly.stream import ranged_file_response
 
-class SongViewSet(viewsets.ModelViewSet):
+
+class SongViewSet(EagerLoadingMixin, viewsets.ModelViewSet):
     lookup_field = 'public_id'
+    eager_loading_actions = EagerLoadingMixin.eager_loading_actions + ('duplicates',)
     queryset = Song.objects.all()
     serializer_class = SongSerializer
+    filter_backends = [VisibleListFilter]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -26,6 +37,101 @@ class SongViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(song)
         return Response(serializer.data)
 
+    def stream(self, request, *args, **kwargs):
+        song = self.get_object()
+
+        if request.user != song.author and not song.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        file = song.song_file
+        bitrate = request.query_params.get('bitrate')
+        if bitrate is not None:
+            try:
+                rendition = song.renditions.filter(bitrate=int(bitrate)).first()
+            except ValueError:
+                return Response({'bitrate': 'Must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+            if rendition is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            file = rendition.file
+
+        # Revalidated on every request, a song made private stops being served from shared caches. The ETag keeps
+        # it a 304 while it's unchanged.
+        cache_control = 'public, no-cache' if song.public else 'private, no-cache'
+        return ranged_file_response(request, file.storage, file.name, cache_control=cache_control)
+
+    def hls_manifest(self, request, *args, **kwargs):
+        song = self.get_object()
+
+        if request.user != song.author and not song.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        if not song.segmented:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        cache_control = 'public, no-cache' if song.public else 'private, no-cache'
+        return ranged_file_response(request,
+                                    song.song_file.storage,
+                                    get_manifest_name(song),
+                                    content_type='application/vnd.apple.mpegurl',
+                                    cache_control=cache_control)
+
+    def hls_segment(self, request, *args, **kwargs):
+        song = self.get_object()
+
+        if request.user != song.author and not song.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        name = get_segment_name(song, kwargs.get('segment'))
+        if not song.segmented or not song.song_file.storage.exists(name):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        # segments are never rewritten, caches can keep them forever
+        cache_control = f'{"public" if song.public else "private"}, max-age=31536000, immutable'
+        return ranged_file_response(request,
+                                    song.song_file.storage,
+                                    name,
+                                    content_type='audio/mpeg',
+                                    cache_control=cache_control)
+
+    def waveform(self, request, *args, **kwargs):
+        song = self.get_object()
+
+        if request.user != song.author and not song.public:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        if not song.waveform:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            level = request.query_params.get('level')
+            level = int(level) if level is not None else None
+
+            with song.waveform.open('rb') as file:
+                peaks, samples_per_peak, sample_rate, levels = read_level(file, level)
+        except (ValueError, WaveformError) as e:
+            return Response({'level': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # int8 (min, max) pairs, one per samples_per_peak samples at sample_rate
+        response = HttpResponse(peaks, content_type='application/octet-stream')
+        response['X-Waveform-Levels'] = levels
+        response['X-Waveform-Samples-Per-Peak'] = samples_per_peak
+        response['X-Waveform-Sample-Rate'] = sample_rate
+        response['Cache-Control'] = f'{"public" if song.public else "private"}, max-age=86400'
+        return response
+
+    def duplicates(self, request, *args, **kwargs):
+        song = self.get_object()
+
+        if song.author != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        matches = song.find_duplicates()
+        songs = self.get_queryset().in_bulk([match.pk for match, score in matches])
+        matches = [(songs[match.pk], score) for match, score in matches
+                   if match.public or match.author_id == request.user.pk]
+
+        return Response([{'score': score, 'song': self.get_serializer(match).data} for match, score in matches])
+
     def partial_update(self, request, *args, **kwargs):
         song = self.get_object()
 
@@ -47,7 +153,7 @@ class SongViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_permissions(self):
-        if self.action == 'retrieve':
+        if self.action in ('list', 'retrieve', 'stream', 'hls_manifest', 'hls_segment', 'waveform'):
             permission_classes = [AllowAny]
         else:
             permission_classes = [IsAuthenticated]
@@ -57,3 +163,84 @@ class SongViewSet(viewsets.ModelViewSet):
         if self.action == 'create':
             return CreateSongSerializer
         return SongSerializer
+
+
+class UploadSessionViewSet(viewsets.GenericViewSet):
+    lookup_field = 'public_id'
+    serializer_class = UploadSessionSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        # expired sessions take no more chunks, clear_upload_sessions deletes them
+        return UploadSession.objects.unexpired().filter(author=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        # the user's abandoned sessions make room for new ones
+        UploadSession.objects.expired().filter(author=request.user).delete()
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        session = serializer.save()
+        create_staging_file(session)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=self.get_upload_headers(session))
+
+    def retrieve(self, request, *args, **kwargs):
+        session = self.get_object()
+        serializer = self.get_serializer(session)
+        return Response(serializer.data, headers=self.get_upload_headers(session))
+
+    def upload_chunk(self, request, *args, **kwargs):
+        session = self.get_object()
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return Response({'detail': 'Upload-Offset header is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        if length > settings.SONG_UPLOAD_CHUNK_MAX_SIZE:
+            return Response({'detail': f'Chunks can\'t be larger than {settings.SONG_UPLOAD_CHUNK_MAX_SIZE} bytes'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        try:
+            checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+            write_chunk(session, request.stream, length, offset, checksum)
+        except ChunkError as e:
+            return Response({'detail': e.detail}, status=e.status_code, headers=self.get_upload_headers(session))
+
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=self.get_upload_headers(session))
+
+    def finalize(self, request, *args, **kwargs):
+        session = self.get_object()
+
+        if session.offset != session.size:
+            return Response({'detail': 'Upload isn\'t complete'},
+                            status=status.HTTP_409_CONFLICT,
+                            headers=self.get_upload_headers(session))
+
+        song_file = StagedUpload(session)
+        data = {key: request.data.get(key) for key in request.data}
+        data['song_file'] = song_file
+
+        try:
+            serializer = CreateSongSerializer(data=data, context=self.get_serializer_context())
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        finally:
+            song_file.close()
+
+        session.delete()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, *args, **kwargs):
+        session = self.get_object()
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @staticmethod
+    def get_upload_headers(session):
+        return {
+            'Upload-Offset': str(session.offset),
+            'Upload-Length': str(session.size),
+            'Cache-Control': 'no-store',
+        }
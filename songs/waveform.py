@@ -0,0 +1,120 @@
+import logging
+import mmap
+import struct
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from .pcm import decode, DecodeError
+
+logger = logging.getLogger(__name__)
+
+# File layout: header, one (offset, peaks) entry per level, then int8 (min, max) pairs of every level.
+# Level 0 has SONG_WAVEFORM_SAMPLES_PER_PEAK samples per peak, every next level halves the resolution.
+MAGIC = b'VPKS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+LEVEL = struct.Struct('<QI')
+
+
+class WaveformError(Exception):
+    pass
+
+
+def compute_levels(samples, samples_per_peak, levels):
+    # Returns a (peaks, 2) int8 array of min/max pairs for every level
+    if len(samples) == 0:
+        return [np.zeros((0, 2), np.int8) for _ in range(levels)]
+
+    # int16 to int8, the top byte is plenty for drawing
+    samples = (samples >> 8).astype(np.int8)
+
+    # the last block is padded with its own last sample, so it doesn't change min/max
+    padding = -len(samples) % samples_per_peak
+    if padding:
+        samples = np.concatenate((samples, np.full(padding, samples[-1], np.int8)))
+
+    blocks = samples.reshape(-1, samples_per_peak)
+    peaks = np.stack((blocks.min(axis=1), blocks.max(axis=1)), axis=1)
+    result = [peaks]
+
+    for _ in range(1, levels):
+        if len(peaks) % 2:
+            peaks = np.concatenate((peaks, peaks[-1:]))
+
+        pairs = peaks.reshape(-1, 2, 2)
+        peaks = np.stack((pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)), axis=1)
+        result.append(peaks)
+
+    return result
+
+
+def pack(levels, sample_rate, samples_per_peak):
+    offset = HEADER.size + LEVEL.size * len(levels)
+    header = [HEADER.pack(MAGIC, VERSION, len(levels), sample_rate, samples_per_peak)]
+
+    for peaks in levels:
+        header.append(LEVEL.pack(offset, len(peaks)))
+        offset += peaks.nbytes
+
+    return b''.join(header) + b''.join(peaks.tobytes() for peaks in levels)
+
+
+def read_level(file, level=None):
+    # Reads one level, only the bytes of the requested level are touched: through a memory map for local files,
+    # with ranged reads from object stores. level=None returns the coarsest level.
+    # Returns (bytes of min/max pairs, samples per peak, sample rate, levels)
+    try:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError):
+        data = None
+
+    def read(offset, length):
+        if data is not None:
+            return data[offset:offset + length]
+        file.seek(offset)
+        return file.read(length)
+
+    try:
+        magic, version, levels, sample_rate, samples_per_peak = HEADER.unpack(read(0, HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise WaveformError('Not a waveform file')
+
+        if level is None:
+            level = levels - 1
+
+        if not 0 <= level < levels:
+            raise WaveformError(f'Level must be between 0 and {levels - 1}')
+
+        offset, peaks = LEVEL.unpack(read(HEADER.size + LEVEL.size * level, LEVEL.size))
+        return read(offset, peaks * 2), samples_per_peak << level, sample_rate, levels
+    finally:
+        if data is not None:
+            data.close()
+
+
+def build_waveform(song):
+    if song.waveform:
+        return
+
+    # already computed for another song with the same content
+    name = f'{song.waveform.field.upload_to}{song.file_stem}.peaks'
+    if song.waveform.storage.exists(name):
+        song.waveform = name
+        song.save(update_fields=['waveform'])
+        return
+
+    sample_rate = settings.SONG_WAVEFORM_SAMPLE_RATE
+    samples_per_peak = settings.SONG_WAVEFORM_SAMPLES_PER_PEAK
+
+    try:
+        samples = decode(song, sample_rate)
+    except DecodeError as e:
+        logger.info('Skipping waveform of song %s: %s', song.pk, e)
+        return
+
+    levels = compute_levels(samples, samples_per_peak, settings.SONG_WAVEFORM_LEVELS)
+
+    song.waveform.save(name.split('/')[-1], ContentFile(pack(levels, sample_rate, samples_per_peak)), save=False)
+    song.save(update_fields=['waveform'])
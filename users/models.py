@@ -2,8 +2,11 @@ import uuid
 
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 from .managers import CustomUserManager
+from vibly.img import ImageStatus, remove_image
 
 
 class CustomUser(AbstractUser):
@@ -12,6 +15,10 @@ class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
     bio = models.TextField(blank=True, null=True, max_length=500)
     pfp = models.ImageField(upload_to='pfps/', default='defaults/pfps/default.png', blank=True)
+    pfp_status = models.CharField(max_length=16, choices=ImageStatus.choices, default=ImageStatus.READY,
+                                  editable=False)
+    pfp_job = models.UUIDField(blank=True, null=True, editable=False)
+    pfp_staged = models.CharField(max_length=255, blank=True, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
@@ -21,7 +28,9 @@ class CustomUser(AbstractUser):
     def __str__(self):
         return self.email
 
-    def delete(self, using=None, keep_parents=False):
-        if self.pfp.name != self.pfp.field.default:
-            self.pfp.delete()
-        return super().delete(using, keep_parents)
+
+@receiver(post_delete, sender=CustomUser)
+def release_pfp(sender, instance, **kwargs):
+    # also runs for QuerySet.delete() and cascades, which skip Model.delete()
+    if instance.pfp.name != instance.pfp.field.default:
+        remove_image(instance.pfp.name)
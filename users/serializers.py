@@ -2,14 +2,16 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
 
-from vibly.img import reshape_and_return_url, delete_image
+from vibly.img import schedule_reshape, get_variant_urls
 
 
 class UserSerializer(serializers.ModelSerializer):
+    pfp_variants = serializers.SerializerMethodField()
+
     class Meta:
         model = get_user_model()
-        fields = ['public_id', 'username', 'email', 'first_name', 'last_name', 'pfp']
-        read_only_fields = ['id', 'username', 'email']
+        fields = ['public_id', 'username', 'email', 'first_name', 'last_name', 'pfp', 'pfp_variants', 'pfp_status']
+        read_only_fields = ['id', 'username', 'email', 'pfp_status']
 
     def validate_password(self, password):
         try:
@@ -23,25 +25,25 @@ class UserSerializer(serializers.ModelSerializer):
         pfp = self.validated_data.get('pfp')
         self.validated_data.pop('pfp', None)
 
-        if pfp:
-            if self.instance:
-                delete_image(self.instance.pfp)
+        user = super().save(**kwargs)
 
-            self.validated_data['pfp'] = reshape_and_return_url(pfp,
-                                                                pfp.name,
-                                                                self.Meta.model.pfp.field.upload_to,
-                                                                height=512,
-                                                                width=512)
+        # processed by a worker, the old picture stays until the new one is ready
+        if pfp:
+            schedule_reshape(user, 'pfp', pfp, height=512, width=512)
 
-        return super().save(**kwargs)
+        return user
 
     def create(self, validated_data):
         user = get_user_model().objects.create_user(**validated_data)
         return user
 
+    def get_pfp_variants(self, instance):
+        return get_variant_urls(instance.pfp, self.context.get('request'))
+
 
 class CreateUserSerializer(UserSerializer):
     class Meta:
         model = get_user_model()
-        fields = ['public_id', 'username', 'password', 'email', 'first_name', 'last_name', 'pfp', 'public_id']
+        fields = ['public_id', 'username', 'password', 'email', 'first_name', 'last_name', 'pfp', 'pfp_variants',
+                  'pfp_status', 'public_id']
         extra_kwargs = {'password': {'write_only': True}}
@@ -1,10 +1,20 @@
+import datetime
+import io
 import os.path
+import uuid
+from unittest import mock
 
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from PIL import Image
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from vibly import settings
+from vibly.img import get_variant_formats, get_variant_name
 
 
 class UserCreate:
@@ -44,6 +54,7 @@ class UserCreate:
         }
 
 
+@override_settings(TASKS_ALWAYS_EAGER=True)
 class UserTests(APITestCase):
     def setUp(self):
         def end():
@@ -167,6 +178,124 @@ class UserTests(APITestCase):
         self.assertTrue(os.path.exists(default_url), 'Default pfp not found. '
                                                      'Probably has been deleted by vibly/img.py')
 
+    @override_settings(TASKS_ALWAYS_EAGER=False)
+    def test_pfp_processed_in_background(self):
+        user_dict = self.create_user_dict()
+        user = user_dict.get('user')
+        token = user_dict.get('token')
+
+        directories = [os.path.join(settings.MEDIA_ROOT, user.pfp.field.upload_to),
+                       os.path.join(settings.MEDIA_ROOT, 'images/staging')]
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        files = [set(os.listdir(directory)) for directory in directories]
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with open('testfiles/armstrong.jpg', 'rb') as pfp:
+                response = self.client.patch('/user/', {'pfp': pfp}, HTTP_AUTHORIZATION=f'Bearer {token}')
+            with open('testfiles/armstrong.jpg', 'rb') as pfp:
+                response = self.client.patch('/user/', {'pfp': pfp}, HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        # the default picture is kept until the job is done
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('pfp_status'), 'pending')
+        user.refresh_from_db()
+        self.assertEqual(user.pfp.name, user.pfp.field.default)
+        self.assertEqual(len(callbacks), 2)
+
+        # the discarded result is deleted after the commit
+        with mock.patch('vibly.tasks.get_executor') as get_executor, self.captureOnCommitCallbacks(execute=True):
+            get_executor.return_value.submit.side_effect = lambda fn, *args: fn(*args)
+            for callback in callbacks:
+                callback()
+
+        # only the latest upload is swapped in, the result of the first job is discarded
+        user.refresh_from_db()
+        self.assertEqual(user.pfp_status, 'ready')
+        self.assertNotEqual(user.pfp.name, user.pfp.field.default)
+        variants = {os.path.basename(get_variant_name(user.pfp.name, size, image_format))
+                    for size in settings.IMAGE_VARIANT_SIZES for image_format in get_variant_formats()}
+        self.assertEqual(set(os.listdir(directories[0])) - files[0], {os.path.basename(user.pfp.path)} | variants)
+        self.assertEqual(set(os.listdir(directories[1])), files[1])
+
+    @override_settings(TASKS_ALWAYS_EAGER=False)
+    def test_lost_pfp_job_retried(self):
+        user_dict = self.create_user_dict()
+        user = user_dict.get('user')
+        token = user_dict.get('token')
+
+        # the jobs are queued on commit and never run, as if the process restarted
+        with self.captureOnCommitCallbacks():
+            with open('testfiles/armstrong.jpg', 'rb') as pfp:
+                response = self.client.patch('/user/', {'pfp': pfp}, HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.data.get('pfp_status'), 'pending')
+        user.refresh_from_db()
+        staged = user.pfp_staged
+        self.assertTrue(default_storage.exists(staged))
+
+        # pending for less than IMAGE_JOB_TIMEOUT, the job may still be running
+        call_command('retry_image_jobs', stdout=io.StringIO())
+        user.refresh_from_db()
+        self.assertEqual(user.pfp_status, 'pending')
+
+        with override_settings(IMAGE_JOB_TIMEOUT=datetime.timedelta(0)):
+            call_command('retry_image_jobs', stdout=io.StringIO())
+        user.refresh_from_db()
+        self.assertEqual((user.pfp_status, user.pfp_job, user.pfp_staged), ('ready', None, ''))
+        self.assertNotEqual(user.pfp.name, user.pfp.field.default)
+        self.assertFalse(default_storage.exists(staged))
+
+        # an upload that is gone can't be processed again
+        get_user_model().objects.filter(pk=user.pk).update(pfp_status='pending', pfp_job=uuid.uuid4(),
+                                                           pfp_staged=staged)
+        with override_settings(IMAGE_JOB_TIMEOUT=datetime.timedelta(0)):
+            call_command('retry_image_jobs', stdout=io.StringIO())
+        user.refresh_from_db()
+        self.assertEqual((user.pfp_status, user.pfp_job, user.pfp_staged), ('failed', None, ''))
+
+    @staticmethod
+    def create_rotated_jpeg():
+        # displayed upright it's red on top and blue at the bottom, stored it's rotated by 90 degrees
+        upright = Image.new('RGB', (100, 200), 'red')
+        upright.paste('blue', (0, 100, 100, 200))
+
+        exif = Image.Exif()
+        exif[0x0112] = 6
+
+        buffer = io.BytesIO()
+        upright.transpose(Image.Transpose.ROTATE_90).save(buffer, 'JPEG', exif=exif)
+        return SimpleUploadedFile('rotated.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_pfp_exif_orientation(self):
+        user_dict = self.create_user_dict()
+        user = user_dict.get('user')
+
+        response = self.client.patch('/user/', {'pfp': self.create_rotated_jpeg()},
+                                     HTTP_AUTHORIZATION=f'Bearer {user_dict.get("token")}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        user.refresh_from_db()
+        with Image.open(user.pfp.path) as pfp:
+            self.assertEqual(pfp.size, (512, 512))
+            red, green, blue = pfp.getpixel((256, 50))
+            self.assertGreater(red, blue)
+            red, green, blue = pfp.getpixel((256, 460))
+            self.assertGreater(blue, red)
+
+    def test_pfp_too_large(self):
+        user_dict = self.create_user_dict()
+        user = user_dict.get('user')
+
+        with mock.patch.object(settings, 'IMAGE_MAX_PIXELS', 100 * 100):
+            response = self.client.patch('/user/', {'pfp': self.create_rotated_jpeg()},
+                                         HTTP_AUTHORIZATION=f'Bearer {user_dict.get("token")}')
+
+        # rejected before decoding, the default picture stays
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('pfp_status'), 'failed')
+        user.refresh_from_db()
+        self.assertEqual(user.pfp.name, user.pfp.field.default)
+
     def test_delete_user(self):
         user_dict = self.create_user_dict()
         token = user_dict.get('token')
@@ -0,0 +1,28 @@
+import uuid
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+class VisibleListFilter(BaseFilterBackend):
+    # Listings show public objects and the user's own ones, ?author=<public_id> lists a single author's.
+    # Single objects check their visibility themselves and answer 403 rather than 404.
+    def filter_queryset(self, request, queryset, view):
+        if view.action != 'list':
+            return queryset
+
+        visible = Q(public=True)
+        if request.user.is_authenticated:
+            visible |= Q(author=request.user)
+        queryset = queryset.filter(visible)
+
+        author = request.query_params.get('author')
+        if author is not None:
+            try:
+                author = uuid.UUID(author)
+            except ValueError:
+                raise ValidationError({'author': 'Must be the public_id of a user'})
+            queryset = queryset.filter(author__public_id=author)
+
+        return queryset
@@ -0,0 +1,166 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+from django.core.files.storage import default_storage
+from PIL import features
+
+import vibly.settings as settings
+from vibly.img import scale_to_width
+
+# format: (extension, Pillow feature it depends on)
+FORMATS = {
+    'jpeg': ('jpg', 'jpg'),
+    'png': ('png', 'zlib'),
+    'webp': ('webp', 'webp'),
+}
+LOCK_DIRECTORY = 'locks'
+LOCK_STRIPES = 256
+# hits move an entry to the front of the LRU by setting its access time, at most once per interval.
+# The modification time stays, it's part of the ETag.
+TOUCH_INTERVAL = 60
+# eviction goes below the limit, so it doesn't run again on the next miss
+EVICT_TO = 0.9
+# running total of the cached bytes and the lock of the process evicting, next to the stripe locks
+SIZE_FILE = 'size'
+EVICTION_LOCK_FILE = 'evict.lock'
+
+
+def get_formats():
+    return [image_format for image_format, (extension, feature) in FORMATS.items() if features.check(feature)]
+
+
+def get_cache_name(path, width, image_format):
+    # the source's modification time is part of the key, images replaced under the same name aren't served stale
+    mtime = default_storage.get_modified_time(path).timestamp()
+    key = hashlib.sha256(f'{path}:{mtime}:{width}:{image_format}'.encode()).hexdigest()
+    return f'{key[:2]}/{key}.{FORMATS[image_format][0]}'
+
+
+def lock(name):
+    # Striped lock files, so there's a bounded number of them. flock conflicts between separate opens of the file,
+    # it serializes threads of this process as well as other processes.
+    directory = os.path.join(settings.IMAGE_CACHE_ROOT, LOCK_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    stripe = int(os.path.basename(name)[:8], 16) % LOCK_STRIPES
+    lock_file = open(os.path.join(directory, f'{stripe}.lock'), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def touch(path):
+    try:
+        stat = os.stat(path)
+        now = time.time()
+        if now - stat.st_atime > TOUCH_INTERVAL:
+            os.utime(path, (now, stat.st_mtime))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def get_resized(path, width, image_format):
+    """
+    Returns the cache name of the image at path scaled to width in image_format, resizing it on the first request.
+    A burst of identical requests resizes once, the others wait for the lock and find the result.
+    """
+    name = get_cache_name(path, width, image_format)
+    cache_path = os.path.join(settings.IMAGE_CACHE_ROOT, name)
+
+    if touch(cache_path):
+        return name
+
+    with lock(name):
+        if touch(cache_path):
+            return name
+
+        with default_storage.open(path, 'rb') as file:
+            pil_img = scale_to_width(file, width)
+
+        if image_format == 'jpeg' and pil_img.mode not in ('RGB', 'L'):
+            pil_img = pil_img.convert('RGB')
+
+        # written aside and renamed, readers never see a partial file
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), suffix='.tmp', delete=False) as temporary:
+            pil_img.save(temporary, image_format.upper())
+        os.replace(temporary.name, cache_path)
+
+    # the cache is only scanned once it's over the limit, not on every miss
+    if add_size(os.path.getsize(cache_path)) > settings.IMAGE_CACHE_MAX_SIZE:
+        evict()
+    return name
+
+
+def update_size(update):
+    # The running total is shared by every process and rewritten under the lock of its file, a missing one is
+    # counted from the entries. Returns the new total.
+    directory = os.path.join(settings.IMAGE_CACHE_ROOT, LOCK_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, SIZE_FILE), 'a+') as size_file:
+        fcntl.flock(size_file, fcntl.LOCK_EX)
+        size_file.seek(0)
+        content = size_file.read()
+        total = update(int(content) if content else sum(size for atime, size, path in scan()))
+
+        size_file.seek(0)
+        size_file.truncate()
+        size_file.write(str(total))
+
+    return total
+
+
+def add_size(size):
+    return update_size(lambda total: total + size)
+
+
+def scan():
+    # (access time, size, path) of every entry
+    entries = []
+    for directory in os.scandir(settings.IMAGE_CACHE_ROOT):
+        if not directory.is_dir() or directory.name == LOCK_DIRECTORY:
+            continue
+
+        for entry in os.scandir(directory.path):
+            # being written
+            if entry.name.endswith('.tmp'):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry.path))
+
+    return entries
+
+
+def evict():
+    # Deletes the least recently used entries until the cache is below EVICT_TO of IMAGE_CACHE_MAX_SIZE and
+    # resets the running total to what is left. Misses during another process' eviction don't wait for it.
+    eviction_lock = open(os.path.join(settings.IMAGE_CACHE_ROOT, LOCK_DIRECTORY, EVICTION_LOCK_FILE), 'a')
+    with eviction_lock:
+        try:
+            fcntl.flock(eviction_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        entries = scan()
+        total = sum(size for atime, size, path in entries)
+
+        for atime, size, path in sorted(entries):
+            if total <= settings.IMAGE_CACHE_MAX_SIZE * EVICT_TO:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        # entries added during the scan are counted by the next one
+        update_size(lambda current: total)
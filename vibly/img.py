@@ -1,36 +1,140 @@
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError, features
 from uuid import uuid4
+import io
+import logging
 import os
+from django.apps import apps
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
+from django.db import models
+from django.utils import timezone
 
 import vibly.settings as settings
+from blobs.models import Blob, PendingDeletion
+from vibly.tasks import submit
+
+logger = logging.getLogger(__name__)
+
+# uploaded images wait here until a worker has processed them
+STAGING_DIRECTORY = 'images/staging/'
+
+
+# extension (and Pillow feature) of every variant format
+VARIANT_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
+VARIANT_QUALITY = 85
+# resize() first reduces by an integer factor down to REDUCING_GAP times the target, then resamples
+REDUCING_GAP = 3.0
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class ImageStatus(models.TextChoices):
+    READY = 'ready'
+    PENDING = 'pending'
+    FAILED = 'failed'
 
 
 def image_to_pillow(file):
     return Image.open(file)
 
 
+def open_image(file):
+    # Only reads the header, images over the byte or pixel limit are rejected before anything is decoded
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if size > settings.IMAGE_MAX_BYTES:
+        raise ImageTooLarge(f'Image is larger than {settings.IMAGE_MAX_BYTES} bytes')
+
+    pil_img = image_to_pillow(file)
+    if pil_img.width * pil_img.height > settings.IMAGE_MAX_PIXELS:
+        raise ImageTooLarge(f'Image has more than {settings.IMAGE_MAX_PIXELS} pixels')
+
+    return pil_img
+
+
+def load_square(file, size):
+    # Returns the centered square of the image at size x size px, upright according to its EXIF orientation.
+    # JPEGs are decoded at the smallest DCT scale that is still large enough (draft), so a phone photo
+    # never exists in memory at full resolution. Cropping and scaling is a single resize.
+    pil_img = open_image(file)
+
+    side = min(pil_img.size)
+    if pil_img.format == 'JPEG' and side > size:
+        pil_img.draft('RGB', (pil_img.width * size // side, pil_img.height * size // side))
+
+    # exif_transpose copies the image even when it's upright
+    if pil_img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        pil_img = ImageOps.exif_transpose(pil_img)
+    if pil_img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        pil_img = pil_img.convert('RGBA' if 'transparency' in pil_img.info else 'RGB')
+
+    side = min(pil_img.size)
+    left, top = (pil_img.width - side) // 2, (pil_img.height - side) // 2
+    return pil_img.resize((size, size), Image.LANCZOS, box=(left, top, left + side, top + side),
+                          reducing_gap=REDUCING_GAP)
+
+
+def scale_to_width(file, width):
+    # Keeps the aspect ratio and never upscales. Stored images are already upright, the pipeline applied
+    # their EXIF orientation.
+    pil_img = open_image(file)
+    width = min(width, pil_img.width)
+    height = max(1, round(pil_img.height * width / pil_img.width))
+
+    if pil_img.format == 'JPEG':
+        pil_img.draft('RGB', (width, height))
+
+    return resize(pil_img, width, height)
+
+
 def get_renamed_filename(filename):
     # Filename: <uuid>.<extension>
     return f'{uuid4()}.{filename.split(".")[-1]}'
 
 
 def remove_image(url, check_default=False, field=None):
+    # Drops a reference to the image, the file and its variants are deleted with the last one
+    name = url.replace('/media/', '')
+    if not name:
+        return
+
     # return if url is default image
-    url = os.path.join(settings.MEDIA_ROOT, url.replace('/media/', ''))
     if check_default:
         if field is None:
             raise Exception('field is required if check_default is True')
 
-        default = os.path.join(settings.MEDIA_ROOT, field.field.default)
+        if name == field.field.default:
+            return
 
-        if url == default:
+    # images stored before they were content addressed have no blob. A blob stored while a file of the same
+    # content was waiting to be deleted has a suffix after the hash.
+    names = []
+    blob = Blob.objects.filter(sha256=os.path.basename(name)[:64], name=name).first()
+    if blob is not None:
+        if not Blob.objects.release(blob):
             return
+    else:
+        names.append(name)
 
-    try:
-        os.remove(url)
-    except (FileNotFoundError, IsADirectoryError):
-        pass
+    # deleted once the transaction commits
+    PendingDeletion.objects.enqueue(names + [get_variant_name(name, size, image_format)
+                                             for size in settings.IMAGE_VARIANT_SIZES
+                                             for image_format in get_variant_formats()])
+
+
+def share_image(name):
+    # Adds a reference to a stored image for another row, which drops it with remove_image like the first one.
+    # Defaults and images stored before they were content addressed can't be shared, returns False for them.
+    blob = Blob.objects.filter(sha256=os.path.basename(name)[:64], name=name).first()
+    if blob is None:
+        return False
+
+    Blob.objects.retain(blob)
+    return True
 
 
 def crop_center(pil_img, crop_width, crop_height):
@@ -46,33 +150,99 @@ def crop_max_square(pil_img):
 
 
 def resize(pil_img, width=128, height=128):
-    return pil_img.resize((width, height), Image.ANTIALIAS)
+    return pil_img.resize((width, height), Image.LANCZOS, reducing_gap=REDUCING_GAP)
 
 
 def save_image(pil_img, filename, upload_to):
-    # Create directory for image if it doesn't exist
-    directory = os.path.join(settings.MEDIA_ROOT, upload_to)
-    os.makedirs(directory, exist_ok=True)
+    # Stored as <upload_to><sha256>.<extension>, identical images share one file. Returns the name,
+    # the caller holds a reference to it and drops it with remove_image.
+    extension = filename.split('.')[-1].lower()
+    image_format = Image.registered_extensions().get(f'.{extension}')
+    if image_format is None:
+        extension, image_format = 'png', 'PNG'
 
-    url = os.path.join(settings.MEDIA_ROOT, upload_to, get_renamed_filename(filename))
-    pil_img.save(url)
+    # jpeg has no alpha channel
+    if image_format == 'JPEG' and pil_img.mode not in ('RGB', 'L'):
+        pil_img = pil_img.convert('RGB')
 
-    return url.replace(settings.MEDIA_ROOT, '').replace('/', '', 1)
+    buffer = io.BytesIO()
+    pil_img.save(buffer, image_format)
 
+    return Blob.objects.acquire(ContentFile(buffer.getvalue(), name=f'image.{extension}'), upload_to).name
 
-def reshape_and_return_url(file, filename, upload_to, width=128, height=128, delete_old=False, field=None):
-    pil_img = image_to_pillow(file)
-    pil_img = crop_max_square(pil_img)
-    pil_img = resize(pil_img, width, height)
+
+def get_variant_formats():
+    # webp depends on how Pillow was built
+    return [image_format for image_format in settings.IMAGE_VARIANT_FORMATS
+            if features.check(VARIANT_EXTENSIONS[image_format])]
+
+
+def get_variant_name(name, size, image_format):
+    # Variants sit next to the image: <name without extension>_<size>.<format extension>
+    return f'{os.path.splitext(name)[0]}_{size}.{VARIANT_EXTENSIONS[image_format]}'
+
+
+def has_variants(name):
+    # the smallest variant is written last. Without a format Pillow supports there are none.
+    formats = get_variant_formats()
+    return bool(formats) and default_storage.exists(get_variant_name(name, min(settings.IMAGE_VARIANT_SIZES),
+                                                                     formats[-1]))
+
+
+def save_variants(pil_img, name):
+    # Downscales a square image to every variant size, each size from the previous one, largest first
+    if pil_img.mode not in ('RGB', 'L'):
+        pil_img = pil_img.convert('RGB')
+
+    for size in sorted(settings.IMAGE_VARIANT_SIZES, reverse=True):
+        if pil_img.size != (size, size):
+            pil_img = resize(pil_img, size, size)
+        for image_format in get_variant_formats():
+            # variants of content addressed images never change, one that is already stored is kept
+            variant = get_variant_name(name, size, image_format)
+            if default_storage.exists(variant):
+                continue
+
+            buffer = io.BytesIO()
+            pil_img.save(buffer, image_format.upper(), quality=VARIANT_QUALITY)
+            default_storage.save(variant, ContentFile(buffer.getvalue()))
+
+
+def get_variant_urls(field, request=None):
+    # {size: {format: url}}. Default images have no variants, nor any image when Pillow supports none of the
+    # formats, every size points to the image itself.
+    def build_url(name):
+        url = field.storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+
+    formats = get_variant_formats()
+    if field.name == field.field.default or not formats:
+        extension = field.name.split('.')[-1].lower()
+        return {size: {extension: build_url(field.name)} for size in settings.IMAGE_VARIANT_SIZES}
+
+    return {size: {image_format: build_url(get_variant_name(field.name, size, image_format))
+                   for image_format in formats}
+            for size in settings.IMAGE_VARIANT_SIZES}
+
+
+def reshape_and_return_url(file, filename, upload_to, width=128, height=128, delete_old=False, field=None,
+                           variants=True):
+    # Decodes the image once, at the largest size needed, and writes every file at most once
+    size = max([width, height] + (list(settings.IMAGE_VARIANT_SIZES) if variants else []))
+    square = load_square(file, size)
+
+    pil_img = square if square.size == (width, height) else resize(square, width, height)
     url = save_image(pil_img, filename, upload_to)
-    django_file = default_storage.open(url)
+
+    # the same image was stored before, its variants as well
+    if variants and not has_variants(url):
+        save_variants(square, url)
 
     if delete_old:
         if field is not None:
             delete_image(field)
 
-    remove_image(os.path.join(settings.MEDIA_URL, upload_to, filename))
-    return django_file.name.replace(settings.MEDIA_ROOT, '').replace('/', '', 1)
+    return url
 
 
 def delete_image(field):
@@ -80,3 +250,80 @@ def delete_image(field):
         remove_image(field.url, check_default=True, field=field)
     except ValueError:
         pass
+
+
+def schedule_reshape(instance, field_name, file, width=128, height=128):
+    # Reshapes the image on the worker pool. The current image is kept until the job swaps in the new one,
+    # <field>_status shows the progress, <field>_job the job allowed to swap and <field>_staged its upload,
+    # so a job lost with its process can be run again (see retry_reshapes)
+    model = type(instance)
+    job = uuid4()
+    staged = default_storage.save(f'{STAGING_DIRECTORY}{get_renamed_filename(file.name)}', file)
+
+    model.objects.filter(pk=instance.pk).update(**{f'{field_name}_status': ImageStatus.PENDING,
+                                                   f'{field_name}_job': job,
+                                                   f'{field_name}_staged': staged})
+    submit(process_reshape, model._meta.label, instance.pk, field_name, job, staged, file.name, width, height)
+
+    # eager jobs have already swapped the image
+    instance.refresh_from_db(fields=[field_name, f'{field_name}_status', f'{field_name}_job',
+                                     f'{field_name}_staged'])
+
+
+def process_reshape(model_label, pk, field_name, job, staged, filename, width, height):
+    model = apps.get_model(model_label)
+    field = model._meta.get_field(field_name)
+    status_field, job_field, staged_field = f'{field_name}_status', f'{field_name}_job', f'{field_name}_staged'
+    queryset = model.objects.filter(pk=pk, **{job_field: job})
+
+    try:
+        with default_storage.open(staged) as file:
+            name = reshape_and_return_url(file, filename, field.upload_to, width, height)
+    except (UnidentifiedImageError, Image.DecompressionBombError, ImageTooLarge, OSError) as e:
+        logger.info('Reshaping %s of %s %s failed: %s', field_name, model_label, pk, e)
+        queryset.update(**{status_field: ImageStatus.FAILED, job_field: None, staged_field: ''})
+        return
+    finally:
+        default_storage.delete(staged)
+
+    # only the latest job of the field swaps, a newer upload or a deleted row discard the result
+    old = queryset.values_list(field_name, flat=True).first()
+    swapped = old is not None and queryset.filter(**{field_name: old}).update(**{field_name: name,
+                                                                                status_field: ImageStatus.READY,
+                                                                                job_field: None,
+                                                                                staged_field: ''})
+    if not swapped:
+        remove_image(name)
+    elif old and old != field.default:
+        remove_image(old)
+
+
+def retry_reshapes(model, field_name, width, height, timeout):
+    # Jobs are only queued in the memory of the process that committed them, a restart before they end leaves
+    # their rows pending. Runs the jobs pending for longer than timeout again, here, and fails the ones whose
+    # upload is gone. Returns (retried, failed).
+    status_field, job_field, staged_field = f'{field_name}_status', f'{field_name}_job', f'{field_name}_staged'
+    pending = model.objects.filter(**{status_field: ImageStatus.PENDING, f'{job_field}__isnull': False}) \
+        .values_list('pk', job_field, staged_field)
+    retried = failed = 0
+
+    for pk, job, staged in pending.iterator():
+        # the upload is staged right before the job is queued. Rows queued before uploads were recorded on them
+        # have none, media_gc may have deleted it.
+        try:
+            staged_at = default_storage.get_modified_time(staged) if staged else None
+        except FileNotFoundError:
+            staged_at = None
+
+        if staged_at is None:
+            failed += model.objects.filter(pk=pk, **{job_field: job}) \
+                .update(**{status_field: ImageStatus.FAILED, job_field: None, staged_field: ''})
+            continue
+        if staged_at > timezone.now() - timeout:
+            continue
+
+        # the staged upload was renamed keeping its extension, the format the image is stored in
+        process_reshape(model._meta.label, pk, field_name, job, staged, staged, width, height)
+        retried += 1
+
+    return retried, failed
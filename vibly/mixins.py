@@ -0,0 +1,87 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, RelatedField
+
+
+def get_related_lookups(serializer, model, prefix=''):
+    # Returns (select_related, prefetch_related) lookups of the relations serializer renders, nested serializers
+    # included. Relations read by method fields are declared in Meta.select_related and Meta.prefetch_related.
+    meta = getattr(serializer, 'Meta', None)
+    select = [prefix + lookup for lookup in getattr(meta, 'select_related', ())]
+    prefetch = [prefix + lookup for lookup in getattr(meta, 'prefetch_related', ())]
+
+    for field in serializer.fields.values():
+        if field.write_only or len(field.source_attrs) != 1:
+            continue
+
+        try:
+            relation = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            continue
+
+        if not relation.is_relation:
+            continue
+
+        if isinstance(field, serializers.ListSerializer):
+            child = field.child
+        elif isinstance(field, ManyRelatedField):
+            child = field.child_relation
+        elif isinstance(field, (serializers.BaseSerializer, RelatedField)):
+            child = field
+        else:
+            # fields that load their rows themselves
+            continue
+
+        # primary keys are read from the row itself
+        if isinstance(child, RelatedField) and child.use_pk_only_optimization():
+            continue
+
+        lookup = prefix + field.source
+
+        if relation.many_to_one or relation.one_to_one:
+            select.append(lookup)
+            if isinstance(child, serializers.BaseSerializer):
+                nested_select, nested_prefetch = get_related_lookups(child, relation.related_model, f'{lookup}__')
+                select += nested_select
+                prefetch += nested_prefetch
+        else:
+            # every level of a nested collection is one query, whatever its size
+            queryset = relation.related_model._default_manager.all()
+            if isinstance(child, serializers.BaseSerializer):
+                queryset = eager_load(queryset, child)
+            prefetch.append(Prefetch(lookup, queryset=queryset))
+
+    return select, prefetch
+
+
+def eager_load(queryset, serializer):
+    select, prefetch = get_related_lookups(serializer, queryset.model)
+
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    return queryset
+
+
+class EagerLoadingMixin:
+    # Loads the relations of the serializer with the objects, so rendering them runs a constant number of queries.
+    # Other actions (streaming, deleting) don't render the serializer and load the objects alone.
+    eager_loading_actions = ('list', 'retrieve', 'update', 'partial_update')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        if self.action not in self.eager_loading_actions:
+            return queryset
+
+        return eager_load(queryset, self.get_serializer_class()())
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+
+        # relations prefetched before the update may have changed, like UpdateModelMixin.update does
+        if getattr(serializer.instance, '_prefetched_objects_cache', None):
+            serializer.instance._prefetched_objects_cache = {}
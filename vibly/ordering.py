@@ -0,0 +1,59 @@
+import hashlib
+from collections import defaultdict
+
+from rest_framework import serializers
+
+
+class StaleOrder(Exception):
+    def __init__(self, version):
+        super().__init__(f'The tracks changed, their version is now {version}')
+        self.version = version
+
+
+def get_order_version(tracks):
+    # Version of an ordered list of tracks, it changes whenever one is added, removed or moved
+    value = ','.join(f'{track.pk}:{track.song_id}' for track in tracks)
+    return hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+
+
+def arrange(tracks, song_public_ids):
+    """
+    Returns tracks in the order of song_public_ids, which has to list the song of every track once. Tracks of the
+    same song keep their order. Raises ValueError otherwise.
+    """
+    by_song = defaultdict(list)
+    for track in reversed(tracks):
+        by_song[track.song.public_id].append(track)
+
+    try:
+        arranged = [by_song[public_id].pop() for public_id in song_public_ids]
+    except IndexError:
+        raise ValueError('Songs have to be the songs of the tracks, each as many times as it is in them')
+
+    if len(arranged) != len(tracks):
+        raise ValueError(f'All {len(tracks)} tracks have to be listed')
+
+    return arranged
+
+
+class ReorderSerializer(serializers.Serializer):
+    songs = serializers.ListField(child=serializers.UUIDField(), allow_empty=True)
+    # the version the order was read at, ETag of the list of tracks, sent as If-Match otherwise
+    version = serializers.CharField(required=False)
+
+
+class RemoveTracksSerializer(serializers.Serializer):
+    # the tracks at orders, from start to end (both included) and of songs are removed together
+    orders = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False)
+    start = serializers.IntegerField(min_value=1, required=False)
+    end = serializers.IntegerField(min_value=1, required=False)
+    songs = serializers.ListField(child=serializers.UUIDField(), required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError('Give the orders, the start and end or the songs of the tracks to remove')
+        if ('start' in attrs) != ('end' in attrs):
+            raise serializers.ValidationError('start and end have to be given together')
+        if attrs.get('start', 0) > attrs.get('end', 0):
+            raise serializers.ValidationError('start can\'t be after end')
+        return attrs
@@ -0,0 +1,134 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .mixins import eager_load
+
+
+class KeysetPagination(BasePagination):
+    # Pages start after the row the cursor points at instead of at an offset, so every page is an index range
+    # scan however deep it is, and rows inserted meanwhile don't shift pages. ordering has to be unique.
+    ordering = ('-created_at', '-id')
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        cursor = request.query_params.get(self.cursor_query_param)
+        return self.get_page(queryset, self.get_page_size(request), self.decode_cursor(queryset.model, cursor))
+
+    def get_page(self, queryset, page_size=None, position=None):
+        page_size = page_size or self.page_size
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(position))
+
+        # one more row tells whether there is a next page
+        rows = list(queryset[:page_size + 1])
+        page = rows[:page_size]
+
+        self.next_cursor = self.encode_cursor(page[-1]) if len(rows) > page_size else None
+        return page
+
+    def get_keyset_filter(self, position):
+        # rows after position in ordering, (a, b) > (x, y) is a > x or (a = x and b > y)
+        query = Q()
+        for index, field in enumerate(self.ordering):
+            lookups = {name.lstrip('-'): value for name, value in zip(self.ordering[:index], position)}
+            lookups[f'{field.lstrip("-")}__{"lt" if field.startswith("-") else "gt"}'] = position[index]
+            query |= Q(**lookups)
+        return query
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return min(page_size, self.max_page_size) if page_size > 0 else self.page_size
+
+    def encode_cursor(self, instance):
+        values = [instance._meta.get_field(field.lstrip('-')).value_to_string(instance) for field in self.ordering]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, model, cursor):
+        if cursor is None:
+            return None
+
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError(cursor)
+
+            return [model._meta.get_field(field.lstrip('-')).to_python(value)
+                    for field, value in zip(self.ordering, values)]
+        except (binascii.Error, UnicodeError, TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_data(self, data):
+        return OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ])
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
+
+
+class TrackPagination(KeysetPagination):
+    ordering = ('order', 'id')
+    page_size = 100
+    max_page_size = 500
+
+
+class PaginatedRelationField(serializers.Field):
+    # Renders the first page of a related collection, like the paginated list at get_url(instance) does.
+    # The following pages are read from that list.
+    def __init__(self, child, get_url, pagination_class=TrackPagination, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+        self.child = child
+        self.get_url = get_url
+        self.pagination_class = pagination_class
+
+    def bind(self, field_name, parent):
+        super().bind(field_name, parent)
+        self.child.bind(field_name='', parent=self)
+
+    def to_representation(self, manager):
+        paginator = self.pagination_class()
+        paginator.base_url = self.context['request'].build_absolute_uri(self.get_url(manager.instance))
+
+        page = paginator.get_page(eager_load(manager.all(), self.child))
+        return paginator.get_paginated_data([self.child.to_representation(item) for item in page])
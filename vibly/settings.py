@@ -52,6 +52,7 @@ INSTALLED_APPS = [
     'songs',
     'playlists',
     'albums',
+    'blobs',
 ]
 
 MIDDLEWARE = [
@@ -82,6 +83,8 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.FormParser',
         'rest_framework.parsers.MultiPartParser',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'vibly.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
 }
 
 SIMPLE_JWT = {
@@ -160,6 +163,30 @@ STATIC_URL = 'static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Media is read and written through the storage API only. vibly.storage.S3Storage keeps it in an S3 compatible
+# bucket (AWS, MinIO...), so several app nodes can share it.
+DEFAULT_FILE_STORAGE = os.getenv('DEFAULT_FILE_STORAGE', 'django.core.files.storage.FileSystemStorage')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', 'http://localhost:9000')
+S3_BUCKET = os.getenv('S3_BUCKET', 'vibly')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY', '')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+# files are linked from here if set (public bucket or CDN), otherwise the app serves them under MEDIA_URL
+S3_PUBLIC_URL = os.getenv('S3_PUBLIC_URL')
+S3_MAX_CONNECTIONS = int(os.getenv('S3_MAX_CONNECTIONS', 10))
+# files over the threshold are uploaded in parts, S3 requires parts of at least 5 MB
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files are deleted by a background worker once the transaction that stopped referencing them commits
+MEDIA_DELETION_BATCH_SIZE = 500
+MEDIA_DELETION_MAX_ATTEMPTS = 5
+
+FILE_UPLOAD_HANDLERS = [
+    'vibly.uploadhandlers.HashingMemoryFileUploadHandler',
+    'vibly.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -171,3 +198,59 @@ CORS_ORIGIN_ALLOWED_ORIGINS = [
 ]
 
 AUTH_USER_MODEL = 'users.CustomUser'
+
+# Resumable song uploads
+SONG_UPLOAD_MAX_SIZE = 200 * 1024 * 1024
+SONG_UPLOAD_CHUNK_MAX_SIZE = 8 * 1024 * 1024
+# Sessions a user can have open at once, and how long one can take before it's deleted with its staged file
+SONG_UPLOAD_MAX_OPEN_SESSIONS = 5
+SONG_UPLOAD_SESSION_MAX_AGE = timedelta(hours=24)
+# Chunks are appended to a local file until the upload is finalized and stored. With several app nodes
+# this directory has to be shared, or the requests of a session routed to one node.
+SONG_UPLOAD_STAGING_ROOT = os.getenv('SONG_UPLOAD_STAGING_ROOT', os.path.join(MEDIA_ROOT, 'songs/files/uploads'))
+
+# Background tasks (vibly.tasks). Test cases run them inline with override_settings(TASKS_ALWAYS_EAGER=True),
+# test transactions are never committed.
+TASKS_WORKERS = int(os.getenv('TASKS_WORKERS', 4))
+TASKS_ALWAYS_EAGER = os.getenv('TASKS_ALWAYS_EAGER', 'False').lower() in ('true', '1', 't')
+
+# Song renditions, bitrates in kbps. Only bitrates below the uploaded file's are produced.
+SONG_RENDITION_ENCODER = 'songs.renditions.FFmpegEncoder'
+SONG_RENDITION_BITRATES = (64, 128, 256)
+
+# Target length of HLS segments in seconds
+SONG_SEGMENT_DURATION = 10
+
+# Waveform peaks. Level 0 has SAMPLES_PER_PEAK samples per min/max pair, every next level halves the resolution.
+SONG_WAVEFORM_SAMPLE_RATE = 11025
+SONG_WAVEFORM_SAMPLES_PER_PEAK = 64
+SONG_WAVEFORM_LEVELS = 8
+
+# Acoustic fingerprints, songs sharing at least MIN_MATCHES time-aligned hashes are considered duplicates
+SONG_FINGERPRINT_SAMPLE_RATE = 8000
+SONG_FINGERPRINT_MIN_MATCHES = 20
+# hashes stored per song at most, music makes a few hundred per second
+SONG_FINGERPRINT_MAX_HASHES = 20000
+
+# Sizes (square, in px) and formats every uploaded cover and profile picture is also stored in. Images stored
+# before a size or format was added don't have it, their variant URLs 404 until `manage.py build_image_variants`
+# has run: run it after every deploy that changes these.
+IMAGE_VARIANT_SIZES = (64, 128, 256, 512)
+IMAGE_VARIANT_FORMATS = ('jpeg', 'webp')
+
+# Uploaded images over either limit are rejected before they are decoded
+IMAGE_MAX_BYTES = 20 * 1024 * 1024
+IMAGE_MAX_PIXELS = 50_000_000
+# Covers and profile pictures still pending this long after their upload are processed again by
+# retry_image_jobs, their job was lost with the process that queued it
+IMAGE_JOB_TIMEOUT = timedelta(hours=1)
+
+# Directories of the stored images, the only media the app serves under MEDIA_URL and resizes. Audio is only
+# served by the song endpoints, which check who may listen.
+IMAGE_DIRECTORIES = ('songs/covers/', 'albums/covers/', 'playlists/covers/', 'pfps/', 'defaults/')
+
+# On the fly resizing (/image/<path>?width=&format=), only of images in IMAGE_DIRECTORIES and to these widths.
+# Results are kept on disk, least recently used ones are evicted above IMAGE_CACHE_MAX_SIZE bytes.
+IMAGE_RESIZE_WIDTHS = (32, 48, 64, 96, 128, 192, 256, 384, 512)
+IMAGE_CACHE_ROOT = os.getenv('IMAGE_CACHE_ROOT', os.path.join(BASE_DIR, 'cache', 'images'))
+IMAGE_CACHE_MAX_SIZE = 256 * 1024 * 1024
@@ -0,0 +1,269 @@
+import contextlib
+import datetime
+import hashlib
+import hmac
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urljoin
+
+import urllib3
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+S3_NAMESPACE = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+# reads of stored files are fetched in ranges of this size
+READ_BUFFER_SIZE = 1024 * 1024
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+@contextlib.contextmanager
+def local_path(storage, name):
+    # Yields a path on the local filesystem for tools that can't read from a file object (ffmpeg).
+    # Storages without local files (S3Storage) are downloaded to a temporary file first.
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+
+    if path is not None:
+        yield path
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1]) as temporary:
+        with storage.open(name, 'rb') as file:
+            shutil.copyfileobj(file, temporary, COPY_BLOCK_SIZE)
+        temporary.flush()
+        yield temporary.name
+
+
+def sign_request(method, path, query, headers, payload_hash, access_key, secret_key, region, service, amz_date):
+    # Returns the Authorization header of an AWS Signature Version 4 request, every header in headers is signed.
+    # path and query have to be sent exactly as they are signed, path already percent-encoded.
+    date = amz_date[:8]
+    headers = {name.lower(): ' '.join(str(value).split()) for name, value in headers.items()}
+    signed_headers = ';'.join(sorted(headers))
+
+    canonical_request = '\n'.join([
+        method,
+        path,
+        '&'.join(f'{quote(key, safe="-_.~")}={quote(value, safe="-_.~")}' for key, value in sorted(query.items())),
+        ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers)),
+        signed_headers,
+        payload_hash,
+    ])
+
+    scope = f'{date}/{region}/{service}/aws4_request'
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+    key = f'AWS4{secret_key}'.encode()
+    for part in (date, region, service, 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    return f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}'
+
+
+class S3Error(OSError):
+    def __init__(self, status, body=b''):
+        super().__init__(f'S3 request failed with status {status}: {body[:200]!r}')
+        self.status = status
+
+
+class S3Reader(io.RawIOBase):
+    # Seekable reader of a stored object, every read is a ranged GET. Wrapped in a BufferedReader,
+    # so small reads (headers, tags) don't turn into a request each.
+    def __init__(self, storage, name, size):
+        super().__init__()
+        self.storage = storage
+        self.name = name
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+
+        data = self.storage.request('GET', self.name,
+                                    headers={'Range': f'bytes={self.position}-{end - 1}'}).data
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Stores files in an S3 compatible bucket (AWS, MinIO...), so several app nodes share one media store.
+    Connections are pooled and kept alive, large files are uploaded in parts. Settings default to S3_*.
+    """
+    def __init__(self, endpoint_url=None, bucket=None, access_key=None, secret_key=None, region=None,
+                 base_url=None, max_connections=None, multipart_threshold=None, multipart_chunk_size=None):
+        self.endpoint_url = (endpoint_url or settings.S3_ENDPOINT_URL).rstrip('/')
+        self.bucket = bucket or settings.S3_BUCKET
+        self.access_key = access_key if access_key is not None else settings.S3_ACCESS_KEY
+        self.secret_key = secret_key if secret_key is not None else settings.S3_SECRET_KEY
+        self.region = region or settings.S3_REGION
+        # files without a public bucket URL are served by the app under MEDIA_URL
+        self.base_url = base_url or settings.S3_PUBLIC_URL or settings.MEDIA_URL
+        self.multipart_threshold = multipart_threshold or settings.S3_MULTIPART_THRESHOLD
+        self.multipart_chunk_size = multipart_chunk_size or settings.S3_MULTIPART_CHUNK_SIZE
+
+        self.host = urllib3.util.parse_url(self.endpoint_url).netloc
+        self.pool = urllib3.PoolManager(maxsize=max_connections or settings.S3_MAX_CONNECTIONS,
+                                        retries=urllib3.Retry(total=3, backoff_factor=0.2, redirect=False),
+                                        timeout=urllib3.Timeout(connect=5, read=60))
+
+    def request(self, method, name, query=None, headers=None, body=b'', expected=(200, 204, 206)):
+        query = query or {}
+        path = quote(f'/{self.bucket}/{name}', safe='/-_.~')
+        payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+        amz_date = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+        headers = {**(headers or {}), 'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash}
+        headers['Authorization'] = sign_request(method, path, query, headers, payload_hash, self.access_key,
+                                                self.secret_key, self.region, 's3', amz_date)
+        del headers['host']
+
+        url = self.endpoint_url + path
+        if query:
+            url += '?' + '&'.join(f'{quote(key, safe="-_.~")}={quote(value, safe="-_.~")}'
+                                  for key, value in sorted(query.items()))
+
+        response = self.pool.request(method, url, headers=headers, body=body or None, preload_content=True)
+
+        if response.status == 404 and 404 not in expected:
+            raise FileNotFoundError(f'{name} does not exist in bucket {self.bucket}')
+        if response.status not in expected:
+            raise S3Error(response.status, response.data)
+
+        return response
+
+    def head(self, name):
+        # None if the object doesn't exist
+        response = self.request('HEAD', name, expected=(200, 404))
+        return response.headers if response.status == 200 else None
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise ValueError('S3Storage only opens files for reading')
+
+        return File(io.BufferedReader(S3Reader(self, name, self.size(name)), READ_BUFFER_SIZE), name)
+
+    def _save(self, name, content):
+        headers = {'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+
+        if content.size <= self.multipart_threshold:
+            content.seek(0)
+            self.request('PUT', name, headers=headers, body=content.read())
+        else:
+            self.multipart_upload(name, content, headers)
+
+        return name
+
+    def multipart_upload(self, name, content, headers):
+        response = self.request('POST', name, query={'uploads': ''}, headers=headers)
+        upload_id = ElementTree.fromstring(response.data).findtext('s3:UploadId', namespaces=S3_NAMESPACE)
+
+        try:
+            parts = []
+            for number, chunk in enumerate(content.chunks(self.multipart_chunk_size), 1):
+                response = self.request('PUT', name, query={'partNumber': str(number), 'uploadId': upload_id},
+                                        body=chunk)
+                parts.append((number, response.headers['ETag']))
+
+            body = ''.join(f'<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>'
+                           for number, etag in parts)
+            response = self.request('POST', name, query={'uploadId': upload_id},
+                                    body=f'<CompleteMultipartUpload>{body}</CompleteMultipartUpload>'.encode())
+
+            # completing can fail after the 200 status was sent
+            if ElementTree.fromstring(response.data).tag == 'Error':
+                raise S3Error(response.status, response.data)
+        except BaseException:
+            # parts of unfinished uploads are stored (and billed) until the upload is aborted
+            self.request('DELETE', name, query={'uploadId': upload_id}, expected=(204, 404))
+            raise
+
+    def get_available_name(self, name, max_length=None):
+        # S3 keys always use forward slashes
+        return super().get_available_name(name.replace('\\', '/'), max_length)
+
+    def delete(self, name):
+        self.request('DELETE', name, expected=(200, 204, 404))
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def listdir(self, path):
+        directories, files = [], []
+        for name, is_directory in self.iter_entries(path):
+            (directories if is_directory else files).append(name)
+        return directories, files
+
+    def iter_entries(self, path, start_after=None):
+        # (name, is_directory) of the entries of path in key order, a directory sorts as <name>/. Pages are
+        # listed as they're consumed and start after the key start_after, so the keys before it aren't listed.
+        prefix = f'{path.rstrip("/")}/' if path else ''
+        query = {'list-type': '2', 'prefix': prefix, 'delimiter': '/'}
+        if start_after:
+            query['start-after'] = start_after
+
+        while True:
+            response = self.request('GET', '', query=query)
+            result = ElementTree.fromstring(response.data)
+
+            keys = [element.text for element in result.findall('s3:CommonPrefixes/s3:Prefix', S3_NAMESPACE)]
+            keys += [element.text for element in result.findall('s3:Contents/s3:Key', S3_NAMESPACE)]
+            for key in sorted(keys):
+                yield key[len(prefix):].rstrip('/'), key.endswith('/')
+
+            token = result.findtext('s3:NextContinuationToken', namespaces=S3_NAMESPACE)
+            if result.findtext('s3:IsTruncated', namespaces=S3_NAMESPACE) != 'true' or not token:
+                return
+            query['continuation-token'] = token
+
+    def size(self, name):
+        headers = self.head(name)
+        if headers is None:
+            raise FileNotFoundError(f'{name} does not exist in bucket {self.bucket}')
+        return int(headers['Content-Length'])
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name))
+
+    def get_modified_time(self, name):
+        headers = self.head(name)
+        if headers is None:
+            raise FileNotFoundError(f'{name} does not exist in bucket {self.bucket}')
+
+        modified = parsedate_to_datetime(headers['Last-Modified'])
+        return modified if settings.USE_TZ else timezone.make_naive(modified)
@@ -0,0 +1,186 @@
+import io
+import mimetypes
+import re
+from uuid import uuid4
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+MAX_RANGES = 16
+BLOCK_SIZE = 64 * 1024
+
+
+class FileRange:
+    # File-like view over [start, start + length) of an open file. fileno() and an absolute tell() are kept,
+    # so wsgi.file_wrapper implementations that use os.sendfile (gunicorn, uWSGI) send exactly Content-Length
+    # bytes from the current offset without copying them through Python.
+    def __init__(self, file, start, length):
+        self.file = file
+        self.name = getattr(file, 'name', '')
+        self.start = start
+        self.end = start + length
+        self.file.seek(start)
+
+    def read(self, size=-1):
+        remaining = self.end - self.file.tell()
+        if remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.file.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.file.tell()
+        elif whence == io.SEEK_END:
+            offset += self.end
+        return self.file.seek(max(self.start, min(offset, self.end)))
+
+    def tell(self):
+        return self.file.tell()
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range_header(header, size):
+    # Returns None when the header should be ignored, [] when no range is satisfiable
+    # and a list of inclusive (start, end) tuples otherwise
+    if not header or not header.startswith('bytes='):
+        return None
+
+    specs = header[len('bytes='):].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_RE.match(spec)
+        if match is None:
+            return None
+
+        first, last = match.groups()
+        if not first and not last:
+            return None
+
+        if not first:
+            # suffix range: last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+
+        ranges.append((start, end))
+
+    return coalesce_ranges(ranges)
+
+
+def coalesce_ranges(ranges):
+    # Overlapping ranges are merged, so a client can't make us send the same bytes many times
+    ranges = sorted(ranges)
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+
+    # weak validators never match If-Range
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def ranged_file_response(request, storage, name, content_type=None, cache_control=None):
+    size = storage.size(name)
+    last_modified = int(storage.get_modified_time(name).timestamp())
+    etag = quote_etag(f'{last_modified:x}-{size:x}')
+    content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    if response is None:
+        ranges = None
+        if if_range_matches(request, etag, last_modified):
+            ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+        if ranges == []:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif ranges is None:
+            response = FileResponse(storage.open(name, 'rb'), content_type=content_type)
+            response['Content-Length'] = size
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = FileResponse(FileRange(storage.open(name, 'rb'), start, end - start + 1),
+                                    content_type=content_type,
+                                    status=206)
+            # set explicitly, FileResponse would measure the whole file
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        else:
+            response = multipart_range_response(storage.open(name, 'rb'), ranges, size, content_type)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+
+    if cache_control:
+        response['Cache-Control'] = cache_control
+
+    return response
+
+
+def multipart_range_response(file, ranges, size, content_type):
+    boundary = uuid4().hex
+    headers = [
+        f'--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode()
+        for start, end in ranges
+    ]
+    closing = f'--{boundary}--\r\n'.encode()
+
+    def parts():
+        try:
+            for header, (start, end) in zip(headers, ranges):
+                yield header
+
+                part = FileRange(file, start, end - start + 1)
+                while block := part.read(BLOCK_SIZE):
+                    yield block
+
+                yield b'\r\n'
+            yield closing
+        finally:
+            file.close()
+
+    content_length = sum(len(header) + end - start + 1 + 2 for header, (start, end) in zip(headers, ranges))
+    content_length += len(closing)
+
+    response = StreamingHttpResponse(parts(),
+                                     status=206,
+                                     content_type=f'multipart/byteranges; boundary={boundary}')
+    response['Content-Length'] = content_length
+    return response
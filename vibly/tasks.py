@@ -0,0 +1,66 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+# functions queued by submit_once that haven't started yet
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.TASKS_WORKERS, thread_name_prefix='vibly-task')
+    return _executor
+
+
+def run(fn, *args, **kwargs):
+    try:
+        fn(*args, **kwargs)
+    except Exception:
+        logger.exception('Background task %s failed', fn.__name__)
+    finally:
+        # every worker thread has its own connections
+        connections.close_all()
+
+
+def submit(fn, *args, **kwargs):
+    # Runs fn on the local worker pool once the current transaction commits,
+    # so the task never sees rows that could still be rolled back
+    if settings.TASKS_ALWAYS_EAGER:
+        fn(*args, **kwargs)
+        return
+
+    transaction.on_commit(lambda: get_executor().submit(run, fn, *args, **kwargs))
+
+
+def submit_once(fn):
+    # Like submit, for tasks that work through a queue of rows: fn is queued at most once, every call made
+    # before it starts running is served by that run
+    if settings.TASKS_ALWAYS_EAGER:
+        fn()
+        return
+
+    transaction.on_commit(lambda: queue_once(fn))
+
+
+def queue_once(fn):
+    with _queued_lock:
+        if fn in _queued:
+            return
+        _queued.add(fn)
+
+    get_executor().submit(run_once, fn)
+
+
+def run_once(fn):
+    with _queued_lock:
+        _queued.discard(fn)
+
+    run(fn)
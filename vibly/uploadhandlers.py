@@ -0,0 +1,31 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadHandlerMixin:
+    # Computes the SHA-256 of every uploaded file while it streams in and stores it as file.sha256
+    def new_file(self, *args, **kwargs):
+        # set before super(), MemoryFileUploadHandler.new_file raises StopFutureHandlers when it takes the file
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # an inactive memory handler passes the data on to the next handler, which hashes it instead
+        if getattr(self, 'activated', True):
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
@@ -16,11 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
 
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from .views import image, media
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Vibly API",
@@ -37,7 +38,9 @@ urlpatterns = [
     path('song/', include('songs.urls')),
     path('playlist/', include('playlists.urls')),
     path('album/', include('albums.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)$', media, name='media'),
+    path('image/<path:path>', image, name='image'),
+]
 
 if settings.DEBUG:
     urlpatterns += [
@@ -0,0 +1,81 @@
+import os
+import posixpath
+import re
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.http import Http404, HttpResponseBadRequest
+from django.views.decorators.http import require_safe
+from PIL import Image, UnidentifiedImageError
+
+import vibly.settings as settings
+from .img import ImageTooLarge
+from .imagecache import get_formats, get_resized
+from .stream import ranged_file_response
+
+# <sha256>.<extension> and its variants <sha256>_<size>.<extension>, the content behind these names never changes
+CONTENT_ADDRESSED_NAME = re.compile(r'(?:^|/)[0-9a-f]{64}(?:_\d+)?\.\w+$')
+
+
+def get_media_cache_control(name):
+    # only called for images, which are public whoever owns them
+    if CONTENT_ADDRESSED_NAME.search(name):
+        return 'public, max-age=31536000, immutable'
+    # defaults and files stored before content addressing, revalidated with the ETag
+    return 'public, no-cache'
+
+
+def is_stored_file(path):
+    # directories exist on the local filesystem, object stores only have files
+    try:
+        return os.path.isfile(default_storage.path(path))
+    except NotImplementedError:
+        return default_storage.exists(path)
+    except SuspiciousFileOperation:
+        return False
+
+
+@require_safe
+def media(request, path):
+    # images only, audio is served by the song endpoints and staging directories never are
+    path = posixpath.normpath(path)
+    if not path.startswith(settings.IMAGE_DIRECTORIES) or not is_stored_file(path):
+        raise Http404
+
+    return ranged_file_response(request, default_storage, path, cache_control=get_media_cache_control(path))
+
+
+@require_safe
+def image(request, path):
+    path = posixpath.normpath(path)
+    if not path.startswith(settings.IMAGE_DIRECTORIES) or not is_stored_file(path):
+        raise Http404
+
+    try:
+        width = int(request.GET.get('width', ''))
+    except ValueError:
+        width = None
+
+    if width not in settings.IMAGE_RESIZE_WIDTHS:
+        return HttpResponseBadRequest(f'width must be one of {", ".join(map(str, settings.IMAGE_RESIZE_WIDTHS))}')
+
+    image_format = request.GET.get('format', 'jpeg')
+    if image_format not in get_formats():
+        return HttpResponseBadRequest(f'format must be one of {", ".join(get_formats())}')
+
+    # Another process' eviction can delete the entry before it's opened, it's resized again once. Once open,
+    # the file is served even if it's deleted.
+    for attempt in range(2):
+        try:
+            name = get_resized(path, width, image_format)
+        except (UnidentifiedImageError, Image.DecompressionBombError, ImageTooLarge) as e:
+            return HttpResponseBadRequest(str(e))
+
+        try:
+            return ranged_file_response(request,
+                                        FileSystemStorage(location=settings.IMAGE_CACHE_ROOT),
+                                        name,
+                                        cache_control=get_media_cache_control(path))
+        except FileNotFoundError:
+            if attempt:
+                raise